@@ -80,6 +80,7 @@ setup(
         'valkka.live.qt',
         'valkka.mvision',
         'valkka.mvision.movement',
+        'valkka.mvision.movementmulti',
         'valkka.mvision.nix',
         'valkka.mvision.yolo3',
         'valkka.mvision.yolo2',
@@ -23,6 +23,7 @@ You should have received a copy of the GNU Affero General Public License along w
 import sys
 import time
 import copy
+import threading
 from enum import Enum
 
 # so, everything that has .core, refers to the api1 level (i.e. swig
@@ -51,6 +52,45 @@ class RecordType(Enum):
 
     
 
+class ShmemBranch:
+    """RGB images of one geometry for the shmem terminals of MultiForkFilterchain:
+
+    ::
+
+        --> [{TimeIntervalFrameFilter: interval_filter}] --> {SwScaleFrameFilter: sws_filter} --> {ForkFrameFilterN: fork_filter}
+
+    :param name:        Unique name of the branch
+    :param width:       Image width
+    :param height:      Image height
+    :param interval:    Interval between frames in milliseconds.  None = no interval filter
+    """
+
+    def __init__(self, name, width, height, interval = None):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.terminals = {} # keep references to the terminal framefilters
+        self.fork_filter = core.ForkFrameFilterN(name + "_fork")
+        self.sws_filter = core.SwScaleFrameFilter(name + "_sws", width, height, self.fork_filter)
+        if interval is None:
+            self.interval_filter = None
+        else:
+            self.interval_filter = core.TimeIntervalFrameFilter(name + "_interval", interval, self.sws_filter)
+
+    def getInput(self):
+        if self.interval_filter is None:
+            return self.sws_filter
+        return self.interval_filter
+
+    def connect(self, name, framefilter):
+        self.terminals[name] = framefilter
+        self.fork_filter.connect(name, framefilter)
+
+    def disconnect(self, name):
+        self.fork_filter.disconnect(name)
+        self.terminals.pop(name)
+
+
 class MultiForkFilterchain(BaseFilterchain):
     """This class implements the following filterchain:
     
@@ -86,17 +126,26 @@ class MultiForkFilterchain(BaseFilterchain):
              |             |
              |             +~~ callback (**)
              |
-             +-- {GateFrameFilter: sws_gate} --> {SwScaleFrameFilter: sws_filter} --> {ForkFrameFilterN: sws_fork_M}
-                                                                                           |                                                                 
-                   +------------+------------+---------------------------------------------+             
+             +-- {GateFrameFilter: sws_gate} --> {ForkFrameFilterN: sws_fork_M}
+                                                                   |
+                   +------------+------------+---------------------+
+                   |            |            |
+                 shmem branches, one per distinct image geometry (width, height, interval), shared by the clients:
+
+                 --> [{TimeIntervalFrameFilter: interval}] --> {SwScaleFrameFilter: sws} --> {ForkFrameFilterN: fork}
+                                                                                                      |
+                   +------------+------------+----------------------------------------------------------+
                    |            |            |
                  on-demand terminals for RGB images, for example
-                   
-                 - RGBShmemFrameFilter(s)                                               
-                 - A common framefilter for all threads: 
-                 
+
+                 - RGBShmemFrameFilter(s)
+                 - A common framefilter for all threads:
+
                  --> {ThreadSafeFrameFilter: common_sws_filter} --> {RGBShmemFrameFilter: common_rgb_shmem_filter}
                  [this could feed a common yolo detector for N streams]
+
+        The movement filter passes frames at shmem_image_interval, so a shmem branch can only be slower than that.  A branch
+        with a longer interval gets a TimeIntervalFrameFilter of its own.  See getShmem
                  
         *** qt bitmap branch *** (in the case you need to pass bitmaps to the qt subsystem)
 
@@ -151,6 +200,8 @@ class MultiForkFilterchain(BaseFilterchain):
         "shmem_image_interval"   : None, # (int, 1000),
         
         "vaapi": (bool, False),
+        "autostart": (bool, True), # register the stream & start the threads at the constructor.  If False, call start & createContext yourself
+        "decoding_linger": (float, 0.0), # when the last client needing decoding goes away, keep decoding for this many seconds.  Makes flipping views instant
 
         # "movement_interval" : (int, 100), # pass frames at 10 fps # USE shmem_image_interval
         # "movement_treshold" : (float, 0.01),
@@ -184,15 +235,28 @@ class MultiForkFilterchain(BaseFilterchain):
         self.make_analysis_branch()
         self.make_qt_branch()
         
-        self.createContext() # creates & registers contexes to LiveThread & USBDeviceThread
-        
-        self.start() # starts threads corresponding to this filterchain
+        if self.autostart:
+            self.createContext() # creates & registers contexes to LiveThread & USBDeviceThread
+            self.start() # starts threads corresponding to this filterchain
     
     
     def setTCPStreaming(self, val):
         self.request_tcp = val
 
 
+    def reconfigure(self, **kwargs):
+        """Change the stream parameters on-the-fly: address, request_tcp, time_correction or msreconnect
+
+        The stream is re-registered to LiveThread (or USBDeviceThread).  Decoding, viewports and shmem terminals stay as they are
+        """
+        for key in kwargs:
+            assert(key in ["address", "request_tcp", "time_correction", "msreconnect"]), "can't reconfigure " + key
+        self.closeContext()
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        self.createContext()
+
+
     def __del__(self):
         self.requestClose()
         
@@ -201,6 +265,18 @@ class MultiForkFilterchain(BaseFilterchain):
         # client counters
         self.decoding_client_count = 0
         self.movement_client_count = 0
+
+        # decoding on/off with a linger time
+        self.decoding = False
+        self.decoding_timer = None # threading.Timer that switches decoding off
+        self.decoding_lock = threading.Lock()
+        self.decoding_stats = {
+            "on"        : 0, # times decoding was switched on
+            "off"       : 0, # times decoding was switched off
+            "kept"      : 0, # times a new client arrived while lingering, i.e. decoder restarts saved
+            "time"      : 0.0 # seconds decoded in total
+            }
+        self.t_decoding = None # when decoding was switched on
         
         self.sws_client_count = 0
         self.x_screen_count = {}
@@ -217,6 +293,10 @@ class MultiForkFilterchain(BaseFilterchain):
 
         # shmem related
         self.shmem_terminals = {}
+        self.shmem_geometry = {} # shmem_name: (n_buffer, image_dimensions, image_interval)
+        self.shmem_event_fds = {} # shmem_name: EventFd.  See getShmem
+        self.shmem_branches = {} # (width, height, interval): ShmemBranch
+        self.shmem_serial = 0 # for unique shmem names
         self.width      = self.shmem_image_dimensions[0]
         self.height     = self.shmem_image_dimensions[1]
             
@@ -244,6 +324,8 @@ class MultiForkFilterchain(BaseFilterchain):
             self.disconnectRec()
             self.releaseAllShmem()
             self.clearAllViewPorts()
+            with self.decoding_lock:
+                self.cancelDecodingOff_()
         self.closed = True
         
         
@@ -387,14 +469,16 @@ class MultiForkFilterchain(BaseFilterchain):
 
         self.ctx.address = self.address
         # stream address, i.e. "rtsp://.."
-        print("RTSP reconnection time:", self.msreconnect)
+        if (self.verbose): print("RTSP reconnection time:", self.msreconnect)
         self.ctx.msreconnect = self.msreconnect
         
         self.ctx.recv_buffer_size = self.recv_buffer_size
         self.ctx.reordering_time = self.reordering_mstime * 1000  # from millisecs to microsecs
 
         self.ctx.time_correction = self.time_correction
-        if self.ctx.time_correction == core.TimeCorrectionType_smart:
+        if not self.verbose:
+            pass
+        elif self.ctx.time_correction == core.TimeCorrectionType_smart:
             print("createLiveContext: smart timestamps")
         else:
             print("createLiveContext: dummy timestamps")
@@ -440,7 +524,7 @@ class MultiForkFilterchain(BaseFilterchain):
         self.ctx.framefilter = self.fork_filter_main
 
         # start playing
-        print("createUSBContext: play")
+        if (self.verbose): print("createUSBContext: play")
         self.usbdevicethread.playStream(self.ctx)
     
     
@@ -501,8 +585,8 @@ class MultiForkFilterchain(BaseFilterchain):
         - Analysis on movement
         """
         self.sws_fork_filter = core.ForkFrameFilterN("sws_fork_" + str(self.slot))
-        self.sws_filter = core.SwScaleFrameFilter("sws_scale_" + str(self.slot), self.width, self.height, self.sws_fork_filter)
-        self.sws_gate = core.GateFrameFilter("sws_gate_" + str(self.slot), self.sws_filter)
+        # the shmem branches (SwScaleFrameFilters) are connected to sws_fork_filter on-demand.  See getShmem
+        self.sws_gate = core.GateFrameFilter("sws_gate_" + str(self.slot), self.sws_fork_filter)
         self.movement_filter = core.MovementFrameFilter("movement_" + str(self.slot), 
                 # self.movement_interval,
                 self.shmem_image_interval,
@@ -541,16 +625,69 @@ class MultiForkFilterchain(BaseFilterchain):
         """Count instances that need decoding
         
         Start decoding if the number goes from 0 => 1
-        Stop decoding if the number goes from 1 => 0
+        Stop decoding if the number goes from 1 => 0, after decoding_linger seconds.  If a new client arrives before that, decoding just continues
         """
-        if self.decoding_client_count < 1 and inc > 0:
-            # connect the analysis branch
-            print(self.__class__.__name__, "start decoding for slot", self.slot)
-            self.avthread.decodingOnCall()
-        elif self.decoding_client_count == 1 and inc < 0:
-            print(self.__class__.__name__, "stop decoding for slot", self.slot)
-            self.avthread.decodingOffCall()
-        self.decoding_client_count += inc
+        with self.decoding_lock:
+            self.decoding_client_count += inc
+            if self.decoding_client_count > 0:
+                if self.cancelDecodingOff_():
+                    self.decoding_stats["kept"] += 1
+                if not self.decoding:
+                    self.decodingOn_()
+            elif inc < 0 and self.decoding:
+                if self.decoding_linger > 0 and not self.closed:
+                    self.decoding_timer = threading.Timer(self.decoding_linger, self.lingerExpired_)
+                    self.decoding_timer.daemon = True
+                    self.decoding_timer.start()
+                else:
+                    self.decodingOff_()
+
+
+    def lingerExpired_(self):
+        with self.decoding_lock:
+            if self.decoding_timer is None: # cancelled meanwhile
+                return
+            self.decoding_timer = None
+            if self.decoding_client_count < 1 and self.decoding and not self.closed:
+                self.decodingOff_()
+
+
+    def cancelDecodingOff_(self):
+        """Returns True if there was a pending decoding switch-off
+        """
+        if self.decoding_timer is None:
+            return False
+        self.decoding_timer.cancel()
+        self.decoding_timer = None
+        return True
+
+
+    def decodingOn_(self):
+        print(self.__class__.__name__, "start decoding for slot", self.slot)
+        self.avthread.decodingOnCall()
+        self.decoding = True
+        self.decoding_stats["on"] += 1
+        self.t_decoding = time.time()
+
+
+    def decodingOff_(self):
+        print(self.__class__.__name__, "stop decoding for slot", self.slot)
+        self.avthread.decodingOffCall()
+        self.decoding = False
+        self.decoding_stats["off"] += 1
+        self.decoding_stats["time"] += time.time() - self.t_decoding
+
+
+    def getDecodingStats(self):
+        """Returns a copy of the decoding statistics, with the current state added
+        """
+        with self.decoding_lock:
+            stats = copy.copy(self.decoding_stats)
+            stats["decoding"] = self.decoding
+            stats["lingering"] = self.decoding_timer is not None
+            if self.decoding:
+                stats["time"] += time.time() - self.t_decoding
+        return stats
         
     
     def movement_client(self, inc = 0):
@@ -616,21 +753,88 @@ class MultiForkFilterchain(BaseFilterchain):
             
 
     # *** Shmem hooks ***
-            
-    def getShmem(self):
+
+    def getShmemBranch_(self, width, height, interval):
+        """Returns the ShmemBranch for this geometry.  Creates & connects it if necessary
+        """
+        key = (width, height, interval)
+        try:
+            return self.shmem_branches[key]
+        except KeyError:
+            pass
+        name = "shmem_branch_%i_%ix%i_%i" % (self.slot, width, height, interval)
+        if self.verbose:
+            print(self.pre, "getShmemBranch_ : creating", name)
+        branch = ShmemBranch(
+            name        = name,
+            width       = width,
+            height      = height,
+            interval    = interval if interval > self.shmem_image_interval else None
+            )
+        self.shmem_branches[key] = branch
+        self.sws_fork_filter.connect(name, branch.getInput())
+        return branch
+
+
+    def releaseShmemBranch_(self, width, height, interval):
+        """Disconnects & removes the ShmemBranch if it has no terminals left
+        """
+        branch = self.shmem_branches[(width, height, interval)]
+        if len(branch.terminals) > 0:
+            return
+        if self.verbose:
+            print(self.pre, "releaseShmemBranch_ : removing", branch.name)
+        self.sws_fork_filter.disconnect(branch.name)
+        self.shmem_branches.pop((width, height, interval))
+
+
+    def getShmem(self, image_dimensions = None, image_interval = None, n_buffer = None, use_event_fd = False):
         """Returns the unique name identifying the shared mem and semaphores.  The name can be passed to the machine vision routines.
+
+        :param image_dimensions:    Requested image (width, height).  Default: shmem_image_dimensions of this filterchain
+        :param image_interval:      Requested interval between frames in milliseconds.  Default (and minimum): shmem_image_interval of this filterchain
+        :param n_buffer:            Requested ring-buffer size.  Default: shmem_n_buffer of this filterchain
+        :param use_event_fd:        The shmem server signals new frames also with an EventFd, so that a client can select over several streams.  Get it with getShmemEventFd
+
+        Clients requesting the same image dimensions & interval share the same SwScaleFrameFilter.  Get the negotiated values with getShmemGeometry
         """
+        if image_dimensions is None:
+            image_dimensions = (self.width, self.height)
+        if image_interval is None or image_interval < self.shmem_image_interval:
+            image_interval = self.shmem_image_interval
+        if n_buffer is None:
+            n_buffer = self.shmem_n_buffer
+        width, height = image_dimensions
         shmem_name = singleton.sema_uuid + "_" +\
-            self.idst + "_" + str(len(self.shmem_terminals))
-        print("getShmem : reserving", shmem_name)
-        shmem_filter = core.RGBShmemFrameFilter(shmem_name, self.shmem_n_buffer, self.width, self.height)
+            self.idst + "_" + str(self.shmem_serial)
+        self.shmem_serial += 1
+        print("getShmem : reserving", shmem_name, "%ix%i @ %i ms" % (width, height, image_interval))
+        branch = self.getShmemBranch_(width, height, image_interval)
+        shmem_filter = core.RGBShmemFrameFilter(shmem_name, n_buffer, width, height)
         # shmem_filter = core.BriefInfoFrameFilter(shmem_name) # DEBUG: see if you are actually getting any frames here ..
+        if use_event_fd:
+            event_fd = core.EventFd()
+            shmem_filter.useFd(event_fd)
+            self.shmem_event_fds[shmem_name] = event_fd
         self.shmem_terminals[shmem_name] = shmem_filter
-        self.sws_fork_filter.connect(shmem_name, shmem_filter)
+        self.shmem_geometry[shmem_name] = (n_buffer, (width, height), image_interval)
+        branch.connect(shmem_name, shmem_filter)
         # if first time, connect main branch to swscale_branch
         self.sws_client(inc = 1)
         return shmem_name 
-    
+
+
+    def getShmemGeometry(self, shmem_name):
+        """Returns (n_buffer, image_dimensions, image_interval) of a shmem terminal reserved with getShmem
+        """
+        return self.shmem_geometry[shmem_name]
+
+
+    def getShmemEventFd(self, shmem_name):
+        """Returns the EventFd of a shmem terminal reserved with getShmem(use_event_fd = True)
+        """
+        return self.shmem_event_fds[shmem_name]
+
         
     def releaseShmem(self, shmem_name):
         try:
@@ -638,7 +842,11 @@ class MultiForkFilterchain(BaseFilterchain):
         except KeyError:
             return False
         print("releaseShmem : releasing", shmem_name)
-        self.sws_fork_filter.disconnect(shmem_name)
+        n_buffer, (width, height), image_interval = self.shmem_geometry.pop(shmem_name)
+        self.shmem_branches[(width, height, image_interval)].disconnect(shmem_name)
+        self.releaseShmemBranch_(width, height, image_interval)
+        # the EventFd must outlive the shmem filter
+        self.shmem_event_fds.pop(shmem_name, None)
         self.sws_client(inc = -1)
         return True
         
@@ -846,11 +1054,24 @@ def test1():
 
     print("\nsetRecording getShmem\n")
     name = fc.getShmem()
+    # two clients sharing a SwScaleFrameFilter & one with a geometry of its own
+    name1 = fc.getShmem(image_dimensions = (416, 416), image_interval = 2000)
+    name2 = fc.getShmem(image_dimensions = (416, 416), image_interval = 2000)
+    name3 = fc.getShmem(image_dimensions = (160, 90), image_interval = 10)
+    print(fc.getShmemGeometry(name1), fc.getShmemGeometry(name3))
+    assert(len(fc.shmem_branches) == 3)
     print("\nsleep\n")
     time.sleep(n)
     
     print("\nsetRecording releaseShmem\n")
-    fc.releaseShmem(name)
+    fc.releaseShmem(name) # the only client of the default geometry: its branch goes away
+    fc.releaseShmem(name1)
+    assert(len(fc.shmem_branches) == 2)
+    assert((416, 416, 2000) in fc.shmem_branches) # still used by name2
+    fc.releaseShmem(name2)
+    assert((416, 416, 2000) not in fc.shmem_branches)
+    fc.releaseShmem(name3)
+    assert(len(fc.shmem_branches) == 0)
     print("\nsleep\n")
     time.sleep(n)
 
@@ -0,0 +1,287 @@
+"""
+codec.py : Compact binary framing for the messages between Qt frontend and python multiprocesses
+
+Copyright 2018 Sampsa Riikonen
+
+Authors: Sampsa Riikonen
+
+This file is part of the Valkka Live video surveillance program
+
+Valkka Live is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+@file    codec.py
+@author  Sampsa Riikonen
+@date    2018
+@version 1.2.2
+@brief   Compact binary framing for the messages between Qt frontend and python multiprocesses
+"""
+import struct
+import pickle
+import marshal
+import time
+from multiprocessing.reduction import ForkingPickler
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+"""A message on the wire looks like this:
+
+::
+
+    [header: command id (uint16), payload format (uint8), payload length (uint32)] [payload]
+
+Command names are mapped to small integers with a command table.  Commands not in the table
+are sent with command id COMMAND_INLINE and the command name is the first element of the payload.
+
+Payload formats:
+
+::
+
+    FORMAT_NONE     : no payload (a command without kwargs)
+    FORMAT_MARSHAL  : marshal encoding of simple python types (None, bool, int, float, str, bytes, lists, tuples, dicts)
+    FORMAT_MSGPACK  : msgpack encoding (if msgpack is installed)
+    FORMAT_PICKLE   : fallback for objects that can't be encoded otherwise (including multiprocessing pipes)
+
+Both ends of the pipe are forked from the same python interpreter, so the marshal format is
+always compatible.  Unlike pickle, marshal does not need to look up classes & modules at the
+receiving end, which makes it several times faster for the small dicts we are sending.
+
+The special command id COMMAND_STOP corresponds to None, i.e. to the "exit" sentinel that is
+passed through the pipes.
+"""
+
+header = struct.Struct("<HBI")
+
+COMMAND_STOP = 0
+COMMAND_INLINE = 0xFFFF
+
+FORMAT_NONE = 0
+FORMAT_MARSHAL = 1
+FORMAT_MSGPACK = 2
+FORMAT_PICKLE = 3
+
+# commands used by valkka live & the machine vision plugins.  Add your own with registerCommand
+default_commands = [
+    "ping",
+    "pong",
+    "activate",
+    "deactivate",
+    "registerClient",
+    "unregisterClient",
+    "setMasterProcess",
+    "unsetMasterProcess",
+    "updateAnalyzerParameters",
+    "resetAnalyzerState",
+    "requestQtShmemServer",
+    "releaseQtShmemServer",
+    "shmem_server",
+    "start_move",
+    "stop_move",
+    "text",
+    "objects",
+    "bboxes",
+    "load"
+]
+
+
+class MessageCodec:
+    """Encodes command & kwargs pairs into bytes and back
+
+    :param commands:    List of command names.  Their position in the list defines the command id.
+                        Both ends of the pipe must use the same list, so register custom commands before forking
+    :param use_msgpack: Use msgpack for the payload if it's available.  Default: False (marshal is used)
+
+    Methods to use:
+
+    ::
+
+        encode(command, kwargs) -> bytes
+        decode(bytes) -> (command, kwargs)
+
+    A command that is None, is encoded as COMMAND_STOP
+    """
+
+    def __init__(self, commands = default_commands, use_msgpack = False):
+        self.command_by_id = {}
+        self.id_by_command = {}
+        for command in commands:
+            self.registerCommand(command)
+        if use_msgpack and msgpack is not None:
+            self.format = FORMAT_MSGPACK
+        else:
+            self.format = FORMAT_MARSHAL
+
+
+    def registerCommand(self, command: str):
+        """Add a command to the table.  Returns the command id
+        """
+        if command in self.id_by_command:
+            return self.id_by_command[command]
+        command_id = len(self.command_by_id) + 1 # 0 is reserved for COMMAND_STOP
+        assert(command_id < COMMAND_INLINE)
+        self.command_by_id[command_id] = command
+        self.id_by_command[command] = command_id
+        return command_id
+
+
+    def encodePayload_(self, payload):
+        if self.format == FORMAT_MSGPACK:
+            try:
+                # use_bin_type: keep str and bytes distinct
+                return FORMAT_MSGPACK, msgpack.packb(payload, use_bin_type = True)
+            except (TypeError, ValueError, OverflowError):
+                pass
+        else:
+            try:
+                return FORMAT_MARSHAL, marshal.dumps(payload)
+            except ValueError: # an unmarshallable object
+                pass
+        # payload has something exotic.  Pickle it.  ForkingPickler knows how to send pipes & file descriptors to another process
+        return FORMAT_PICKLE, bytes(ForkingPickler.dumps(payload, protocol = pickle.HIGHEST_PROTOCOL))
+
+
+    def encode(self, command, kwargs = None) -> bytes:
+        if command is None:
+            return header.pack(COMMAND_STOP, FORMAT_NONE, 0)
+        command_id = self.id_by_command.get(command, COMMAND_INLINE)
+        if command_id == COMMAND_INLINE:
+            payload = [command, kwargs or {}]
+        elif kwargs:
+            payload = kwargs
+        else:
+            return header.pack(command_id, FORMAT_NONE, 0)
+        fmt, body = self.encodePayload_(payload)
+        return header.pack(command_id, fmt, len(body)) + body
+
+
+    def decode(self, buf):
+        """Returns a tuple (command, kwargs).  For the stop sentinel, command is None
+        """
+        command_id, fmt, n = header.unpack_from(buf, 0)
+        if command_id == COMMAND_STOP:
+            return None, None
+        body = memoryview(buf)[header.size:header.size + n]
+        if fmt == FORMAT_NONE:
+            payload = {}
+        elif fmt == FORMAT_MARSHAL:
+            payload = marshal.loads(body)
+        elif fmt == FORMAT_MSGPACK:
+            # msgpack returns lists instead of tuples.  Keep it that way: it's faster & the
+            # consumers (Qt slots, c__ methods) index the values anyway
+            payload = msgpack.unpackb(body, raw = False)
+        elif fmt == FORMAT_PICKLE:
+            payload = pickle.loads(body)
+        else:
+            raise ValueError("corrupt message: unknown payload format %i" % (fmt))
+
+        if command_id == COMMAND_INLINE:
+            return payload[0], payload[1]
+        try:
+            command = self.command_by_id[command_id]
+        except KeyError:
+            raise ValueError("corrupt message: unknown command id %i" % (command_id))
+        return command, payload
+
+
+# the codec instance used by valkka.live.multiprocess
+codec = MessageCodec()
+
+
+def registerCommand(command: str):
+    """Register a custom command for your machine vision plugin.  Must be done at import time, i.e. before the multiprocesses are forked
+    """
+    return codec.registerCommand(command)
+
+
+class BenchmarkMessage:
+    """Like valkka.live.multiprocess.MessageObject, but without the Qt imports
+    """
+    def __init__(self, command, **kwargs):
+        self.command = command
+        self.kwargs = kwargs
+
+
+def benchmark(n = 10000, codec_ = None):
+    """Compare pickling against the binary codec through a real multiprocessing.Pipe
+
+    Returns a dict with microseconds per message for both ways of sending
+    """
+    from multiprocessing import Pipe
+    if codec_ is None:
+        codec_ = codec
+
+    bbox_list = [(0.1*i, 0.2*i, 0.3*i, 0.4*i) for i in range(10)]
+    object_list = ["person", "dog", "car", "bicycle"]
+    messages = [
+        ("bboxes", {"bbox_list": bbox_list}),
+        ("objects", {"object_list": object_list}),
+        ("start_move", {}),
+        ("text", {"message": "Has analyzed 10 frames"})
+    ]
+    a, b = Pipe()
+    res = {}
+
+    t = time.time()
+    for i in range(n):
+        command, kwargs = messages[i % len(messages)]
+        a.send(BenchmarkMessage(command, **kwargs))
+        obj = b.recv()
+    res["pickle"] = (time.time() - t) / n * 1e6
+
+    t = time.time()
+    for i in range(n):
+        command, kwargs = messages[i % len(messages)]
+        a.send_bytes(codec_.encode(command, kwargs))
+        command, kwargs = codec_.decode(b.recv_bytes())
+    res["codec"] = (time.time() - t) / n * 1e6
+
+    res["pickle_size"] = len(pickle.dumps(BenchmarkMessage("bboxes", bbox_list = bbox_list)))
+    res["codec_size"] = len(codec_.encode("bboxes", {"bbox_list": bbox_list}))
+    return res
+
+
+def test1():
+    """Encode & decode round trip
+    """
+    for codec_ in [MessageCodec(), MessageCodec(use_msgpack = True)]:
+        for command, kwargs in [
+                ("bboxes", {"bbox_list": [(0.1, 0.2, 0.3, 0.4)]}),
+                ("start_move", {}),
+                ("my_custom_command", {"a": 1, "b": None, "c": [True, False], "d": b"kokkelis"}),
+                ("updateAnalyzerParameters", {"line": [[0.1, 0.2], [0.3, 0.4]], "unitnormal": [0.0, 1.0]}),
+                ("text", {"message": "äö unicode"}),
+                ("objects", {"object_list": range(3)}), # not marshallable: goes through pickle
+                (None, None)
+            ]:
+            command_, kwargs_ = codec_.decode(codec_.encode(command, kwargs))
+            print(command, kwargs, "==>", command_, kwargs_)
+            assert(command_ == command)
+
+
+def test2():
+    """Micro-benchmark: pickle vs. codec
+    """
+    for codec_ in [MessageCodec(), MessageCodec(use_msgpack = True)]:
+        print("format", codec_.format, benchmark(codec_ = codec_))
+
+
+def main():
+    import sys
+    pre = "main :"
+    print(pre, "main: arguments: ", sys.argv)
+    if (len(sys.argv) < 2):
+        print(pre, "main: needs test number")
+    else:
+        st = "test" + str(sys.argv[1]) + "()"
+        exec(st)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -143,16 +143,14 @@ class MVisionContainer(VideoContainer):
     
     def getProcess(self, tag):
         try:
-            queue = singleton.process_map[tag]
+            pool = singleton.process_map[tag]
         except KeyError:
             return None
-        
-        try:
-            mvision_process = queue.pop()
-        except IndexError:
-            return None
-
-        return mvision_process
+        if self.mvision_class.max_streams > 1:
+            # a multiprocess that analyzes several streams: share it
+            return pool.getShared()
+        # an idle process from the pool or a freshly forked one.  None if max_instances has been reached
+        return pool.get()
     
 
     def serialize(self):
@@ -183,6 +181,7 @@ class MVisionContainer(VideoContainer):
             QtWidgets.QSizePolicy.Expanding)
         
         self.video.signals.drop.connect(self.setDevice)
+        self.video.signals.resize.connect(self.resize_slot)
         self.define_analyzer_button.clicked.connect(self.right_double_click_slot) # show the analyzer widget windows
         
         # this VideoContainer was initialized with a device id, so we stream the video now
@@ -216,18 +215,34 @@ class MVisionContainer(VideoContainer):
         self.video.setDevice(self.device) # inform the video widget so it can start drags
         
         # ManagedFilterChain.addViewPort accepts ViewPort instance
-        self.filterchain = self.filterchain_group.get(_id = self.device._id)
+        self.filterchain = self.getFilterchain_()
         
         if self.filterchain:
             self.viewport.setXScreenNum(self.n_xscreen)
             self.viewport.setWindowId  (int(self.video.winId()))
             self.filterchain.addViewPort(self.viewport)
             
-            # now the shared mem / semaphore part :
-            self.shmem_name = self.filterchain.getShmem()
-            print(self.pre, "setDevice : got shmem name", self.shmem_name)
+            # now the shared mem / semaphore part .. the images are downscaled anyway, so prefer the sub stream
+            if hasattr(self.filterchain_group, "getForAnalyzer"):
+                self.shmem_filterchain = self.filterchain_group.getForAnalyzer(self.device._id)
+            else:
+                self.shmem_filterchain = self.filterchain
+            self.shmem_name = self.shmem_filterchain.getShmem(
+                image_dimensions    = self.mvision_class.shmem_image_dimensions,
+                image_interval      = self.mvision_class.shmem_image_interval,
+                n_buffer            = self.mvision_class.shmem_n_buffer,
+                # a multiprocess that analyzes several streams selects over their EventFds
+                use_event_fd        = self.mvision_class.max_streams > 1
+                )
+            # the filterchain might not give exactly what was requested
+            self.shmem_n_buffer, self.shmem_image_dimensions, self.shmem_image_interval =\
+                self.shmem_filterchain.getShmemGeometry(self.shmem_name)
+            print(self.pre, "setDevice : got shmem name", self.shmem_name, self.shmem_image_dimensions, self.shmem_image_interval)
             
-            self.mvision_widget = self.mvision_process.getWidget()
+            if self.mvision_class.max_streams > 1:
+                self.mvision_widget = self.mvision_process.getWidget(shmem_name = self.shmem_name)
+            else:
+                self.mvision_widget = self.mvision_process.getWidget()
             self.mvision_widget.setParent(self.main_widget)
             self.main_layout.addWidget(self.mvision_widget)
             
@@ -259,12 +274,28 @@ class MVisionContainer(VideoContainer):
 
 
     def activate(self):
-        self.mvision_process.activate(
-                n_buffer         = singleton.shmem_n_buffer,
-                image_dimensions = singleton.shmem_image_dimensions,
+        if self.mvision_class.max_streams > 1:
+            self.mvision_process.activate(
+                n_buffer         = self.shmem_n_buffer,
+                image_dimensions = self.shmem_image_dimensions,
+                shmem_name       = self.shmem_name,
+                event_fd         = self.shmem_filterchain.getShmemEventFd(self.shmem_name)
+                )
+        else:
+            self.mvision_process.activate(
+                n_buffer         = self.shmem_n_buffer,
+                image_dimensions = self.shmem_image_dimensions,
                 shmem_name       = self.shmem_name
                 )
         # creates the shmem client at the multiprocess
+
+
+    def deactivate(self):
+        if self.mvision_class.max_streams > 1:
+            # removes only this stream from the multiprocess
+            self.mvision_process.deactivate(shmem_name = self.shmem_name)
+        else:
+            self.mvision_process.deactivate()
             
 
     def set_bounding_boxes_slot(self, message_object):
@@ -299,13 +330,17 @@ class MVisionContainer(VideoContainer):
         self.analyzer_widget.close()
 
         self.filterchain.delViewPort(self.viewport)
-        self.filterchain.releaseShmem(self.shmem_name)
+        self.shmem_filterchain.releaseShmem(self.shmem_name)
 
-        self.mvision_process.deactivate() # deactivates the shmem client at the multiprocess & puts process back to sleep ..
+        self.deactivate() # deactivates the shmem client at the multiprocess & puts process back to sleep ..
         
         self.main_layout.removeWidget(self.mvision_widget)
+        if self.mvision_class.max_streams > 1:
+            # the multiprocess is shared: it must forget the widget of this stream
+            self.mvision_process.releaseWidget(shmem_name = self.shmem_name)
         
         self.filterchain = None
+        self.shmem_filterchain = None
         self.device = None
         
         self.disconnectSignals()
@@ -318,7 +353,10 @@ class MVisionContainer(VideoContainer):
         if self.mvision_process is None:
             return
         tag = self.mvision_class.tag
-        singleton.process_map[tag].append(self.mvision_process) # .. and recycle it
+        if (self.mvision_class.max_streams > 1) and self.mvision_process.inUse():
+            pass # other containers are still using this multiprocess
+        else:
+            singleton.process_map[tag].put(self.mvision_process) # .. and recycle it
         print(self.pre, "close: process_map=", singleton.process_map)
         if self.analyzer_widget_connected:
             self.mvision_process.disconnectAnalyzerWidget(self.analyzer_widget)
@@ -333,76 +371,69 @@ class MVisionContainer(VideoContainer):
 
 class MVisionClientContainer(MVisionContainer):
     """Like the mother class, but does client/master process handling
+
+    The master process is attached to the client process in activate & detached in deactivate.  The client process keeps the reference to its master process (mvision_process.master_process), since the master process might be changed on-the-fly (see gui.balanceProcesses)
     """
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
         if self.mvision_process is None:
-            self.mvision_master_process = None
             return
 
+        # don't fork a master process just yet: check only that there will be one in activate
         master_tag = self.mvision_process.master
-        self.mvision_master_process = self.getMasterProcess(master_tag)
-        if self.mvision_master_process is None: 
+        if not singleton.avail_master_process(master_tag):
             self.clearProcess()
             return
 
-        # self.mvision_process.setMasterProcess(self.mvision_master_process)
-
 
     def getProcess(self, tag):
         # print(self.pre, "getProcess: client_process_map0=", singleton.client_process_map)
         try:
-            queue = singleton.client_process_map[tag]
+            pool = singleton.client_process_map[tag]
         except KeyError:
             return None
-        try:
-            mvision_process = queue.pop()
-        except IndexError:
-            return None
         # print(self.pre, "getProcess: client_process_map=", singleton.client_process_map)
-        return mvision_process
+        return pool.get()
 
 
     def clearProcess(self):
         print("MVisionClientContainer: clearProcess")
         if self.mvision_process is None:
             return
-        self.mvision_process.unsetMasterProcess()        
+        master_process = self.mvision_process.master_process
+        if master_process is not None:
+            self.mvision_process.unsetMasterProcess()
+            singleton.release_master_process(master_process)
         tag = self.mvision_class.tag
         # print(self.pre, "clearProcess: client_process_map0=", singleton.client_process_map)
-        singleton.client_process_map[tag].append(self.mvision_process) # .. and recycle it
+        singleton.client_process_map[tag].put(self.mvision_process) # .. and recycle it
         # print(self.pre, "clearProcess: client_process_map=", singleton.client_process_map)
         if self.analyzer_widget_connected:
             self.mvision_process.disconnectAnalyzerWidget(self.analyzer_widget)
         self.mvision_process = None
 
-    
-    def getMasterProcess(self, tag):
-        return singleton.get_avail_master_process(tag)
-
-    def clearMasterProcess(self):
-        if self.mvision_master_process is None:
-            return
-        master_tag = self.mvision_master_process.tag
-        singleton.master_process_map[master_tag].append(self.mvision_master_process)
-        self.mvision_master_process = None
-
 
     def activate(self):
         self.mvision_process.activate(
-            n_buffer         = singleton.shmem_n_buffer,
-            image_dimensions = singleton.shmem_image_dimensions,
+            n_buffer         = self.shmem_n_buffer,
+            image_dimensions = self.shmem_image_dimensions,
             shmem_name       = self.shmem_name
             )
-        self.mvision_process.setMasterProcess(self.mvision_master_process)
+        # there might be several master processes: pick the least loaded one.  Forks a new one if necessary
+        master_process = singleton.get_avail_master_process(self.mvision_process.master)
+        if master_process is None:
+            print(self.pre, "activate : no master process available for", self.mvision_process.master)
+            return
+        self.mvision_process.setMasterProcess(master_process)
 
 
-    def close(self):
-        super().close()
-        self.clearMasterProcess()
-        
+    def deactivate(self):
+        master_process = self.mvision_process.master_process
+        super().deactivate() # detaches the client process from its master process
+        singleton.release_master_process(master_process)
+
 
 
 class MyGui(QtWidgets.QMainWindow):
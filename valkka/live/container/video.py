@@ -76,6 +76,7 @@ class VideoContainer:
     class Signals(QtCore.QObject):
         close = Signal(object)
         drop  = Signal(object)
+        resize = Signal(object) # (width, height)
         left_double_click  = Signal()
         right_double_click = Signal()
         
@@ -141,6 +142,10 @@ class VideoContainer:
         def setDevice(self, device):
             self.device = device
 
+        def resizeEvent(self, e):
+            self.signals.resize.emit((e.size().width(), e.size().height()))
+            super().resizeEvent(e)
+
         def dragEnterEvent(self, e):
             print("VideoWidget: dragEnterEvent")
             e.accept()
@@ -229,6 +234,8 @@ class VideoContainer:
             self.mouse_click_ctx.atReleaseEvent(e)
             super().mouseReleaseEvent(e)
 
+    resize_delay = 500 # milliseconds.  See resize_slot
+
     parameter_defs = {
         "parent_container"  : None,                 # RootVideoContainer or child class
         "filterchain_group" : None,                 # Instance of FilterChainGroup.  Filterchain manager class.  # None for debugging
@@ -265,6 +272,12 @@ class VideoContainer:
         self.filterchain = None
         self.viewport = ViewPort() # viewport instance is used by ManagedFilterChain(s)
 
+        # switch between main & sub streams only once the video widget has stopped resizing
+        self.resize_timer = QtCore.QTimer()
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(self.resize_delay)
+        self.resize_timer.timeout.connect(self.resize_timeout_slot)
+
 
     def serialize(self):
         """Return a dict of parameters that the parent object needs to de-serialize & instantiate this object
@@ -305,6 +318,7 @@ class VideoContainer:
             QtWidgets.QSizePolicy.Expanding)
         
         self.video.signals.drop.connect(self.setDevice)
+        self.video.signals.resize.connect(self.resize_slot)
         
         # this VideoContainer was initialized with a device id, so we stream the video now
         if self.device_id > -1:
@@ -349,7 +363,7 @@ class VideoContainer:
         self.video.setDevice(self.device) # inform the video widget so it can start drags
         
         # ManagedFilterChain.addViewPort accepts ViewPort instance
-        self.filterchain = self.filterchain_group.get(_id = self.device._id)
+        self.filterchain = self.getFilterchain_()
         if self.filterchain:
             self.viewport.setXScreenNum(self.n_xscreen)
             self.viewport.setWindowId  (int(self.video.winId()))
@@ -359,6 +373,34 @@ class VideoContainer:
             ## for the object class look into valkka.live.onvif.group
 
 
+    def getFilterchain_(self):
+        """Filterchain for the viewport: main or sub stream, depending on the size of the video widget
+        """
+        if hasattr(self.filterchain_group, "getForViewport"): # a LiveFilterChainGroup
+            return self.filterchain_group.getForViewport(self.device._id, self.video.width(), self.video.height())
+        return self.filterchain_group.get(_id = self.device._id)
+
+
+    def resize_slot(self, size):
+        """Video widget was resized: switch between main & sub streams if needed, but only after resize_delay milliseconds without further resizing.  Otherwise dragging a splitter across the size limit would switch the streams back and forth
+        """
+        if not self.filterchain:
+            return
+        self.resize_timer.start() # restarts the timer if it's running
+
+
+    def resize_timeout_slot(self):
+        if not self.filterchain: # the device might have been cleared meanwhile
+            return
+        filterchain = self.getFilterchain_()
+        if (filterchain is None) or (filterchain is self.filterchain):
+            return
+        print(self.pre, "resize_timeout_slot : switching to slot", filterchain.slot)
+        self.filterchain.delViewPort(self.viewport)
+        self.filterchain = filterchain
+        self.filterchain.addViewPort(self.viewport)
+
+
     def setDeviceById(self, _id):
         """Set the video to this VideoContainer by stream id only
         """
@@ -370,6 +412,17 @@ class VideoContainer:
             return
         else:
             self.setDevice(device)
+
+
+    def refreshDevice(self):
+        """The device parameters were modified, but the stream stays the same: update the device object
+        """
+        if not self.device:
+            return
+        device = singleton.devices_by_id.get(self.device._id)
+        if device is not None:
+            self.device = device
+            self.video.setDevice(self.device)
         
         
     def clearDevice(self):
@@ -72,7 +72,7 @@ class RTSPCameraDevice:
         if (len(self.tail)>0):
             st += "/" + self.tail 
         if (len(self.subaddress_sub)>0):
-            st += "/" + self.subaddress_main
+            st += "/" + self.subaddress_sub
         return st
 
     def getForceTCP(self):
@@ -22,8 +22,10 @@ You should have received a copy of the GNU Affero General Public License along w
 
 from valkka.live.qimport import QtWidgets, QtCore, QtGui, Signal, Slot # Qt5
 import sys
+import copy
 from valkka.live.gpuhandler import GPUHandler
 from valkka.live import constant, singleton
+from valkka.live.tools import PhaseTimer
 # from valkka.api2.chains import ManagedFilterchain, LiveManagedFilterchain, USBManagedFilterchain
 from valkka.live.chain.multifork import MultiForkFilterchain, ContextType, RecordType
 from valkka.live.chain.playback import PlaybackFilterchain
@@ -66,13 +68,22 @@ class FilterChainGroup:
         
         
     def reset(self):
+        self.requestClose()
+        self.waitClose()
+
+
+    def requestClose(self):
         # start closing all threads simultaneously
         for chain in self.chains:
             chain.requestClose()
+
+
+    def waitClose(self):
         # wait until all threads closed
         for chain in self.chains:
             chain.waitClose()
         self.chains = []
+        self.rows = {}
 
 
     def get(self, **kwargs):
@@ -133,6 +144,9 @@ class LiveFilterChainGroup(FilterChainGroup):
         parameterInitCheck(LiveFilterChainGroup.parameter_defs, kwargs, self)
         self.pre = self.__class__.__name__ + " : "
         self.chains = []
+        self.sub_chains = {} # filterchains for the sub streams, by _id.  Created on-demand: see getSub
+        self.rows = {} # database rows the filterchains were created from, by _id
+        self.timer = None # PhaseTimer of the latest bring-up
         self.context_type = None
         self.closed = False
         if self.vaapi:
@@ -141,11 +155,67 @@ class LiveFilterChainGroup(FilterChainGroup):
     
     def read(self):
         """Reads all devices from the database and creates filterchains
-        
-        TODO: we can, of course, just modify the added / removed cameras
         """
         self.reset()
+        self.readConfig_()
+        rows = self.readRows_()
+        # important .. otherwise chains will go out of context and get garbage collected
+        self.chains = self.makeChains_(list(rows.values()))
+        self.rows = rows
+        print(self.pre, self.timer)
+
+
+    def requestClose(self):
+        super().requestClose()
+        for chain in self.sub_chains.values():
+            chain.requestClose()
+
+
+    def waitClose(self):
+        for chain in self.sub_chains.values():
+            chain.waitClose()
+        self.sub_chains = {}
+        super().waitClose()
+
+
+    def getSub(self, _id):
+        """The sub stream filterchain of a device, or None if the device has no sub stream
+
+        The filterchain (and the connection to the sub stream) is created at the first call, so that cameras whose sub stream is never used are connected only once
+        """
+        try:
+            return self.sub_chains[_id]
+        except KeyError:
+            pass
+        dic = self.rows.get(_id)
+        if (dic is None) or (not self.hasSub_(dic)):
+            return None
+        if (self.verbose): print(self.pre, "getSub : creating sub stream filterchain for", _id)
+        chain = self.makeChain_(dic, sub = True)
+        self.sub_chains[_id] = chain
+        return chain
+
+
+    def getForViewport(self, _id, width, height):
+        """Filterchain for a viewport of this size (in pixels).  Small viewports get the sub stream, if the device has one (see singleton.sub_stream_max_width)
+        """
+        if (width <= singleton.sub_stream_max_width) and (height <= singleton.sub_stream_max_width):
+            sub = self.getSub(_id)
+            if sub is not None:
+                return sub
+        return self.get(_id = _id)
 
+
+    def getForAnalyzer(self, _id):
+        """Filterchain that feeds the analyzers: the images are downscaled anyway, so use the sub stream if the device has one
+        """
+        sub = self.getSub(_id)
+        if sub is not None:
+            return sub
+        return self.get(_id = _id)
+
+
+    def readConfig_(self):
         # take some stuff from the general config
         config = next(self.datamodel.config_collection.get())
         if config["overwrite_timestamps"]:
@@ -153,133 +223,225 @@ class LiveFilterChainGroup(FilterChainGroup):
         else:
             self.time_correction = core.TimeCorrectionType_smart
 
+
+    def readRows_(self):
+        """Camera rows that need a filterchain, by _id
+        """
+        rows = {}
         for dic in self.datamodel.camera_collection.get(): # TODO: search directly for RTSPCameraRow
-            if (self.verbose): print(self.pre, "read : dic", dic)
-            affinity = -1
-            if self.cpu_scheme is not None:
-                affinity = self.cpu_scheme.getAV()
-            classname = dic.pop("classname")
+            if (self.verbose): print(self.pre, "readRows_ : dic", dic)
+            if dic["classname"] in [RTSPCameraRow.__name__, USBCameraRow.__name__, SDPFileRow.__name__]:
+                rows[dic["_id"]] = dic
+            else:
+                print(self.pre, "no context for classname", dic["classname"])
+        return rows
 
-            if classname == RTSPCameraRow.__name__:            
-                device = RTSPCameraDevice(**dic) # a neat object with useful methods
-                self.context_type = ContextType.live
 
-            elif classname == USBCameraRow.__name__:
-                device = USBCameraDevice(**dic) # a neat object with useful methods
-                self.context_type = ContextType.usb
+    def getDevice_(self, dic):
+        """Database row to (device, context type)
+        """
+        dic = copy.copy(dic)
+        classname = dic.pop("classname")
+        if classname == RTSPCameraRow.__name__:            
+            return RTSPCameraDevice(**dic), ContextType.live # a neat object with useful methods
+        elif classname == USBCameraRow.__name__:
+            return USBCameraDevice(**dic), ContextType.usb
+        else:
+            return SDPFileDevice(**dic), ContextType.live
 
-            elif classname == SDPFileRow.__name__:            
-                device = SDPFileDevice(**dic) # a neat object with useful methods
-                self.context_type = ContextType.live
 
-            else:
-                print(self.pre, "no context for classname", classname)
-                continue
+    def chainPars_(self, dic):
+        """The parameters of a database row that affect its filterchain.  Divided into the ones that need a new filterchain & the ones that can be changed on-the-fly (see MultiForkFilterchain.reconfigure)
+        """
+        device, context_type = self.getDevice_(dic)
+        reconf = {
+            "address"           : device.getMainAddress(),
+            "request_tcp"       : (dic["classname"] == RTSPCameraRow.__name__) and device.getForceTCP(),
+            "time_correction"   : self.time_correction
+            }
+        if self.hasSub_(dic):
+            sub_reconf = copy.copy(reconf)
+            sub_reconf["address"] = device.getSubAddress()
+        else:
+            sub_reconf = None
+        fixed = (dic["classname"], device.getLiveMainSlot(), sub_reconf is not None)
+        return fixed, reconf, sub_reconf
 
-            # chain = ManagedFilterchain( # decoding and branching the stream happens here
-            # chain = ManagedFilterchain2( # decoding and branching the stream happens here
-            # chain = LiveManagedFilterchain( # decoding and branching the stream happens here
-            chain = MultiForkFilterchain( # decoding and branching the stream happens here
-                context_type = self.context_type,
-                livethread  = self.livethread,
-                usbdevicethread  = self.usbthread,
-                openglthreads
-                            = self.gpu_handler.openglthreads,
-                address     = device.getMainAddress(),
-                slot        = device.getLiveMainSlot(),
-                # request_tcp = device.getForceTCP(),
-                ## ..that one not here
-                ## MultiForkFilterChain is "universal" for all types
-                ## of inputs (rtsp, usb & sdp files)
-                ## however, requesting tcp streaming instead of udp
-                ## is just for RTSP cameras
-                _id         = device._id,
-                affinity    = affinity,
-                msreconnect = 10000,
-                # verbose     = True,
-                verbose      = False,
-                vaapi        = self.vaapi,
-                
-                time_correction = self.time_correction, # overwrite timestamps or not?
-
-                shmem_image_dimensions = singleton.shmem_image_dimensions,
-                shmem_n_buffer = singleton.shmem_n_buffer,
-                shmem_image_interval = singleton.shmem_image_interval
-            )
 
-            if classname == RTSPCameraRow.__name__:
-                """RTSP cameras specific configurations here
-                """
-                if (device.getForceTCP()):
-                    chain.setTCPStreaming(True)
+    def hasSub_(self, dic):
+        return (dic["classname"] == RTSPCameraRow.__name__) and dic.get("live_sub", False)
 
-            self.chains.append(chain) # important .. otherwise chain will go out of context and get garbage collected
-    
 
-    def update(self):
-        """Reads all devices from the database.  Creates new filterchains and removes old ones
-        
-        TODO: currently this is broken: if user changes any other field than the ip address, the cameras don't get updated
+    def makeChains_(self, dics):
+        """Creates main stream filterchains for a list of database rows in one go: first all filterchains are constructed, then all decoding threads are started and finally all streams are registered.  Sets self.timer
+
+        Returns a list of filterchains.  The sub stream filterchains are created on-demand (see getSub)
         """
-        raise(AssertionError("out of date"))
-        
-        new_ids = []
-        old_ids = []
-        
-        # collect old ip addresses
-        for chain in self.chains:
-            if (self.verbose): print(self.pre, "old :", chain, chain.get__id(), chain.get_address(), chain._id)
-            old_ids.append(chain.get__id())
-            
-        # collect devices
-        devices = []
-        for dic in self.datamodel.camera_collection.get():
-            if (self.verbose): print(self.pre, "update : dic", dic)
-            if (dic["classname"] == RTSPCameraRow.__name__):
-                devices.append(dic)
+        self.timer = PhaseTimer("filterchains (%i)" % (len(dics)))
+        self.timer.phase("construct")
+        chains = [self.makeChain_(dic, autostart = False) for dic in dics]
+        self.timer.phase("start threads")
+        for chain in chains:
+            chain.start()
+        self.timer.phase("register streams")
+        for chain in chains:
+            chain.createContext()
+        self.timer.stop()
+        return chains
+
+
+    def makeChain_(self, dic, autostart = True, sub = False):
+        """Filterchain for the main stream of a device, or for the sub stream if sub = True
+        """
+        affinity = -1
+        if self.cpu_scheme is not None:
+            affinity = self.cpu_scheme.getAV()
+        device, self.context_type = self.getDevice_(dic)
+        if sub:
+            address, slot = device.getSubAddress(), device.getLiveSubSlot()
+        else:
+            address, slot = device.getMainAddress(), device.getLiveMainSlot()
+
+        # chain = ManagedFilterchain( # decoding and branching the stream happens here
+        # chain = ManagedFilterchain2( # decoding and branching the stream happens here
+        # chain = LiveManagedFilterchain( # decoding and branching the stream happens here
+        chain = MultiForkFilterchain( # decoding and branching the stream happens here
+            context_type = self.context_type,
+            livethread  = self.livethread,
+            usbdevicethread  = self.usbthread,
+            openglthreads
+                        = self.gpu_handler.openglthreads,
+            address     = address,
+            slot        = slot,
+            # request_tcp = device.getForceTCP(),
+            ## ..that one not here
+            ## MultiForkFilterChain is "universal" for all types
+            ## of inputs (rtsp, usb & sdp files)
+            ## however, requesting tcp streaming instead of udp
+            ## is just for RTSP cameras
+            _id         = device._id,
+            affinity    = affinity,
+            msreconnect = 10000,
+            # verbose     = True,
+            verbose      = False,
+            vaapi        = self.vaapi,
+            autostart    = autostart,
+            decoding_linger = float(singleton.decoding_linger),
             
-        devices_by_id={}
-        for dic in devices: # RTSPCameraRow instances
-            _id = dic["_id"]
-            new_ids.append(_id)
-            devices_by_id[_id] = dic
-        
-        if (self.verbose):
-            print(self.pre, "update : new_ids =", new_ids)
-            print(self.pre, "update : old_ids =", old_ids)
-        
-        add_list = list(set(new_ids).difference(set(old_ids))) # cams to be added
-        rem_list = list(set(old_ids).difference(set(new_ids))) # cams to be removed
-        
+            time_correction = self.time_correction, # overwrite timestamps or not?
+
+            shmem_image_dimensions = singleton.shmem_image_dimensions,
+            shmem_n_buffer = singleton.shmem_n_buffer,
+            shmem_image_interval = singleton.shmem_image_interval
+        )
+
+        if dic["classname"] == RTSPCameraRow.__name__:
+            """RTSP cameras specific configurations here
+            """
+            if (device.getForceTCP()):
+                chain.setTCPStreaming(True)
+
+        return chain
+
+
+    def getDecodingStats(self):
+        """Decoding statistics of all filterchains, by _id (sub streams by (_id, "sub")).  See MultiForkFilterchain.getDecodingStats
+        """
+        stats = dict((chain._id, chain.getDecodingStats()) for chain in self.chains)
+        stats.update(((_id, "sub"), chain.getDecodingStats()) for _id, chain in self.sub_chains.items())
+        return stats
+
+
+    def diff(self):
+        """Compares the filterchains against the database.  Returns a dictionary with lists of _ids:
+
+        ::
+
+            added           : new devices
+            removed         : devices that were removed
+            reconfigured    : stream parameters changed (address, tcp, etc.).  The filterchain is reconfigured on-the-fly
+            rebuilt         : slot number, device type or use of the sub stream changed.  The filterchains are replaced by new ones
+            modified        : other fields changed (say, recording).  Nothing to do for the filterchain
+            rows            : (not a list) the database rows by _id
+
+        Unchanged devices are not listed
+        """
+        self.readConfig_()
+        rows = self.readRows_()
+        old_ids = set(self.rows.keys())
+        new_ids = set(rows.keys())
+        dic = {
+            "added"         : sorted(new_ids.difference(old_ids)),
+            "removed"       : sorted(old_ids.difference(new_ids)),
+            "reconfigured"  : [],
+            "rebuilt"       : [],
+            "modified"      : [],
+            "rows"          : rows
+            }
+        for _id in sorted(new_ids.intersection(old_ids)):
+            fixed, reconf, sub_reconf = self.chainPars_(rows[_id])
+            fixed_, reconf_, sub_reconf_ = self.chainPars_(self.rows[_id])
+            if fixed != fixed_:
+                dic["rebuilt"].append(_id)
+            elif reconf != reconf_ or sub_reconf != sub_reconf_ or reconf["time_correction"] != getattr(self.get(_id = _id), "time_correction", None):
+                dic["reconfigured"].append(_id)
+            elif rows[_id] != self.rows[_id]:
+                dic["modified"].append(_id)
         if (self.verbose):
-            print(self.pre, "update : add_list =", add_list)
-            print(self.pre, "update : rem_list =", rem_list)
-        
-        # purge removed chains
-        for i, chain in enumerate(self.chains):
-            if (chain.get__id() in rem_list):
-                chain_ = self.chains.pop(i)
-                if (self.verbose): print(self.pre, "closing chain", chain_)
-                chain_.close()
-        
-        # add new chains
-        for new_address in add_list:
-            dic = devices_by_id[new_address]
-            chain = ManagedFilterchain( # decoding and branching the stream happens here
-                livethread  = self.livethread,
-                openglthreads
-                            = self.gpu_handler.openglthreads,
-                address     = RTSPCameraRow.getMainAddressFromDict(dic),
-                slot        = dic["slot"],
-                _id         = dic["_id"],
-                # affinity    = a,
-                msreconnect = 10000,
-                verbose = True
-            )
-            if (self.verbose): print(self.pre, "adding chain", chain)
-            self.chains.append(chain) # important .. otherwise chain will go out of context and get garbage collected
+            print(self.pre, "diff :", dict((key, value) for key, value in dic.items() if key != "rows"))
+        return dic
 
-        # TODO: purge the views from removed cameras    
+
+    def update(self, diff = None):
+        """Reads all devices from the database.  Creates new filterchains, removes old ones & reconfigures the modified ones.  Filterchains of the unchanged devices are not touched
+
+        :param diff:    Result of self.diff().  Default: None (call it now)
+
+        Returns the diff dictionary
+
+        Viewports & shmem terminals of the reconfigured filterchains are kept.  The ones of the removed & rebuilt filterchains are lost: detach them before calling this method, i.e.
+
+        ::
+
+            diff = filterchain_group.diff()
+            # clear the containers showing devices in diff["removed"] & diff["rebuilt"]
+            filterchain_group.update(diff)
+            # set the devices in diff["rebuilt"] back to their containers
+        """
+        if diff is None:
+            diff = self.diff()
+        rows = diff["rows"]
+
+        # close the removed & rebuilt chains: deregister the streams & start closing the threads simultaneously
+        closing = []
+        for _id in diff["removed"] + diff["rebuilt"]:
+            chain = self.get(_id = _id)
+            if chain is not None:
+                self.chains.remove(chain)
+                closing.append(chain)
+            if _id in self.sub_chains:
+                closing.append(self.sub_chains.pop(_id))
+        for chain in closing:
+            if (self.verbose): print(self.pre, "update : closing chain", chain)
+            chain.closeContext()
+            chain.requestClose()
+        for chain in closing:
+            chain.waitClose()
+
+        for _id in diff["reconfigured"]:
+            fixed, reconf, sub_reconf = self.chainPars_(rows[_id])
+            if (self.verbose): print(self.pre, "update : reconfiguring", _id, fixed)
+            self.get(_id = _id).reconfigure(**reconf)
+            if (sub_reconf is not None) and (_id in self.sub_chains):
+                self.sub_chains[_id].reconfigure(**sub_reconf)
+
+        chains = self.makeChains_([rows[_id] for _id in diff["added"] + diff["rebuilt"]])
+        if (self.verbose): print(self.pre, "update : added chains", chains)
+        # important .. otherwise chains will go out of context and get garbage collected
+        self.chains += chains
+
+        self.rows = rows
+        return diff
             
                     
     def getDevice(self, **kwargs): 
@@ -535,8 +697,13 @@ def test1():
         )
     
     
-    filterchain_group = FilterChainGroup(datamodel = dm, livethread = livethread, gpu_handler = gpu_handler, verbose = True)
-    filterchain_group.update()
+    usbthread = USBDeviceThread(
+        name = "usb_thread",
+        verbose = False
+        )
+
+    filterchain_group = LiveFilterChainGroup(datamodel = dm, livethread = livethread, usbthread = usbthread, gpu_handler = gpu_handler, verbose = True)
+    filterchain_group.read()
     
     print("\n ADDING ONE \n")
     
@@ -549,24 +716,30 @@ def test1():
             )
     
     filterchain_group.update()
+
+    print("\n CHANGING ADDRESS OF ONE \n")
+
+    entry = next(collection.get({"address":"192.168.1.42"}))
+    collection.update(entry["_id"], {"address": "192.168.1.44"})
+
+    diff = filterchain_group.update()
+    assert(diff["reconfigured"] == [entry["_id"]])
     
     print("\n REMOVING ONE \n")
     
     entry = next(collection.get({"address":"192.168.1.41"}))
     collection.delete(entry["_id"])
     
-    filterchain_group.update()
+    diff = filterchain_group.update()
+    assert(diff["removed"] == [entry["_id"]])
     
     print("\n BYE \n")
     
     filterchain_group.close()
+    livethread.close()
+    usbthread.close()
+    gpu_handler.close()
     
     
 if (__name__=="__main__"):
     test1()
-    
-    
-    
- 
- 
- 
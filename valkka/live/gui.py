@@ -69,7 +69,7 @@ from valkka.live.cpu import CPUScheme
 from valkka.live.quickmenu import QuickMenu, QuickMenuElement
 from valkka.live.qt.playback import PlaybackController
 from valkka.live.qt.tools import QCapsulate, QTabCapsulate, getCorrectedGeom
-from valkka.live.tools import nameToClass, classToName
+from valkka.live.tools import nameToClass, classToName, PhaseTimer
 
 from valkka.live.datamodel.base import DataModel
 from valkka.live.datamodel.row import RTSPCameraRow, EmptyRow, USBCameraRow, SDPFileRow, MemoryConfigRow, ValkkaFSConfigRow
@@ -84,6 +84,7 @@ from valkka.live.filterchain import LiveFilterChainGroup, PlaybackFilterChainGro
 from valkka.live.chain.multifork import RecordType
 
 from valkka.live.fs import ValkkaSingleFSHandler
+from valkka.live.multiprocess import QFrontDispatcher, ProcessPool, Supervisor
 
 pre = "valkka.live :"
 
@@ -186,6 +187,7 @@ class MyGui(QtWidgets.QMainWindow):
         self.valkkafs = None # NEW: list of valkkafs'
 
         self.config_modified = False # should valkka services be restarted?
+        self.cameras_modified = False # should filterchains be updated?
         self.valkkafs_modified = False # remove recorded streams?
 
 
@@ -311,7 +313,7 @@ class MyGui(QtWidgets.QMainWindow):
         self.manage_memory_container = singleton.data_model.getConfigForm()
 
         self.manage_memory_container.signals.save.connect(self.config_modified_slot)
-        self.manage_cameras_container.getForm().signals.save_record.connect(self.config_modified_slot)
+        self.manage_cameras_container.getForm().signals.save_record.connect(self.cameras_modified_slot)
 
         tabs = [ 
                     (self.manage_cameras_container. widget, "Camera Configuration"),
@@ -672,57 +674,107 @@ class MyGui(QtWidgets.QMainWindow):
     # *** Multiprocess handling ***
 
     def startProcesses(self):
-        """Create and start python multiprocesses
+        """Create python multiprocess pools & start the prewarm multiprocesses
         
         Starting a multiprocess creates a process fork.
         
         In theory, there should be no problem in first starting the multithreading environment and after that perform forks (only the thread requestin the fork is copied), but in practice, all kinds of weird behaviour arises.
         
         Read all about it in here : http://www.linuxprogrammingblog.com/threads-and-fork-think-twice-before-using-them
-        """
-        singleton.process_map = {} # each key is a list of started multiprocesses
-        # self.process_avail = {} # count instances
 
+        Only the prewarm count of multiprocesses (singleton.mvision_prewarm) is forked here, the rest are forked on demand by the ProcessPool instances.  This is safe only if valkka.live.multiprocess.startForkServer was called at the beginning of the program (as in valkka.live.main): then the multiprocesses are forked from the single-threaded forkserver instead of this process
+        """
+        singleton.process_map = {} # each key is a ProcessPool
         singleton.client_process_map = {}
         singleton.master_process_map = {}
+
+        # a single thread that reads the messages from all multiprocesses & turns them into Qt signals
+        self.front_dispatcher = QFrontDispatcher()
+        # respawns crashed multiprocesses
+        self.supervisor = Supervisor()
         
         def span(mvision_classes: list, process_map: dict):
             for mvision_class in mvision_classes:
                 name = mvision_class.name
                 tag  = mvision_class.tag
-                num  = mvision_class.max_instances
                 if (tag not in process_map):
-                    process_map[tag] = []
-                    # self.process_avail[tag] = num
-                    for n in range(0, num):
-                        print("startProcesses: spanning", tag, n)
-                        # verbose = True
-                        verbose = singleton.mvision_verbose
-                        p = mvision_class(verbose = verbose)
-                        # p.start()
-                        p.go()
-                        process_map[tag].append(p)
+                    if hasattr(mvision_class, "prewarm"):
+                        prewarm = mvision_class.prewarm
+                    else:
+                        prewarm = singleton.mvision_prewarm
+                    process_map[tag] = ProcessPool(
+                        mvision_class,
+                        max_instances       = mvision_class.max_instances,
+                        prewarm             = prewarm,
+                        idle_timeout        = singleton.mvision_idle_timeout,
+                        front_dispatcher    = self.front_dispatcher,
+                        supervisor          = self.supervisor,
+                        kwargs              = {"verbose": singleton.mvision_verbose}
+                        )
+                    print("startProcesses: spanning", tag, prewarm)
+                    process_map[tag].prewarm()
             
         span(self.mvision_classes, singleton.process_map)
         span(self.mvision_client_classes, singleton.client_process_map)
         span(self.mvision_master_classes, singleton.master_process_map)
+        # start the thread only after all forks have been done
+        self.front_dispatcher.start()
+        self.supervisor.start()
+
+        # stop multiprocesses that have been idle for too long
+        self.reap_timer = QtCore.QTimer()
+        self.reap_timer.setInterval(10000)
+        self.reap_timer.timeout.connect(self.reapProcesses)
+        self.reap_timer.start()
+
+        # move client processes away from saturated master processes
+        self.balance_timer = QtCore.QTimer()
+        self.balance_timer.setInterval(5000)
+        self.balance_timer.timeout.connect(self.balanceProcesses)
+        self.balance_timer.start()
+
+
+    def reapProcesses(self):
+        for process_map in [singleton.process_map, singleton.client_process_map, singleton.master_process_map]:
+            for pool in process_map.values():
+                pool.reap()
+
+
+    def balanceProcesses(self):
+        """Migrate one client process per tick from each saturated master process to a less loaded one
+
+        Clients are moved only between running master processes: new master processes are forked only when clients are attached (see MVisionClientContainer.activate).  The containers follow the migration, since they use client.master_process
+        """
+        migrated = []
+        for pool in singleton.client_process_map.values():
+            for client in pool.busy:
+                master = client.master_process
+                if (master is None) or (master in migrated) or (not master.saturated()):
+                    continue
+                new_master = singleton.get_avail_master_process(master.tag, exclude = master, fork = False)
+                if (new_master is None) or new_master.saturated():
+                    continue
+                print("balanceProcesses: migrating", client, "from", master, "to", new_master)
+                client.migrateMasterProcess(new_master)
+                singleton.release_master_process(master)
+                migrated.append(master)
         
         
     def closeProcesses(self):
         #print("closeProcesses: client map", singleton.client_process_map)
         #print("closeProcesses: master map", singleton.master_process_map)
+        self.reap_timer.stop()
+        self.balance_timer.stop()
+        self.supervisor.stop()
 
         def stop(process_map):
             for key in process_map:
-                for p in process_map[key]:
-                    # print("closeProcesses: stop:", p)
-                    # p.stop()
-                    p.requestStop()
+                # print("closeProcesses: stop:", process_map[key])
+                process_map[key].requestStop()
 
         def wait(process_map):
             for key in process_map:
-                for p in process_map[key]:
-                    p.waitStop()
+                process_map[key].waitStop()
 
         stop(singleton.process_map)
         stop(singleton.client_process_map)
@@ -732,10 +784,14 @@ class MyGui(QtWidgets.QMainWindow):
         wait(singleton.client_process_map)
         wait(singleton.master_process_map)
 
+        self.front_dispatcher.stop()
+
         
     # *** Valkka ***
         
     def openValkka(self):
+        timer = PhaseTimer("gui: openValkka")
+        timer.phase("config")
         self.cpu_scheme = CPUScheme()
         
         # singleton.data_model.camera_collection
@@ -760,6 +816,7 @@ class MyGui(QtWidgets.QMainWindow):
         else:
             self.cpu_scheme = CPUScheme(n_cores = -1)
 
+        timer.phase("OpenGLThreads")
         self.gpu_handler = GPUHandler(
             n_720p  = memory_config["n_720p"] * n_frames, # n_cameras * n_frames
             n_1080p = memory_config["n_1080p"] * n_frames,
@@ -770,6 +827,7 @@ class MyGui(QtWidgets.QMainWindow):
             cpu_scheme = self.cpu_scheme
         )
 
+        timer.phase("live & usb threads")
         self.livethread = LiveThread(
             name = "live_thread",
             verbose = False,
@@ -788,6 +846,7 @@ class MyGui(QtWidgets.QMainWindow):
         #fs_flavor = valkkafs_config["fs_flavor"] 
         #record    = valkkafs_config["record"]
     
+        timer.phase("filterchains")
         self.filterchain_group = LiveFilterChainGroup(
             datamodel     = singleton.data_model, 
             livethread    = self.livethread, 
@@ -799,6 +858,7 @@ class MyGui(QtWidgets.QMainWindow):
 
         # TODO: RecordType..?
         if singleton.use_playback:
+            timer.phase("ValkkaFS")
             print("openValkka: ValkkaFS **PLAYBACK & RECORDING ACTIVATED**")
             # ValkkaSingleFSHandler: 
             # directory handling and valkkafs <-> stream id association
@@ -878,32 +938,49 @@ class MyGui(QtWidgets.QMainWindow):
                 valkkafs_manager = self.valkkafsmanager
             )
 
+        timer.stop()
+        print(timer)
+
                 
     def closeValkka(self):
         # live => chain => opengl
         #self.livethread.close()
         # self.usbthread.close()
+        timer = PhaseTimer("gui: closeValkka")
 
-        print("Closing live & usb threads")
-        # close filterchains from beginning-to-end => threads first
+        stats = self.filterchain_group.getDecodingStats().values()
+        print("gui: closeValkka: decoder switched on %i times, restarts saved by lingering %i times" %
+            (sum(st["on"] for st in stats), sum(st["kept"] for st in stats)))
+
+        timer.phase("live, usb & decoding threads")
+        print("Closing live & usb threads and filterchains")
+        # request all threads feeding frames to close simultaneously ..
         self.livethread.requestClose()
         self.usbthread.requestClose()
+        self.filterchain_group.requestClose()
+        if singleton.use_playback:
+            self.filterchain_group_play.requestClose()
+        # .. and only then wait for them
         self.livethread.waitClose()
         self.usbthread.waitClose()
-        
-        print("Closing filterchains")
+        self.filterchain_group.waitClose()
         self.filterchain_group.close()
         if singleton.use_playback:
+            self.filterchain_group_play.waitClose()
             self.filterchain_group_play.close()
 
+        timer.phase("OpenGLThreads")
         print("Closing OpenGLThreads")
         self.gpu_handler.close()
 
-        print("Closing ValkkaFS threads")
         if singleton.use_playback:
+            timer.phase("ValkkaFS")
+            print("Closing ValkkaFS threads")
             self.playback_controller.close()
             self.valkkafsmanager.close()
         
+        timer.stop()
+        print(timer)
         # print("Closing multiprocessing frontend")
         """
         if singleton.thread:
@@ -912,15 +989,45 @@ class MyGui(QtWidgets.QMainWindow):
 
     def reOpenValkka(self):
         print("gui: valkka reinit")
+        timer = PhaseTimer("gui: reOpenValkka")
         self.wait_window.show()
+        timer.phase("close")
         self.saveWindowLayout() # overwrites the layout
         self.closeContainers()
         self.closeValkka()
+        timer.phase("open")
         self.openValkka()
         self.loadWindowLayout()
+        timer.stop()
+        print(timer)
         self.wait_window.hide()
 
 
+    def updateValkka(self):
+        """Apply the camera configuration to the running filterchains.  Only the streams of the modified cameras are touched
+        """
+        if singleton.use_playback: # valkkafs is mapped to the live filterchains in openValkka
+            self.reOpenValkka()
+            return
+        print("gui: valkka update")
+        singleton.reCacheDevicesById()
+        diff = self.filterchain_group.diff()
+        detach = diff["removed"] + diff["rebuilt"]
+        detached = [] # (container, _id)
+        for container in self.containers_grid:
+            for child in container.children:
+                _id = child.getDeviceId()
+                if _id in detach: # release the viewports & shmem terminals of the chains that are going away
+                    child.clearDevice()
+                    detached.append((child, _id))
+                elif (_id in diff["reconfigured"]) or (_id in diff["modified"]):
+                    child.refreshDevice()
+        self.filterchain_group.update(diff)
+        for child, _id in detached:
+            if _id in diff["rebuilt"]: # .. and attach them to the new chains
+                child.setDeviceById(_id)
+
+
     def startThreads(self):
         print(">startThreads")
         if singleton.start_www:
@@ -997,7 +1104,13 @@ class MyGui(QtWidgets.QMainWindow):
             return
         def slot_func():
             # print(">process_map", singleton.process_map)
-            if ( (cl.tag in singleton.process_map) and (len(singleton.process_map[cl.tag])>0) ):
+            if (cl.tag not in singleton.process_map):
+                available = False
+            elif cl.max_streams > 1: # multi-stream analyzer
+                available = singleton.process_map[cl.tag].availableShared()
+            else:
+                available = singleton.process_map[cl.tag].available()
+            if available:
                 cont = container.VideoContainerNxM(
                     parent            = None,
                     gpu_handler       = self.gpu_handler,
@@ -1022,9 +1135,9 @@ class MyGui(QtWidgets.QMainWindow):
             return
         def slot_func():
             # print(">process_map", singleton.process_map)
-            if ( (cl.tag in singleton.client_process_map) and len(singleton.client_process_map[cl.tag]) > 0 ):
+            if ( (cl.tag in singleton.client_process_map) and singleton.client_process_map[cl.tag].available() ):
                 master_tag = cl.master
-                if singleton.get_avail_master_process(master_tag) is not None:
+                if singleton.avail_master_process(master_tag):
                     cont = container.VideoContainerNxM(
                         parent            = None,
                         gpu_handler       = self.gpu_handler,
@@ -1079,12 +1192,16 @@ class MyGui(QtWidgets.QMainWindow):
 
     def config_dialog_slot(self):
         self.config_modified = False
+        self.cameras_modified = False
         self.valkkafs_modified = False
         self.config_win.show()
         self.manage_cameras_container.choose_first_slot()
         
     def config_modified_slot(self):
         self.config_modified = True # restart valkka services
+
+    def cameras_modified_slot(self):
+        self.cameras_modified = True # update filterchains
         
     def valkkafs_modified_slot(self):
         self.config_modified = True # restart valkka services
@@ -1097,6 +1214,9 @@ class MyGui(QtWidgets.QMainWindow):
         if (self.config_modified):
             self.updateCameraTree()
             self.reOpenValkka()
+        elif (self.cameras_modified):
+            self.updateCameraTree()
+            self.updateValkka()
     
     def save_window_layout_slot(self):
         self.saveWindowLayout()
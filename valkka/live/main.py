@@ -29,6 +29,7 @@ from setproctitle import setproctitle
 from valkka.live.tools import getLogger
 from valkka.live.local import ValkkaLocalDir
 from valkka.live import singleton
+from valkka.live.multiprocess import startForkServer
 try:
     from valkka import web
 except Exception as e:
@@ -86,6 +87,9 @@ def process_cl_args():
     parser.add_argument("--vaapi", action="store", type=str2bool, default=False, 
         help="use VAAPI hw acceleration")
 
+    parser.add_argument("--linger", action="store", type=float, default=singleton.decoding_linger, 
+        help="keep decoding a stream this many seconds after it's not viewed or analyzed anymore.  0 = stop immediately")
+
     parser.add_argument("--www", action="store", type=str2bool, default=False, 
         help="starts the web- and websocket servers.  Before this, you need to install the www extras with 'pip3 install --user -e .[www]'")
 
@@ -97,6 +101,10 @@ def process_cl_args():
 
 
 def main():
+    # before any threads are running: mvision multiprocesses are launched from the forkserver,
+    # so that they can be started (and restarted) at any time
+    startForkServer(preload = singleton.mvision_package_names)
+
     parsed_args, unparsed_args = process_cl_args()
     
     #print(parsed_args, unparsed_args)
@@ -138,6 +146,8 @@ def main():
     if parsed_args.vaapi:
         singleton.vaapi = True
 
+    singleton.decoding_linger = parsed_args.linger
+
     # singleton.display = parsed_args.display
 
     from valkka.live.gui import MyGui as MyGuiBase
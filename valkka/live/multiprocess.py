@@ -20,18 +20,41 @@ You should have received a copy of the GNU Affero General Public License along w
 @brief   
 """
 
-from multiprocessing import Process, Pipe
+import multiprocessing
+from multiprocessing import Process, Pipe, forkserver, connection
 import select
 import errno
 import time
+import threading
 import sys
 import logging
 
 from valkka.live.qimport import QtWidgets, QtCore, QtGui, Signal, Slot
 from valkka.live.tools import getLogger, setLogger
+from valkka.live import codec
+from valkka.live import resources
 
 logger = getLogger(__name__)
 
+# modules imported by the forkserver, so that the new multiprocesses don't need to import them
+forkserver_preload = [
+    "valkka.live.multiprocess",
+    "valkka.mvision.multiprocess"
+]
+
+
+def startForkServer(preload = []):
+    """Launch all multiprocesses from a forkserver instead of forking the current process
+
+    :param preload: Additional modules to import in the forkserver (say, your machine vision packages), so that they're not imported again by each new multiprocess
+
+    Call this at the very beginning of your program, before any Qt or libValkka threads are running.  The forkserver is a single-threaded python process, so multiprocesses can be launched from there at any time.  Forking the (multithreaded) main process is avoided altogether
+    """
+    multiprocessing.set_start_method("forkserver", force = True)
+    multiprocessing.set_forkserver_preload(forkserver_preload + preload)
+    forkserver.ensure_running()
+    logger.debug("startForkServer: forkserver running with preload %s", forkserver_preload + preload)
+
 
 class MessageObject:
 
@@ -46,6 +69,30 @@ class MessageObject:
         return self.kwargs[key]
 
 
+def sendMessage(pipe, message: MessageObject, message_codec = codec.codec):
+    """Send a MessageObject (or None) through a pipe
+
+    If message_codec is None, the MessageObject is pickled (the old way).  Otherwise it is encoded into a compact binary message (see valkka.live.codec)
+    """
+    if message_codec is None:
+        pipe.send(message)
+    elif message is None:
+        pipe.send_bytes(message_codec.encode(None))
+    else:
+        pipe.send_bytes(message_codec.encode(message.command, message.kwargs))
+
+
+def recvMessage(pipe, message_codec = codec.codec):
+    """Inverse of sendMessage: returns a MessageObject or None
+    """
+    if message_codec is None:
+        return pipe.recv()
+    command, kwargs = message_codec.decode(pipe.recv_bytes())
+    if command is None:
+        return None
+    return MessageObject(command, **kwargs)
+
+
 
 def safe_select(l1, l2, l3, timeout = None):
     """
@@ -72,15 +119,119 @@ def safe_select(l1, l2, l3, timeout = None):
     # print("select : ?")
 
 
+class SignalRouter:
+    """Reads MessageObjects coming from a multiprocess & maps them into Qt signals
+
+    :param signals:         QObject having the Qt signals
+    :param pipe:            The pipe to read
+    :param message_codec:   Codec for decoding the messages.  None = messages are pickled
+    :param coalesce:        Use the coalescing mode or not.  Default: False
+    :param state_commands:  Commands that are coalesced
+    :param max_rate:        Maximum rate (per second) for emitting coalesced signals
+
+    In the coalescing mode:
+
+    - All pending messages are drained from the pipe at once
+    - For "state" style commands (e.g. "bboxes"), only the latest message per command is kept.  These are emitted at most max_rate times per second
+    - Other messages (events, like "start_move") are emitted immediately and in order
+
+    Used by QFrontThread (one pipe) and QFrontDispatcher (many pipes)
+    """
+
+    max_drain = 1000 # max number of messages drained at once from the pipe
+
+    def __init__(self, signals, pipe, message_codec = codec.codec, coalesce = False, state_commands = [], max_rate = 10.0):
+        self.pre = __name__ + "." + self.__class__.__name__
+        self.logger = getLogger(self.pre)
+        self.signals = signals
+        self.pipe = pipe
+        self.message_codec = message_codec
+        self.coalesce = coalesce
+        self.state_commands = set(state_commands)
+        self.min_interval = 1.0 / max_rate
+        self.pending = {} # latest "state" message, by command
+        self.t_emit = 0
+
+
+    def deadline(self):
+        """Time when the pending coalesced signals should be emitted.  None if there's nothing pending
+        """
+        if len(self.pending) < 1:
+            return None
+        return self.t_emit + self.min_interval
+
+
+    def drain(self):
+        """Read all messages available in the pipe.  Call only when the pipe is readable
+
+        Returns False if the multiprocess indicated that it's exiting (or the pipe broke)
+        """
+        for i in range(self.max_drain):
+            try:
+                obj = recvMessage(self.pipe, self.message_codec)
+            except EOFError as e:
+                self.logger.critical("reading from multiprocess failed: pipe closed")
+                return False
+            except Exception as e:
+                self.logger.critical("reading from multiprocess failed with %s", e)
+                return True
+            if obj is None:
+                return False
+            if self.coalesce and (obj.command in self.state_commands):
+                self.pending[obj.command] = obj # overwrites the older one
+            else:
+                self.emit(obj)
+            if not self.pipe.poll(0):
+                break
+        return True
+
+
+    def flush(self, t = None):
+        """Emit coalesced signals if it's time to do so
+        """
+        if len(self.pending) < 1:
+            return
+        if t is None:
+            t = time.time()
+        if t >= self.t_emit + self.min_interval:
+            for obj in self.pending.values():
+                self.emit(obj)
+            self.pending = {}
+            self.t_emit = t
+
+
+    def emit(self, obj):
+        # convert a message from the multiprocess into a Qt signal
+        if hasattr(self.signals, obj.command):
+            signal = getattr(self.signals, obj.command)
+            self.logger.debug("emitting signal %s", signal)
+            if len(obj.kwargs) < 1:
+                signal.emit() # no kwargs, so send signal without an object
+            else:
+                signal.emit(obj.kwargs) # signal carries a dictionary
+        else:
+            self.logger.info("no signal for %s.  Available signals: %s",
+                obj.command, self.signals)
+
+
+
 class QFrontThread(QtCore.QThread):
     """A QThread that is used to read messages MessageObjects coming from multiprocess & turning them into Qt signals
+
+    For the parameters, see SignalRouter
     """
-    def __init__(self, signals, pipe):
+    def __init__(self, signals, pipe, message_codec = codec.codec, coalesce = False, state_commands = [], max_rate = 10.0):
         self.pre = __name__ + "." + self.__class__.__name__
         self.logger = getLogger(self.pre)
         super().__init__()
         self.signals = signals
         self.pipe = pipe
+        self.router = SignalRouter(signals, pipe, 
+            message_codec   = message_codec, 
+            coalesce        = coalesce,
+            state_commands  = state_commands,
+            max_rate        = max_rate
+            )
         self.loop = True
         # self.setDebug()
 
@@ -90,7 +241,12 @@ class QFrontThread(QtCore.QThread):
 
     def run(self):
         while self.loop:
-            self.readPipes__(timeout = None)
+            deadline = self.router.deadline()
+            if deadline is None:
+                self.readPipes__(timeout = None)
+            else:
+                self.readPipes__(timeout = max(0, deadline - time.time()))
+            self.router.flush()
         self.logger.debug("QFrontThread: bye!")
 
     def readPipes__(self, timeout):
@@ -111,26 +267,126 @@ class QFrontThread(QtCore.QThread):
             AnalyzerWindow: showEvent
 
         """
-        try:
-            obj = self.pipe.recv()
-        except Exception as e:
-            self.logger.critical("QFrontThread: reading from multiprocess failed with %s", e)
-            return
+        r, w, e = safe_select([self.pipe], [], [], timeout = timeout)
+        if self.pipe in r:
+            if not self.router.drain():
+                self.loop = False
 
-        if obj is None:
-            self.loop = False
-            return
-        # convert a messages from the multiprocess into a Qt signal
-        if hasattr(self.signals, obj.command):
-            signal = getattr(self.signals, obj.command)
-            self.logger.debug("QFrontThread: emitting signal %s", signal)
-            if len(obj.kwargs) < 1:
-                signal.emit() # no kwargs, so send signal without an object
+
+
+class QFrontDispatcher(QtCore.QThread):
+    """A single QThread that reads the frontend pipes of several multiprocesses & turns the messages into Qt signals
+
+    Use this instead of a QFrontThread per multiprocess:
+
+    ::
+
+        dispatcher = QFrontDispatcher()
+        p1.go(front_dispatcher = dispatcher)
+        p2.go(front_dispatcher = dispatcher)
+        dispatcher.start()
+        ...
+        p1.stop()
+        p2.stop()
+        dispatcher.stop()
+
+    Multiprocesses can be added at any time.  A multiprocess is removed automatically when it exits
+    """
+
+    def __init__(self):
+        self.pre = __name__ + "." + self.__class__.__name__
+        self.logger = getLogger(self.pre)
+        super().__init__()
+        self.routers = {} # key: pipe, value: SignalRouter
+        self.closing = [] # pipes to be closed by the dispatcher thread.  See removeProcess
+        self.lock = threading.Lock()
+        self.wakeup_read, self.wakeup_write = Pipe(duplex = False)
+        self.loop = True
+        # self.setDebug()
+
+
+    def setDebug(self):
+        setLogger(self.logger, logging.DEBUG)
+
+
+    def addProcess(self, process):
+        """Start listening to a QMultiProcess
+        """
+        router = SignalRouter(process.signals, process.front_pipe, 
+            message_codec   = process.message_codec,
+            coalesce        = process.coalesce_signals,
+            state_commands  = process.state_signals,
+            max_rate        = process.max_signal_rate
+            )
+        with self.lock:
+            self.routers[process.front_pipe] = router
+        self.wakeup()
+
+
+    def removeProcess(self, process, close = False):
+        """Stop listening to a QMultiProcess
+
+        :param close:   Close the frontend pipe of the multiprocess.  It's closed by the dispatcher thread, once it's not selecting over the pipe anymore
+        """
+        with self.lock:
+            self.routers.pop(process.front_pipe, None)
+            if close:
+                self.closing.append(process.front_pipe)
+        self.wakeup()
+
+
+    def closePipes__(self):
+        with self.lock:
+            closing = self.closing
+            self.closing = []
+        for pipe in closing:
+            pipe.close()
+
+
+    def wakeup(self):
+        """Interrupt select so that changes in the list of pipes are taken into account
+        """
+        self.wakeup_write.send_bytes(b"w")
+
+
+    def run(self):
+        while self.loop:
+            with self.lock:
+                routers = dict(self.routers)
+            deadlines = [d for d in (router.deadline() for router in routers.values()) if d is not None]
+            if len(deadlines) > 0:
+                timeout = max(0, min(deadlines) - time.time())
             else:
-                signal.emit(obj.kwargs) # signal carries a dictionary
-        else:
-            self.logger.info("QFrontThread: no signal for %s.  Available signals: %s",
-                obj.command, self.signals)
+                timeout = None
+            rlis = [self.wakeup_read] + list(routers.keys())
+            r, w, e = safe_select(rlis, [], [], timeout = timeout)
+            if self.wakeup_read in r:
+                r.remove(self.wakeup_read)
+                while self.wakeup_read.poll(0):
+                    self.wakeup_read.recv_bytes()
+            for pipe in r:
+                if not routers[pipe].drain(): # multiprocess exited
+                    self.logger.debug("run: removing pipe %s", pipe)
+                    with self.lock:
+                        self.routers.pop(pipe, None)
+            t = time.time()
+            for router in routers.values():
+                router.flush(t)
+            self.closePipes__()
+        self.closePipes__()
+        self.logger.debug("run: bye!")
+
+
+    def requestStop(self):
+        self.loop = False
+        self.wakeup()
+
+    def waitStop(self):
+        self.wait()
+
+    def stop(self):
+        self.requestStop()
+        self.waitStop()
 
 
 
@@ -142,7 +398,7 @@ class QMultiProcess(Process):
 
         self.front_pipe      : write messages to multiprocess / read messages from multiprocess
         self.back_pipe       : multiprocess reads / writes messages to frontend
-        self.qt_front_thread : watches self.front_pipe to read MessageObject instances from multiprocess and turns them into Qt signals
+        self.qt_front_thread : watches self.front_pipe to read MessageObject instances from multiprocess and turns them into Qt signals.  Only if there is no shared QFrontDispatcher (see go)
 
         slots write directly to self.front_pipe
 
@@ -154,9 +410,18 @@ class QMultiProcess(Process):
 
 
     Here outgoing messages are mapped to Qt signals.  Without Qt, could use normal threading.Thread and mapping of messages to callbacks
+
+    MessageObjects are sent through the pipes as compact binary messages, using the codec defined in the class member message_codec (see valkka.live.codec).  Set it to None in your subclass to use plain pickling instead.  If your subclass uses custom commands / signals, you might want to register them with valkka.live.codec.registerCommand at import time
     """
 
     timeout = 1.0
+    message_codec = codec.codec
+
+    # coalescing of outgoing signals (see QFrontThread).  Signals in state_signals carry a state that
+    # can be overwritten by a newer one (bounding boxes, etc.), so the GUI needs to see only the latest one
+    coalesce_signals = False
+    state_signals = []
+    max_signal_rate = 10.0
 
     class Signals(QtCore.QObject):
         pong = Signal(object) # demo outgoing signal
@@ -172,6 +437,15 @@ class QMultiProcess(Process):
     # ****
 
 
+    # messages that define the state of the multiprocess.  The latest one of each is sent again (in this order)
+    # when the multiprocess is respawned after a crash (see Supervisor)
+    replay_commands = []
+    # key: command, value: list of commands in replay_commands it cancels
+    replay_cancel = {}
+
+    # frontend-only members that are not passed to a multiprocess launched by a forkserver (see startForkServer)
+    frontend_attributes = ["signals", "qt_front_thread", "front_dispatcher", "front_pipe", "replay"]
+
     def __init__(self, name = "QMultiProcess"):
         self.name = name
         self.pre = self.__class__.__name__ + "." + self.name
@@ -180,13 +454,23 @@ class QMultiProcess(Process):
         self.signals = self.Signals()
         print("class, signals:", self.__class__.__name__, self.signals)
         self.front_pipe, self.back_pipe = Pipe() # incoming messages
-        self.qt_front_thread = QFrontThread(self.signals, self.front_pipe)
+        self.qt_front_thread = None # created in go, only if there is no QFrontDispatcher
+        self.front_dispatcher = None
+        self.replay = {} # latest messages of replay_commands, by command
+        self.stop_requested = False
         self.loop = True
         self.listening = False # are we listening something else than just the intercom pipes?
 
     def __str__(self):
         return "<"+self.pre+">"
 
+    def __getstate__(self):
+        # called only when the multiprocess is launched by a forkserver
+        state = self.__dict__.copy()
+        for key in self.frontend_attributes:
+            state.pop(key, None)
+        return state
+
     def setDebug(self):
         setLogger(self.logger, logging.DEBUG)
         # self.qt_front_thread.setDebug() # lets not do this..
@@ -202,7 +486,7 @@ class QMultiProcess(Process):
                 self.readPipes__(timeout = self.timeout) # timeout of 1 sec
 
         # indicate front end qt thread to exit
-        self.back_pipe.send(None)
+        self.send_out__(None)
         self.logger.debug("bye!")
 
 
@@ -213,7 +497,7 @@ class QMultiProcess(Process):
         r, w, e = safe_select(rlis, [], [], timeout = timeout) # timeout = 0 == this is just a poll
         # handle the main intercom pipe
         if self.back_pipe in r:
-            obj = self.back_pipe.recv()
+            obj = self.recv_in__()
             r.remove(self.back_pipe)
             self.routeMainPipe__(obj)
         # in your subclass, handle rest of the pipes
@@ -244,28 +528,88 @@ class QMultiProcess(Process):
 
 
     def send_out__(self, obj):
-        """Pickle obj & send to outgoing pipe
+        """Encode obj & send to outgoing pipe
         """
         # print("send_out__", obj)
-        self.back_pipe.send(obj) # these are mapped to Qt signals
+        sendMessage(self.back_pipe, obj, self.message_codec) # these are mapped to Qt signals
+
+
+    def recv_in__(self):
+        """Read & decode a MessageObject from the incoming pipe
+        """
+        return recvMessage(self.back_pipe, self.message_codec)
 
 
 
     # **** frontend ****
 
     def sendMessageToBack(self, message: MessageObject):
-        self.front_pipe.send(message)
-
-    def go(self):
-        self.qt_front_thread.start()
+        if message is not None:
+            if message.command in self.replay_commands:
+                self.replay[message.command] = message
+            elif message.command in self.replay_cancel:
+                for command in self.replay_cancel[message.command]:
+                    self.replay.pop(command, None)
+        sendMessage(self.front_pipe, message, self.message_codec)
+
+    def go(self, front_dispatcher = None):
+        """Start the multiprocess
+
+        :param front_dispatcher:    A QFrontDispatcher instance.  If given, messages from the multiprocess are read by that shared thread.  Otherwise, this multiprocess gets a QFrontThread of its own
+        """
+        self.front_dispatcher = front_dispatcher
+        if self.front_dispatcher is None:
+            self.qt_front_thread = QFrontThread(self.signals, self.front_pipe, 
+                message_codec   = self.message_codec,
+                coalesce        = self.coalesce_signals,
+                state_commands  = self.state_signals,
+                max_rate        = self.max_signal_rate
+                )
+            self.qt_front_thread.start()
+        else:
+            self.front_dispatcher.addProcess(self)
         self.start()
 
+    def respawn(self):
+        """Launch the multiprocess again after it has died.  The frontend (Qt signals & their connections) is kept & the saved state (see replay_commands) is sent to the new multiprocess
+        """
+        if self.front_dispatcher is None:
+            # the parent still has the other end of the pipe, so the frontend thread never sees EOF: tell it to let go
+            sendMessage(self.back_pipe, None, self.message_codec)
+            self.qt_front_thread.wait()
+            self.front_pipe.close()
+        else:
+            self.front_dispatcher.removeProcess(self, close = True)
+        self.back_pipe.close() # the copy of the dead multiprocess' end
+        self.front_pipe, self.back_pipe = Pipe()
+        Process.__init__(self, name = self.name) # a Process can be started only once
+        self.stop_requested = False
+        self.go(front_dispatcher = self.front_dispatcher)
+        self.preReplay_()
+        for command in self.replay_commands:
+            if command in self.replay:
+                self.logger.debug("respawn: replaying %s", command)
+                sendMessage(self.front_pipe, self.replay[command], self.message_codec)
+
+    def preReplay_(self):
+        """Called in respawn, before the saved state is sent to the new multiprocess.  Overwrite in child classes
+        """
+        pass
+
+    def peerRespawned(self, process):
+        """Called by Supervisor when another supervised multiprocess has been respawned.  Override in child classes, if you depend on other multiprocesses
+        """
+        pass
+
     def requestStop(self):
+        self.stop_requested = True
         self.sendMessageToBack(None)
         
     def waitStop(self):
         self.join()
-        self.qt_front_thread.wait()
+        if self.front_dispatcher is None:
+            self.qt_front_thread.wait()
+        # .. otherwise the dispatcher removes the pipe once it receives the exit message
 
     def stop(self):
         self.requestStop()
@@ -275,7 +619,262 @@ class QMultiProcess(Process):
 
     def ping_slot(self):
         self.sendMessageToBack(MessageObject("ping", lis = [1,2,3]))
-        
+
+
+
+class Supervisor(QtCore.QObject):
+    """Watches multiprocesses & respawns them if they die unexpectedly (segfault, OOM killer, etc.)
+
+    :param interval:    How often the process sentinels are checked (seconds).  Default: 1.0
+    :param backoff:     Delay before the first respawn (seconds).  Doubled for each consecutive crash.  Default: 1.0
+    :param max_backoff: Maximum delay before a respawn (seconds).  Default: 60.0
+    :param stable_time: If a multiprocess has been running this long before crashing, the delay is reset to backoff.  Default: 60.0
+
+    ::
+
+        supervisor = Supervisor()
+        supervisor.addProcess(p) # after p.go()
+        supervisor.start()
+        ...
+        supervisor.stop()
+
+    Multiprocesses that exit after requestStop are just removed from the supervisor.  Respawning is done with QMultiProcess.respawn, so the objects using a multiprocess keep on using the same instance.  Runs in the Qt main thread
+    """
+
+    class Signals(QtCore.QObject):
+        died = Signal(object) # a multiprocess died unexpectedly
+        respawned = Signal(object) # a multiprocess was launched again
+
+    class State:
+        def __init__(self):
+            self.t_start = time.time()
+            self.n_crash = 0 # consecutive crashes
+            self.pending = False # waiting for a respawn
+
+    def __init__(self, interval = 1.0, backoff = 1.0, max_backoff = 60.0, stable_time = 60.0):
+        self.pre = __name__ + "." + self.__class__.__name__
+        self.logger = getLogger(self.pre)
+        super().__init__()
+        self.signals = self.Signals()
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_time = stable_time
+        self.states = {} # key: multiprocess, value: Supervisor.State
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(int(interval * 1000))
+        self.timer.timeout.connect(self.check)
+
+    def addProcess(self, process):
+        """Start supervising a (started) multiprocess
+        """
+        self.states[process] = self.State()
+
+    def removeProcess(self, process):
+        self.states.pop(process, None)
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def check(self):
+        sentinels = {}
+        for process, state in self.states.items():
+            if not state.pending:
+                sentinels[process.sentinel] = process
+        if len(sentinels) < 1:
+            return
+        for sentinel in connection.wait(list(sentinels.keys()), timeout = 0):
+            process = sentinels[sentinel]
+            process.join() # the process has exited, so this doesn't block
+            if process.stop_requested: # a normal exit
+                self.removeProcess(process)
+                continue
+            state = self.states[process]
+            if (time.time() - state.t_start) > self.stable_time:
+                state.n_crash = 0
+            delay = min(self.max_backoff, self.backoff * 2**state.n_crash)
+            state.n_crash += 1
+            state.pending = True
+            self.logger.critical("%s died with exitcode %s: respawning in %s seconds", process, process.exitcode, delay)
+            self.signals.died.emit(process)
+            QtCore.QTimer.singleShot(int(delay * 1000), lambda process = process: self.respawn_(process))
+
+    def respawn_(self, process):
+        if process not in self.states: # removed while waiting
+            return
+        state = self.states[process]
+        process.respawn()
+        state.t_start = time.time()
+        state.pending = False
+        for other in list(self.states.keys()):
+            if other is not process:
+                other.peerRespawned(process)
+        self.signals.respawned.emit(process)
+
+
+
+class ProcessPool:
+    """A pool of multiprocesses of a certain class.  Multiprocesses are forked only when they're needed
+
+    :param process_class:       A QMultiProcess subclass
+    :param max_instances:       Maximum number of multiprocesses in the pool.  Default: process_class.max_instances
+    :param prewarm:             Number of multiprocesses to fork already in prewarm().  Default: 0
+    :param idle_timeout:        Idle multiprocesses (beyond the prewarm count) are stopped after this many seconds in reap().  None = never.  Default: None
+    :param front_dispatcher:    QFrontDispatcher for the spawned multiprocesses.  Default: None
+    :param supervisor:          Supervisor that respawns the multiprocesses if they crash.  Default: None
+    :param kwargs:              Passed to the process_class constructor.  Default: {}
+
+    Two ways of using the pool:
+
+    ::
+
+        # each user gets a multiprocess of its own (stand-alone analyzers & clients)
+        p = pool.get() # pop an idle multiprocess or fork a new one
+        ...
+        pool.put(p) # back to the idle pool
+
+        # multiprocesses are shared (master processes & multi-stream analyzers)
+        p = pool.getShared() # a multiprocess with p.available() == True or a new one
+
+    Call reap() every now and then to stop multiprocesses that have been idle for too long
+    """
+
+    def __init__(self, process_class, max_instances = None, prewarm = 0, idle_timeout = None, front_dispatcher = None, supervisor = None, kwargs = {}):
+        self.pre = __name__ + "." + self.__class__.__name__ + "." + process_class.__name__
+        self.logger = getLogger(self.pre)
+        self.process_class = process_class
+        if max_instances is None:
+            self.max_instances = process_class.max_instances
+        else:
+            self.max_instances = max_instances
+        self.n_prewarm = min(prewarm, self.max_instances)
+        self.idle_timeout = idle_timeout
+        self.front_dispatcher = front_dispatcher
+        self.supervisor = supervisor
+        self.kwargs = kwargs
+        self.idle = [] # tuples: (multiprocess, time when it became idle)
+        self.busy = []
+
+    def __str__(self):
+        return "<ProcessPool %s: %i idle, %i busy, max %i>" % (self.process_class.__name__, len(self.idle), len(self.busy), self.max_instances)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def spawn_(self):
+        self.logger.debug("spawn_: forking a new %s", self.process_class.__name__)
+        p = self.process_class(**self.kwargs)
+        p.go(front_dispatcher = self.front_dispatcher)
+        if self.supervisor is not None:
+            self.supervisor.addProcess(p)
+        return p
+
+    def size(self):
+        """Number of running multiprocesses
+        """
+        return len(self.idle) + len(self.busy)
+
+    def available(self):
+        """Can get() return a multiprocess or not
+        """
+        return len(self.idle) > 0 or self.size() < self.max_instances
+
+    def gpuAvailable(self):
+        """Is there enough GPU memory for a new multiprocess (process_class.required_mb).  True if could not detect
+        """
+        required_mb = getattr(self.process_class, "required_mb", 0)
+        return (required_mb < 1) or resources.requiredGPU_MB(required_mb)
+
+    def prewarm(self):
+        """Fork the prewarm count of multiprocesses into the idle pool
+        """
+        while self.size() < self.n_prewarm:
+            self.idle.append((self.spawn_(), time.time()))
+
+    def get(self):
+        """Returns an idle multiprocess or forks a new one.  None if max_instances has been reached
+        """
+        if len(self.idle) > 0:
+            p, t = self.idle.pop() # the most recently used one
+        elif self.size() < self.max_instances:
+            p = self.spawn_()
+        else:
+            return None
+        self.busy.append(p)
+        return p
+
+    def put(self, p):
+        """Return a multiprocess to the idle pool
+        """
+        try:
+            self.busy.remove(p)
+        except ValueError:
+            self.logger.warning("put: %s does not belong to this pool", p)
+            return
+        self.idle.append((p, time.time()))
+
+    def availableShared(self):
+        """Can getShared() return a multiprocess or not
+        """
+        return self.available() or any(p.available() for p in self.busy)
+
+    def getShared(self, exclude = None, fork = True):
+        """Returns a running multiprocess that still has space (p.available()), or forks a new one.  None if all are full & max_instances has been reached
+
+        :param exclude: A multiprocess that should not be returned
+        :param fork:    If False, return only a multiprocess that is already in use (never fork or take one from the idle pool)
+
+        For master processes (that have the methods loadScore & saturated), the least loaded one is returned.  If all of them are saturated, a new one is forked, if possible (and if there is GPU memory for it, see gpuAvailable)
+        """
+        candidates = [p for p in self.busy if p.available() and (p is not exclude)]
+        if len(candidates) > 0 and hasattr(candidates[0], "loadScore"):
+            unsaturated = [p for p in candidates if not p.saturated()]
+            if len(unsaturated) < 1 and fork and self.available() and self.gpuAvailable():
+                return self.get()
+            return min(unsaturated or candidates, key = lambda p: p.loadScore())
+        elif len(candidates) > 0:
+            return candidates[0]
+        elif not fork:
+            return None
+        # an idle multiprocess becomes busy once it's being shared
+        return self.get()
+
+    def reap(self, t = None):
+        """Stop multiprocesses that have been idle longer than idle_timeout, keeping at least the prewarm count alive
+        """
+        if self.idle_timeout is None:
+            return
+        if t is None:
+            t = time.time()
+        expired = []
+        # self.idle is ordered by time: the oldest ones first
+        while len(self.idle) > 0 and self.size() > self.n_prewarm and (t - self.idle[0][1]) > self.idle_timeout:
+            expired.append(self.idle.pop(0)[0])
+        for p in expired:
+            self.logger.debug("reap: stopping idle %s", p)
+            p.requestStop()
+        for p in expired:
+            p.waitStop()
+
+    def requestStop(self):
+        for p in self.busy:
+            p.requestStop()
+        for p, t in self.idle:
+            p.requestStop()
+
+    def waitStop(self):
+        for p in self.busy:
+            p.waitStop()
+        for p, t in self.idle:
+            p.waitStop()
+        self.busy = []
+        self.idle = []
+
+    def stop(self):
+        self.requestStop()
+        self.waitStop()
 
 
 def test1():
@@ -291,10 +890,65 @@ def test1():
 
 
 
+
+def test2():
+    """Several multiprocesses, a single frontend thread
+    """
+    dispatcher = QFrontDispatcher()
+    mps = []
+    for i in range(5):
+        mp = QMultiProcess(name = "QMultiProcess%i" % (i))
+        mp.go(front_dispatcher = dispatcher)
+        mps.append(mp)
+    dispatcher.start()
+    time.sleep(3)
+    print("try ping")
+    for mp in mps:
+        mp.ping_slot()
+    time.sleep(3)
+    print("exit")
+    for mp in mps:
+        mp.requestStop()
+    for mp in mps:
+        mp.waitStop()
+    dispatcher.stop()
+
+
+def test3():
+    """Lazy forking with ProcessPool
+    """
+    dispatcher = QFrontDispatcher()
+    dispatcher.start()
+    pool = ProcessPool(QMultiProcess, max_instances = 3, prewarm = 1, idle_timeout = 1, front_dispatcher = dispatcher)
+    pool.prewarm()
+    print(pool)
+    p1 = pool.get() # the prewarmed one
+    p2 = pool.get() # forked now
+    print(pool)
+    p2.ping_slot()
+    pool.put(p1)
+    pool.put(p2)
+    print(pool)
+    time.sleep(2)
+    pool.reap() # only the prewarmed one is kept
+    print(pool)
+    pool.stop()
+    dispatcher.stop()
+
+
+def test4():
+    """Like test3, but multiprocesses are launched by a forkserver
+    """
+    startForkServer()
+    test3()
+
+
+
 if __name__ == "__main__":
     import logging    
     setLogger(logger, logging.DEBUG)
     test1()
+    # test2()
     """TODO
 
     - Test with Qt window: press button => mp => outgoing signal to qlabel
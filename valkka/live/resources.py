@@ -0,0 +1,390 @@
+"""
+resources.py : Cached probing of system resources (GPU memory, cpu load)
+
+Copyright 2018 Sampsa Riikonen
+
+Authors: Sampsa Riikonen
+
+This file is part of the Valkka Live video surveillance program
+
+Valkka Live is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License along with this program.  If not, see <https://www.gnu.org/licenses/>
+
+@file    resources.py
+@author  Sampsa Riikonen
+@date    2018
+@version 1.2.2
+@brief   Cached probing of system resources (GPU memory, cpu load)
+"""
+import sys
+import os
+import re
+import glob
+import time
+import shutil
+import threading
+import multiprocessing
+from valkka.live.tools import getLogger
+
+logger = getLogger(__name__)
+
+
+"""Usage:
+
+::
+
+    from valkka.live import resources
+    free = resources.getFreeGPU_MB()            # -1 if could not detect
+    ok = resources.requiredGPU_MB(2400)         # True if could not detect
+    resources.getProbe().snapshot()             # everything in a dict
+
+The first provider that works is used: NVML (nvidia, needs the pynvml module), sysfs (amdgpu) and glxinfo (slow, as it forks a process).  The results are cached for ttl seconds, so the analyzers can ask for them at each activation.
+
+Each process has a probe of its own.  GPU memory should be reserved (reserveGPU_MB) in the main process, before the analyzer multiprocess allocates it, so that all reservations end up in the same probe.  See valkka.mvision.detector.reserveGPU_MB
+
+For tests:
+
+::
+
+    resources.setProbe(resources.ResourceProbe(providers = [resources.FakeProvider([resources.GPUInfo(0, "fake", 4000, 3000)])]))
+"""
+
+
+class GPUInfo:
+    """Memory of a single GPU, in MBytes
+    """
+
+    def __init__(self, index, name, total_mb, free_mb, source = ""):
+        self.index = index
+        self.name = name
+        self.total_mb = total_mb
+        self.free_mb = free_mb
+        self.source = source
+
+    def __str__(self):
+        return "<GPUInfo %i %s: %i / %i MB free (%s)>" % (self.index, self.name, self.free_mb, self.total_mb, self.source)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class ResourceProvider:
+    """Base class for GPU memory providers
+
+    Subclasses define:
+
+    ::
+
+        name        : for logging
+        available() : can this provider be used at all.  Should be cheap
+        gpus()      : returns a list of GPUInfo objects.  Raises an exception if probing fails
+    """
+
+    name = "none"
+
+    def available(self):
+        return False
+
+    def gpus(self):
+        raise(AssertionError("virtual method"))
+
+
+class NVMLProvider(ResourceProvider):
+    """Nvidia cards through the NVML library (module pynvml, i.e. pip3 install nvidia-ml-py)
+    """
+
+    name = "nvml"
+
+    def __init__(self):
+        self.nvml = None
+
+    def available(self):
+        if self.nvml is not None:
+            return True
+        try:
+            import pynvml
+            pynvml.nvmlInit()
+        except Exception:
+            return False
+        self.nvml = pynvml
+        return True
+
+    def gpus(self):
+        nvml = self.nvml
+        lis = []
+        for i in range(nvml.nvmlDeviceGetCount()):
+            handle = nvml.nvmlDeviceGetHandleByIndex(i)
+            mem = nvml.nvmlDeviceGetMemoryInfo(handle)
+            name = nvml.nvmlDeviceGetName(handle)
+            if isinstance(name, bytes):
+                name = name.decode("utf-8")
+            lis.append(GPUInfo(i, name, mem.total // 2**20, mem.free // 2**20, source = self.name))
+        return lis
+
+
+class SysfsProvider(ResourceProvider):
+    """Cards that report their vram in sysfs (amdgpu)
+    """
+
+    name = "sysfs"
+    pattern = "/sys/class/drm/card[0-9]*/device/mem_info_vram_total"
+
+    def available(self):
+        return len(glob.glob(self.pattern)) > 0
+
+    def gpus(self):
+        lis = []
+        for i, total_file in enumerate(sorted(glob.glob(self.pattern))):
+            device = os.path.dirname(total_file)
+            with open(total_file, "r") as f:
+                total = int(f.read())
+            with open(os.path.join(device, "mem_info_vram_used"), "r") as f:
+                used = int(f.read())
+            lis.append(GPUInfo(i, device.split("/")[-2], total // 2**20, (total - used) // 2**20, source = self.name))
+        return lis
+
+
+class GlxinfoProvider(ResourceProvider):
+    """Parses the output of glxinfo.  Forks a process, so this is slow
+    """
+
+    name = "glxinfo"
+    regex = re.compile(r"available .* memory: (\d+) MB")
+    total_regex = re.compile(r"Total available memory: (\d+) MB")
+
+    def available(self):
+        return shutil.which("glxinfo") is not None
+
+    def gpus(self):
+        from subprocess import Popen, PIPE
+        p = Popen(["glxinfo"], stdout = PIPE, stderr = PIPE)
+        st = p.communicate(timeout = 10)[0].decode("utf-8")
+        free = self.regex.findall(st)
+        if len(free) < 1:
+            raise ValueError("glxinfo reports no GPU memory")
+        total = self.total_regex.findall(st)
+        free = int(free[-1])
+        return [GPUInfo(0, "glx", int(total[0]) if total else free, free, source = self.name)]
+
+
+class FakeProvider(ResourceProvider):
+    """Returns whatever GPUInfos it has been given.  For testing
+
+    :param gpu_list: A list of GPUInfo objects.  Modify it (or the objects) to simulate changes
+    """
+
+    name = "fake"
+
+    def __init__(self, gpu_list = []):
+        self.gpu_list = gpu_list
+        self.calls = 0 # how many times gpus was called
+
+    def available(self):
+        return True
+
+    def gpus(self):
+        self.calls += 1
+        return [GPUInfo(g.index, g.name, g.total_mb, g.free_mb, source = self.name) for g in self.gpu_list]
+
+
+class ResourceProbe:
+    """Caches the GPU memory information for ttl seconds.  Thread-safe
+
+    :param providers:   ResourceProviders in the order of preference.  Default: NVML, sysfs, glxinfo
+    :param ttl:         Cache time in seconds
+
+    Memory claimed with claimGPU_MB is subtracted from the cached free memory, so that several analyzers activated within ttl don't all get the same memory.  This works only for the claims made in the same process, i.e. in the main process
+    """
+
+    def __init__(self, providers = None, ttl = 5.0):
+        if providers is None:
+            providers = [NVMLProvider(), SysfsProvider(), GlxinfoProvider()]
+        self.providers = providers
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.provider = None # the chosen one
+        self.chosen = False
+        self.gpu_list = []
+        self.t_probe = None
+        self.claimed_mb = 0
+
+    def chooseProvider_(self):
+        self.chosen = True
+        for provider in self.providers:
+            if provider.available():
+                self.provider = provider
+                logger.debug("chooseProvider_: using %s", provider.name)
+                return
+        logger.info("no GPU memory provider available")
+
+    def probe_(self):
+        if not self.chosen:
+            self.chooseProvider_()
+        self.t_probe = time.time()
+        self.claimed_mb = 0
+        if self.provider is None:
+            self.gpu_list = []
+            return
+        try:
+            self.gpu_list = self.provider.gpus()
+        except Exception as e:
+            logger.warning("probing GPU memory with %s failed: %s", self.provider.name, e)
+            self.gpu_list = []
+
+    def invalidate(self):
+        """Probe again at the next query
+        """
+        with self.lock:
+            self.t_probe = None
+
+    def gpus(self):
+        """A list of GPUInfo objects, at most ttl seconds old
+        """
+        with self.lock:
+            if (self.t_probe is None) or (time.time() - self.t_probe) > self.ttl:
+                self.probe_()
+            return list(self.gpu_list)
+
+    def getFreeGPU_MB(self):
+        """Free memory of the GPU that has most of it.  -1 if could not detect
+        """
+        gpu_list = self.gpus()
+        if len(gpu_list) < 1:
+            return -1
+        with self.lock:
+            return max(0, max(gpu.free_mb for gpu in gpu_list) - self.claimed_mb)
+
+    def requiredGPU_MB(self, n):
+        """Is there n MBytes of free GPU memory.  True if could not detect
+        """
+        free = self.getFreeGPU_MB()
+        if free == -1:
+            return True
+        return free >= n
+
+    def claimGPU_MB(self, n):
+        """Somebody is about to allocate n MBytes
+        """
+        with self.lock:
+            self.claimed_mb += n
+
+    def reserveGPU_MB(self, n):
+        """Check that there is n MBytes of free GPU memory & claim it.  True if there was (or if could not detect)
+        """
+        gpu_list = self.gpus()
+        with self.lock: # check & claim at one go
+            if len(gpu_list) > 0 and (max(gpu.free_mb for gpu in gpu_list) - self.claimed_mb) < n:
+                return False
+            self.claimed_mb += n
+        return True
+
+    def releaseGPU_MB(self, n):
+        """Release a claim of n MBytes made with reserveGPU_MB or claimGPU_MB, i.e. the analyzer is not going to allocate the memory after all or it has been deactivated
+        """
+        with self.lock:
+            # claims are cleared at each probe, so this one might be gone already
+            self.claimed_mb = max(0, self.claimed_mb - n)
+
+    def snapshot(self):
+        """All resource information in a dictionary
+        """
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            load = -1
+        return {
+            "gpus"          : self.gpus(),
+            "free_gpu_mb"   : self.getFreeGPU_MB(),
+            "gpu_provider"  : self.provider.name if self.provider else None,
+            "n_cpus"        : multiprocessing.cpu_count(),
+            "load"          : load
+            }
+
+
+probe = None
+
+
+def getProbe():
+    global probe
+    if probe is None:
+        probe = ResourceProbe()
+    return probe
+
+
+def setProbe(probe_):
+    """Replace the ResourceProbe, i.e. for testing
+    """
+    global probe
+    probe = probe_
+
+
+def getFreeGPU_MB():
+    return getProbe().getFreeGPU_MB()
+
+
+def requiredGPU_MB(n):
+    return getProbe().requiredGPU_MB(n)
+
+
+def reserveGPU_MB(n):
+    return getProbe().reserveGPU_MB(n)
+
+
+def releaseGPU_MB(n):
+    getProbe().releaseGPU_MB(n)
+
+
+def test1():
+    """Fake provider & caching
+    """
+    gpu_list = [GPUInfo(0, "fake", 4000, 3000)]
+    provider = FakeProvider(gpu_list)
+    setProbe(ResourceProbe(providers = [provider], ttl = 0.5))
+    print(getProbe().gpus())
+    assert(getFreeGPU_MB() == 3000)
+    assert(requiredGPU_MB(2400))
+    getProbe().claimGPU_MB(2400)
+    assert(not requiredGPU_MB(2400))
+    assert(getProbe().reserveGPU_MB(600))
+    assert(not getProbe().reserveGPU_MB(1))
+    releaseGPU_MB(600)
+    assert(getFreeGPU_MB() == 600)
+    assert(getProbe().reserveGPU_MB(600))
+    gpu_list[0].free_mb = 1000
+    assert(provider.calls == 1) # cached
+    time.sleep(0.6)
+    assert(getFreeGPU_MB() == 1000) # claims are cleared at re-probe
+    assert(provider.calls == 2)
+    print(getProbe().snapshot())
+    setProbe(ResourceProbe(providers = [FakeProvider([])]))
+    assert(getFreeGPU_MB() == -1)
+    assert(requiredGPU_MB(100000))
+    setProbe(None)
+
+
+def test2():
+    """The real thing
+    """
+    t = time.time()
+    print(getProbe().snapshot())
+    print("first probe took %.1f ms" % ((time.time() - t) * 1000))
+    t = time.time()
+    print(getFreeGPU_MB())
+    print("cached probe took %.3f ms" % ((time.time() - t) * 1000))
+
+
+def main():
+    pre = "main :"
+    print(pre, "main: arguments: ", sys.argv)
+    if (len(sys.argv) < 2):
+        print(pre, "main: needs test number")
+    else:
+        st = "test" + str(sys.argv[1]) + "()"
+        exec(st)
+
+
+if (__name__ == "__main__"):
+    main()
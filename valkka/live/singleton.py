@@ -49,6 +49,12 @@ www_module = None
 # use vaapi or not
 vaapi = False
 
+# keep decoding a stream for this many seconds after the last viewer / analyzer has gone away
+decoding_linger = 10.0
+
+# viewports smaller than this (width & height in pixels) show the sub stream of a camera, if it has one.  Analyzers use always the sub stream
+sub_stream_max_width = 800
+
 # explicit X11 DISPLAY variable for libValkka / OpenGLThread
 display = None# not used!
 
@@ -82,22 +88,48 @@ data_model = None
 devices_by_id = {}
 
 # process map for different analyzers
+# key: tag, value: valkka.live.multiprocess.ProcessPool instance
 process_map = {}
 client_process_map = {}
 master_process_map = {}
 
+# number of mvision processes per analyzer class that are forked at startup.  The rest are forked on demand.
+# An mvision class can override this with the class member "prewarm"
+mvision_prewarm = 1
+# stop mvision processes that have been idle for this many seconds.  None = never
+mvision_idle_timeout = 300
+
 
-def get_avail_master_process(tag):
+def get_avail_master_process(tag, exclude = None, fork = True):
     global master_process_map
     try:
-        queue = master_process_map[tag]
+        pool = master_process_map[tag]
     except KeyError:
         return None
-    # return master process that still has space for clients
-    for process in queue: 
-        if process.available():
-            return process
-    return None
+    # return the least loaded master process that still has space for clients.  Forks a new one if necessary (and if fork is True)
+    return pool.getShared(exclude = exclude, fork = fork)
+
+
+def avail_master_process(tag):
+    """Could get_avail_master_process return a master process.  Does not fork anything
+    """
+    try:
+        pool = master_process_map[tag]
+    except KeyError:
+        return False
+    return pool.availableShared()
+
+
+def release_master_process(master_process):
+    """Return a master process to the idle pool once its last client has gone, so that ProcessPool.reap can stop it
+    """
+    if (master_process is None) or master_process.inUse():
+        return
+    try:
+        pool = master_process_map[master_process.tag]
+    except KeyError:
+        return
+    pool.put(master_process)
 
 
 # QThread for interprocess communication
@@ -30,6 +30,7 @@ import types
 import re
 import logging
 import copy
+import time
 from pydoc import locate
 from valkka.live.singleton import config_dir, valkkafs_dir
 
@@ -230,19 +231,53 @@ def getH264V4l2(verbose=False):
 
 
 def getFreeGPU_MB():
-    import re
-    from subprocess import Popen, PIPE
-    s=re.compile("available .* memory: (\d+) MB")
-    lis=("glxinfo").split()
-    p = Popen(lis, stdout=PIPE, stderr=PIPE)
-    st = p.stdout.read().decode("utf-8")
+    """Free GPU memory in MBytes, -1 if could not detect.  Cached: see valkka.live.resources
+    """
+    from valkka.live import resources
+    return resources.getFreeGPU_MB()
+
 
-    try:
-        val=int(s.findall(st)[0])
-    except IndexError or ValueError:
-        return -1
+class PhaseTimer:
+    """Wall-clock time of consecutive phases, i.e. of starting up or closing down
+    
+    ::
+    
+        timer = PhaseTimer("closeValkka")
+        timer.phase("threads")
+        ...
+        timer.phase("filterchains")
+        ...
+        timer.stop()
+        print(timer) # closeValkka: threads 0.102 s, filterchains 0.250 s, total 0.352 s
+    """
 
-    return val
+    def __init__(self, name):
+        self.name = name
+        self.phases = [] # (name, seconds)
+        self.current = None
+        self.t0 = time.time()
+        self.t = self.t0
+        self.total = None
+
+    def phase(self, name):
+        """End the current phase (if any) & start a new one
+        """
+        t = time.time()
+        if self.current is not None:
+            self.phases.append((self.current, t - self.t))
+        self.current = name
+        self.t = t
+
+    def stop(self):
+        self.phase(None)
+        self.total = self.t - self.t0
+        return self.total
+
+    def __str__(self):
+        st = ", ".join("%s %.3f s" % (name, dt) for name, dt in self.phases)
+        if self.total is not None:
+            st += ", total %.3f s" % (self.total)
+        return self.name + ": " + st
 
 
 def parameterInitCheck(definitions, parameters, obj, undefined_ok=False):
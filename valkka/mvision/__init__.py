@@ -11,6 +11,11 @@ try:
 except Exception as e:
     print("valkka.mvision.__init__ : could not import module movement : '"+str(e)+"'")
 
+try:
+    from .import movementmulti
+except Exception as e:
+    print("valkka.mvision.__init__ : could not import module movementmulti : '"+str(e)+"'")
+
 """
 try: 
     from .import alpr
@@ -80,6 +80,14 @@ class Analyzer(object):
         raise(AssertionError("virtual method"))
 
 
+    def batch(self, imgs):
+        """Do the magic for a list of images.  Returns a list of results
+
+        Override this if your analyzer is capable of real batched inference
+        """
+        return [self(img) for img in imgs]
+
+
     def report(self, *args):
         if (self.verbose):
             print(self.pre, *args)
@@ -0,0 +1,695 @@
+"""
+detector.py : Pluggable object detector backends
+
+Copyright 2018 Sampsa Riikonen
+
+Authors: Sampsa Riikonen
+
+This file is part of the machine vision plugin for the Valkka Live program
+
+This plugin is free software: you can redistribute it and/or modify it under the terms of the MIT License.  This code is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the MIT License for more details.
+
+@file    detector.py
+@author  Sampsa Riikonen
+@date    2018
+@version 1.2.2
+@brief   Pluggable object detector backends
+"""
+import sys
+import os
+import time
+import importlib
+import importlib.util
+from valkka.api2 import parameterInitCheck
+from valkka.live.tools import getLogger, setLogger
+from valkka.mvision.base import Analyzer
+from valkka.live import resources
+
+logger = getLogger(__name__)
+
+
+"""Object detector backends produce lists of tuples, one tuple per detected object:
+
+::
+
+    (nametag, probability, left, right, top, bottom)
+
+where probability is in percent and the coordinates are in pixels of the analyzed image (i.e. the format of the darknet predictors)
+
+Backends are loaded lazily: importing this module or instantiating a backend doesn't import any heavy libraries.  That happens in DetectorBackend.load, typically in the analyzer multiprocess
+
+::
+
+    name, kwargs = chooseBackend([("darknet", {"model": "yolov3"}), ("opencv", opencv_yolov3)])
+    backend = getBackend(name, **kwargs)
+    backend.load()
+    lis = backend(img)
+    lis_list = backend.batch([img1, img2])
+
+The yolo plugins declare their backends in the order of preference and use DetectorAnalyzer:
+
+::
+
+    detector_backends = [("darknet", {"model": "yolov3"}), ("opencv", opencv_yolov3)]
+    auto_menu = hasBackend(detector_backends)
+    ...
+    backend = preferredBackend(detector_backends) # in the multiprocess
+    analyzer = DetectorAnalyzer(backend = backend)
+"""
+
+# opencv-dnn model files are searched from here
+model_dir = os.path.join(os.path.expanduser("~"), ".valkka", "models")
+
+# the coco class names, in the order used by the yolo models
+coco_names = [
+    "person", "bicycle", "car", "motorbike", "aeroplane", "bus", "train", "truck", "boat", "traffic light",
+    "fire hydrant", "stop sign", "parking meter", "bench", "bird", "cat", "dog", "horse", "sheep", "cow",
+    "elephant", "bear", "zebra", "giraffe", "backpack", "umbrella", "handbag", "tie", "suitcase", "frisbee",
+    "skis", "snowboard", "sports ball", "kite", "baseball bat", "baseball glove", "skateboard", "surfboard", "tennis racket", "bottle",
+    "wine glass", "cup", "fork", "knife", "spoon", "bowl", "banana", "apple", "sandwich", "orange",
+    "broccoli", "carrot", "hot dog", "pizza", "donut", "cake", "chair", "sofa", "pottedplant", "bed",
+    "diningtable", "toilet", "tvmonitor", "laptop", "mouse", "remote", "keyboard", "cell phone", "microwave", "oven",
+    "toaster", "sink", "refrigerator", "book", "clock", "vase", "scissors", "teddy bear", "hair drier", "toothbrush"
+]
+
+
+class DetectorBackend:
+    """Base class for the object detector backends
+
+    :param verbose: Verbose output or not
+
+    Subclasses define:
+
+    ::
+
+        modules     : python modules required by the backend
+        load()      : import the libraries & load the model
+        __call__    : detect objects in one image
+        batch       : detect objects in a list of images (optional)
+        usesGPU     : (optional)
+    """
+
+    modules = []
+
+    parameter_defs = {
+        "verbose": (bool, False)
+    }
+
+    @classmethod
+    def available(cls, **kwargs):
+        """Can this backend be used with these kwargs.  Doesn't import anything
+        """
+        for module in cls.modules:
+            if not moduleFound(module):
+                return False
+        return True
+
+    def __init__(self, **kwargs):
+        parameterInitCheck(DetectorBackend.parameter_defs, kwargs, self, undefined_ok = True)
+        self.pre = self.__class__.__name__
+        self.logger = getLogger(self.pre)
+        self.loaded = False
+
+    def load(self):
+        raise(AssertionError("virtual method"))
+
+    def __call__(self, img):
+        raise(AssertionError("virtual method"))
+
+    def batch(self, imgs):
+        """Returns a list of results, one for each image
+        """
+        return [self(img) for img in imgs]
+
+    def usesGPU(self):
+        return False
+
+    @classmethod
+    def mayUseGPU(cls, **kwargs):
+        """Might this backend use the GPU with these kwargs.  Doesn't import anything
+        """
+        return False
+
+    def close(self):
+        pass
+
+
+class DarknetBackend(DetectorBackend):
+    """The darknet predictors of darknet-python
+
+    See https://github.com/elsampsa/darknet-python
+    """
+
+    modules = ["darknet"]
+
+    parameter_defs = {
+        "verbose": (bool, False),
+        "model": (str, "yolov3") # "yolov3", "yolov3tiny" or "yolov2"
+    }
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        parameterInitCheck(self.parameter_defs, kwargs, self)
+        assert(self.model in ["yolov3", "yolov3tiny", "yolov2"])
+
+    def load(self):
+        from valkka.live.version import MIN_DARKNET_VERSION_MAJOR, MIN_DARKNET_VERSION_MINOR, MIN_DARKNET_VERSION_PATCH
+        from darknet.core import VERSION_MAJOR, VERSION_MINOR, VERSION_PATCH
+        assert(VERSION_MAJOR >= MIN_DARKNET_VERSION_MAJOR)
+        assert(VERSION_MINOR >= MIN_DARKNET_VERSION_MINOR)
+        assert(VERSION_PATCH >= MIN_DARKNET_VERSION_PATCH)
+        from darknet.api2.predictor import get_YOLOv3_Predictor, get_YOLOv3_Tiny_Predictor, get_YOLOv2_Predictor
+        if self.model == "yolov3":
+            self.predictor = get_YOLOv3_Predictor()
+        elif self.model == "yolov3tiny":
+            self.predictor = get_YOLOv3_Tiny_Predictor()
+        else:
+            self.predictor = get_YOLOv2_Predictor()
+        self.loaded = True
+
+    def __call__(self, img):
+        return self.predictor(img)
+
+    def usesGPU(self):
+        from darknet.core import darknet_with_cuda
+        return darknet_with_cuda()
+
+    @classmethod
+    def mayUseGPU(cls, **kwargs):
+        return True # known only after importing darknet
+
+
+class LetterboxGeometry:
+    """How images of a certain resolution are placed into the network input
+
+    :param shape:       Image shape (height, width, ..)
+    :param input_size:  Network input size (width, height)
+    """
+
+    def __init__(self, shape, input_size):
+        self.height, self.width = shape[0], shape[1]
+        self.scale = min(input_size[0] / self.width, input_size[1] / self.height)
+        self.new_width = int(round(self.width * self.scale))
+        self.new_height = int(round(self.height * self.scale))
+        self.pad_x = (input_size[0] - self.new_width) // 2
+        self.pad_y = (input_size[1] - self.new_height) // 2
+        self.canvases = [] # padded input images, one per batch position
+
+
+class Letterbox:
+    """Scales images into the network input keeping the aspect ratio & pads the rest.
+
+    :param input_size:  Network input size (width, height)
+    :param max_batch:   Max number of images in one input tensor
+    :param fill:        Value of the padding
+
+    The geometry & the padded input images are created once per image resolution and reused after that.  The same goes for the float input tensor (n, 3, height, width), so no memory is allocated per frame
+
+    ::
+
+        letterbox = Letterbox((416, 416), max_batch = 4)
+        blob, geometries = letterbox([img1, img2])
+        ..
+        boxes = letterbox.unmap(boxes, geometries[0]) # from network input pixels back to pixels of img1
+    """
+
+    def __init__(self, input_size, max_batch = 1, fill = 114):
+        import numpy
+        import cv2
+        self.numpy = numpy
+        self.cv2 = cv2
+        self.input_size = input_size
+        self.max_batch = max_batch
+        self.fill = fill
+        self.geometries = {} # LetterboxGeometry by image shape
+        self.blob = numpy.zeros((max_batch, 3, input_size[1], input_size[0]), dtype = numpy.float32)
+
+    def getGeometry(self, shape):
+        key = (shape[0], shape[1])
+        try:
+            return self.geometries[key]
+        except KeyError:
+            geometry = LetterboxGeometry(shape, self.input_size)
+            self.geometries[key] = geometry
+            return geometry
+
+    def canvas_(self, geometry, n):
+        while len(geometry.canvases) <= n:
+            geometry.canvases.append(self.numpy.full((self.input_size[1], self.input_size[0], 3), self.fill, dtype = self.numpy.uint8))
+        canvas = geometry.canvases[n]
+        return canvas, canvas[
+            geometry.pad_y : geometry.pad_y + geometry.new_height,
+            geometry.pad_x : geometry.pad_x + geometry.new_width]
+
+    def __call__(self, imgs):
+        """Returns the input tensor (a view to the preallocated one) and a list of LetterboxGeometry objects, one per image
+        """
+        assert(len(imgs) <= self.max_batch)
+        geometries = []
+        for n, img in enumerate(imgs):
+            geometry = self.getGeometry(img.shape)
+            canvas, roi = self.canvas_(geometry, n)
+            if geometry.scale == 1.0 and roi.shape == img.shape:
+                self.numpy.copyto(roi, img)
+            else:
+                resized = self.cv2.resize(img, (geometry.new_width, geometry.new_height), dst = roi, interpolation = self.cv2.INTER_LINEAR)
+                if not self.numpy.shares_memory(resized, roi): # just in case cv2 didn't write into the view
+                    self.numpy.copyto(roi, resized)
+            # (height, width, 3) uint8 => (3, height, width) float
+            self.numpy.multiply(canvas.transpose((2, 0, 1)), 1/255.0, out = self.blob[n], casting = "unsafe")
+            geometries.append(geometry)
+        return self.blob[0:len(imgs)], geometries
+
+    def unmap(self, boxes, geometry):
+        """Boxes (n, 4) (left, top, right, bottom) from network input pixels to image pixels.  In-place
+        """
+        boxes[:, 0::2] -= geometry.pad_x
+        boxes[:, 1::2] -= geometry.pad_y
+        boxes /= geometry.scale
+        self.numpy.clip(boxes[:, 0::2], 0, geometry.width, out = boxes[:, 0::2])
+        self.numpy.clip(boxes[:, 1::2], 0, geometry.height, out = boxes[:, 1::2])
+        return boxes
+
+
+def nms(boxes, scores, threshold, classes = None):
+    """Non-maximum suppression with numpy.  Returns the indices of the boxes to keep, highest score first
+
+    :param boxes:       numpy array (n, 4) : (left, top, right, bottom)
+    :param scores:      numpy array (n)
+    :param threshold:   Boxes overlapping (IoU) more than this with a better box are removed
+    :param classes:     numpy array (n) of class indices.  If given, only boxes of the same class suppress each other
+
+    The IoUs of a kept box against all remaining boxes are computed in one go, so the number of python iterations is the number of kept boxes
+    """
+    import numpy
+    if len(boxes) < 1:
+        return numpy.zeros(0, dtype = numpy.int64)
+    if classes is not None: # move the boxes of each class apart so that they never overlap
+        boxes = boxes + (classes * (boxes.max() + 1))[:, None]
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while len(order) > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = numpy.clip(numpy.minimum(x2[i], x2[rest]) - numpy.maximum(x1[i], x1[rest]), 0, None)
+        h = numpy.clip(numpy.minimum(y2[i], y2[rest]) - numpy.maximum(y1[i], y1[rest]), 0, None)
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= threshold]
+    return numpy.array(keep, dtype = numpy.int64)
+
+
+def fractional(lis, shape):
+    """Pixel coordinates of detector results to fractional coordinates.  Returns a list of (left, right, top, bottom) tuples
+    """
+    if len(lis) < 1:
+        return []
+    import numpy
+    boxes = numpy.array([l[2:6] for l in lis], dtype = numpy.float64)
+    boxes /= numpy.array([shape[1], shape[1], shape[0], shape[0]], dtype = numpy.float64)
+    return list(map(tuple, boxes.tolist()))
+
+
+class OpenCVDNNBackend(DetectorBackend):
+    """Runs yolo models with OpenCV's dnn module.  Works on the CPU, so no GPU is needed
+
+    :param model_file:      Darknet weights file or an ONNX file
+    :param config_file:     Darknet cfg file.  Empty for ONNX files
+    :param names_file:      Class names, one per line.  Empty = coco names
+    :param input_size:      Network input size (width, height)
+    :param letterbox:       Keep the aspect ratio of the images & pad (True) or stretch them into the network input (False)
+    :param conf_threshold:  Minimum confidence (0-1) of a detection
+    :param nms_threshold:   IoU threshold of the non-maximum suppression
+    :param output_format:   "yolo" : rows (cx, cy, w, h, objectness, class scores ..) (darknet, yolov5).  "yolov8" : (cx, cy, w, h, class scores ..), transposed
+    :param target:          "cpu", "opencl" or "cuda"
+    :param max_batch:       Max number of images in one forward pass
+
+    Darknet models output the boxes in relative coordinates, ONNX models in pixels of the network input
+    """
+
+    modules = ["cv2"]
+
+    parameter_defs = {
+        "verbose":          (bool, False),
+        "model_file":       str,
+        "config_file":      (str, ""),
+        "names_file":       (str, ""),
+        "input_size":       (tuple, (416, 416)),
+        "letterbox":        (bool, True),
+        "conf_threshold":   (float, 0.5),
+        "nms_threshold":    (float, 0.4),
+        "output_format":    (str, "yolo"),
+        "target":           (str, "cpu"),
+        "max_batch":        (int, 4)
+    }
+
+    @classmethod
+    def available(cls, **kwargs):
+        if not super().available(**kwargs):
+            return False
+        for key in ["model_file", "config_file"]:
+            if kwargs.get(key) and not os.path.exists(kwargs[key]):
+                return False
+        return True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        parameterInitCheck(self.parameter_defs, kwargs, self)
+        assert(self.output_format in ["yolo", "yolov8"])
+        assert(self.target in ["cpu", "opencl", "cuda"])
+
+    def load(self):
+        import cv2
+        import numpy
+        self.cv2 = cv2
+        self.numpy = numpy
+        self.net = cv2.dnn.readNet(self.model_file, self.config_file)
+        if self.target == "cuda":
+            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+        elif self.target == "opencl":
+            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_OPENCL)
+        else:
+            self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.out_names = self.net.getUnconnectedOutLayersNames()
+        self.relative = len(self.config_file) > 0 # darknet models
+        if self.names_file:
+            with open(self.names_file, "r") as f:
+                self.names = [line.strip() for line in f if line.strip()]
+        else:
+            self.names = coco_names
+        if self.letterbox:
+            self.letterboxer = Letterbox(self.input_size, max_batch = self.max_batch)
+        else:
+            self.letterboxer = None
+        self.loaded = True
+
+    def __call__(self, img):
+        return self.batch([img])[0]
+
+    def batch(self, imgs):
+        results = []
+        for i in range(0, len(imgs), self.max_batch):
+            results += self.forward_(imgs[i:i+self.max_batch])
+        return results
+
+    def forward_(self, imgs):
+        # frames from valkka are RGB already: no channel swapping
+        if self.letterboxer is None:
+            blob = self.cv2.dnn.blobFromImages(imgs, 1/255.0, self.input_size, swapRB = False, crop = False)
+            geometries = [None] * len(imgs)
+        else:
+            blob, geometries = self.letterboxer(imgs)
+        self.net.setInput(blob)
+        outs = self.net.forward(self.out_names)
+        # the output layers have either (n_imgs * rows, columns) or (n_imgs, rows, columns) values
+        outs = [out.reshape((len(imgs), -1, out.shape[-1])) if self.output_format == "yolo"
+            else out.reshape((len(imgs), out.shape[-2], out.shape[-1])).transpose((0, 2, 1))
+            for out in outs]
+        return [self.postprocess_([out[n] for out in outs], img, geometries[n]) for n, img in enumerate(imgs)]
+
+    def postprocess_(self, outs, img, geometry = None):
+        numpy = self.numpy
+        rows = numpy.concatenate(outs, axis = 0)
+        if self.output_format == "yolo":
+            scores = rows[:, 5:] * rows[:, 4:5] # class scores times objectness
+        else:
+            scores = rows[:, 4:]
+        classes = scores.argmax(axis = 1)
+        confidences = scores[numpy.arange(len(scores)), classes]
+        ok = confidences >= self.conf_threshold
+        rows, classes, confidences = rows[ok], classes[ok], confidences[ok]
+        if len(rows) < 1:
+            return []
+        # (cx, cy, w, h) => (left, top, right, bottom)
+        boxes = numpy.empty((len(rows), 4), dtype = numpy.float32)
+        boxes[:, 0:2] = rows[:, 0:2] - rows[:, 2:4] / 2
+        boxes[:, 2:4] = rows[:, 0:2] + rows[:, 2:4] / 2
+        h, w = img.shape[0], img.shape[1]
+        if geometry is None: # the image was stretched into the network input
+            if self.relative:
+                boxes *= (w, h, w, h)
+            else:
+                boxes *= (w / self.input_size[0], h / self.input_size[1], w / self.input_size[0], h / self.input_size[1])
+            numpy.clip(boxes, 0, (w, h, w, h), out = boxes)
+        else:
+            if self.relative:
+                boxes *= (self.input_size[0], self.input_size[1], self.input_size[0], self.input_size[1])
+            self.letterboxer.unmap(boxes, geometry)
+        keep = nms(boxes, confidences, self.nms_threshold, classes = classes)
+        boxes = boxes[keep].astype(numpy.int32)
+        n_names = len(self.names)
+        return [
+            (self.names[c] if c < n_names else str(c), p, left, right, top, bottom)
+            for c, p, (left, top, right, bottom) in zip(
+                classes[keep].tolist(),
+                (confidences[keep] * 100).astype(numpy.int32).tolist(),
+                boxes.tolist())
+        ]
+
+    def usesGPU(self):
+        return self.target == "cuda"
+
+    @classmethod
+    def mayUseGPU(cls, **kwargs):
+        return kwargs.get("target", "cpu") == "cuda"
+
+
+backend_classes = {
+    "darknet": DarknetBackend,
+    "opencv": OpenCVDNNBackend
+}
+
+
+# default opencv-dnn setups for the yolo plugins.  Download the darknet cfg & weights files into model_dir
+opencv_yolov3 = {
+    "model_file"    : os.path.join(model_dir, "yolov3.weights"),
+    "config_file"   : os.path.join(model_dir, "yolov3.cfg"),
+    "input_size"    : (416, 416)
+}
+
+opencv_yolov3_tiny = {
+    "model_file"    : os.path.join(model_dir, "yolov3-tiny.weights"),
+    "config_file"   : os.path.join(model_dir, "yolov3-tiny.cfg"),
+    "input_size"    : (416, 416)
+}
+
+opencv_yolov2 = {
+    "model_file"    : os.path.join(model_dir, "yolov2.weights"),
+    "config_file"   : os.path.join(model_dir, "yolov2.cfg"),
+    "input_size"    : (416, 416)
+}
+
+
+# find_spec results by module name, so that the plugins can probe the backends at import without searching the modules again & again
+module_found = {}
+
+
+def moduleFound(module):
+    """Is the python module installed.  Doesn't import it
+    """
+    try:
+        return module_found[module]
+    except KeyError:
+        pass
+    try:
+        found = importlib.util.find_spec(module) is not None
+    except (ImportError, ValueError):
+        found = False
+    module_found[module] = found
+    return found
+
+
+def registerBackend(name, backend_class):
+    """Add your own DetectorBackend subclass
+    """
+    backend_classes[name] = backend_class
+
+
+def availableBackends():
+    """Names of the backends whose python modules are installed
+    """
+    return [name for name, cl in backend_classes.items() if cl.available()]
+
+
+def chooseBackend(preferences):
+    """Returns the first available (name, kwargs) tuple from a list of them, or None
+    """
+    for name, kwargs in preferences:
+        if (name in backend_classes) and backend_classes[name].available(**kwargs):
+            return name, kwargs
+    return None
+
+
+def hasBackend(preferences):
+    """Is any of the backends available
+    """
+    return chooseBackend(preferences) is not None
+
+
+def getBackend(name, **kwargs):
+    """Instantiate a backend.  Call load() on the returned object before using it
+    """
+    return backend_classes[name](**kwargs)
+
+
+def preferredBackend(preferences, verbose = False):
+    """Instantiate the first available backend from a list of (name, kwargs) tuples (the libraries are not loaded yet).  None if none of them is available
+    """
+    choice = chooseBackend(preferences)
+    if choice is None:
+        logger.warning("none of the detector backends %s is available", [name for name, kwargs in preferences])
+        return None
+    name, kwargs = choice
+    logger.info("using detector backend %s", name)
+    return getBackend(name, verbose = verbose, **kwargs)
+
+
+def reserveGPU_MB(preferences, n):
+    """Reserve n MBytes of GPU memory for the preferred backend, if it might use the GPU.  Call in the main process (i.e. at the front-end of the multiprocess), so that the reservations of all analyzers are in the same valkka.live.resources.ResourceProbe
+
+    Returns False if there is not enough GPU memory
+    """
+    choice = chooseBackend(preferences)
+    if choice is None:
+        return True
+    name, kwargs = choice
+    if not backend_classes[name].mayUseGPU(**kwargs):
+        return True
+    ok = resources.reserveGPU_MB(n)
+    logger.debug("reserveGPU_MB: %i MB for %s: %s", n, name, ok)
+    return ok
+
+
+def releaseGPU_MB(preferences, n):
+    """Release a reservation made with reserveGPU_MB (that returned True)
+    """
+    choice = chooseBackend(preferences)
+    if choice is None:
+        return
+    name, kwargs = choice
+    if not backend_classes[name].mayUseGPU(**kwargs):
+        return
+    resources.releaseGPU_MB(n)
+    logger.debug("releaseGPU_MB: %i MB for %s", n, name)
+
+
+class DetectorAnalyzer(Analyzer):
+    """An object detector analyzer.  The detection is done by a DetectorBackend.  If no backend is given, the darknet backend is used with the model of this class
+    """
+
+    model = "yolov3" # for the darknet backend
+
+    parameter_defs = {
+        "verbose": (bool, False),   # :param verbose:  Verbose output or not?  Default: False.
+        "debug": (bool, False),
+        "backend": None             # :param backend:  A DetectorBackend instance.  Default: None (darknet)
+    }
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # checks that kwargs is consistent with parameter_defs.  Attaches
+        # parameters as attributes to self
+        parameterInitCheck(self.parameter_defs, kwargs, self)
+        self.init()
+
+    def init(self):
+        if self.backend is None:
+            self.backend = getBackend("darknet", model = self.model, verbose = self.verbose)
+        if not self.backend.loaded:
+            self.backend.load() # heavy libraries are imported only now
+        self.predictor = self.backend
+        self.reset()
+
+    def reset(self):
+        pass
+
+    def __call__(self, img):
+        self.logger.debug("analyzing frame : %s", img.shape)
+        lis = self.predictor(img)
+        self.logger.debug("finished analyzing frame")
+        return lis
+
+    def batch(self, imgs):
+        return self.predictor.batch(imgs)
+
+    def close(self):
+        self.predictor.close()
+
+
+def benchmark(backend, img, n = 10, batch = 1):
+    """Returns the time per image in milliseconds
+    """
+    if not backend.loaded:
+        backend.load()
+    backend.batch([img] * batch) # warm-up
+    t = time.time()
+    for i in range(n):
+        backend.batch([img] * batch)
+    return (time.time() - t) / (n * batch) * 1000
+
+
+def test1():
+    """Which backends are available
+    """
+    print("available backends:", availableBackends())
+    print("yolov3 with:", chooseBackend([("darknet", {"model": "yolov3"}), ("opencv", opencv_yolov3)]))
+
+
+def test2():
+    """Benchmark the opencv-dnn backend on the cpu
+    """
+    import numpy
+    backend = getBackend("opencv", **opencv_yolov3_tiny)
+    img = numpy.zeros((1080 // 4, 1920 // 4, 3), dtype = numpy.uint8)
+    for batch in [1, 4]:
+        print("batch", batch, "%.1f ms / image" % (benchmark(backend, img, batch = batch)))
+
+
+def test3():
+    """Letterbox & nms
+    """
+    import numpy
+    letterbox = Letterbox((416, 416), max_batch = 2)
+    img1 = numpy.ones((1080 // 4, 1920 // 4, 3), dtype = numpy.uint8) * 200
+    img2 = numpy.ones((416, 208, 3), dtype = numpy.uint8) * 100
+    blob, geometries = letterbox([img1, img2])
+    print("blob", blob.shape, "geometries", [(g.scale, g.pad_x, g.pad_y) for g in geometries])
+    blob_, geometries_ = letterbox([img1, img2])
+    assert(geometries_[0] is geometries[0]) # cached
+    assert(abs(blob[0, 0, 208, 208] - 200/255.0) < 1e-6)
+    assert(abs(blob[0, 0, 0, 0] - 114/255.0) < 1e-6) # padding
+    # a box covering the letterboxed image maps back to the whole image
+    boxes = numpy.array([[0, geometries[0].pad_y, 416, 416 - geometries[0].pad_y]], dtype = numpy.float32)
+    print("unmapped", letterbox.unmap(boxes, geometries[0]))
+
+    boxes = numpy.array([
+        [0, 0, 10, 10],
+        [1, 1, 10, 10], # overlaps the first one
+        [20, 20, 30, 30],
+        [1, 1, 11, 11] # overlaps the first one, but is a different class
+        ], dtype = numpy.float32)
+    scores = numpy.array([0.9, 0.8, 0.7, 0.6])
+    classes = numpy.array([0, 0, 0, 1])
+    keep = nms(boxes, scores, 0.5, classes = classes)
+    print("keep", keep)
+    assert(keep.tolist() == [0, 2, 3])
+    print(fractional([("dog", 99, 10, 20, 30, 40)], (100, 200, 3)))
+
+
+def main():
+    pre = "main :"
+    print(pre, "main: arguments: ", sys.argv)
+    if (len(sys.argv) < 2):
+        print(pre, "main: needs test number")
+    else:
+        st = "test" + str(sys.argv[1]) + "()"
+        exec(st)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -2,8 +2,17 @@
 
 import sys
 import time
+import mmap
+import struct
+import threading
+import queue
 import numpy
 
+# the binary protocol & the shared memory ring buffer layout.  See valkka.mvision.nix.ring
+ring_header = struct.Struct("<4sIIIII") # magic, version, n_cells, cell_size, width, height
+request = struct.Struct("<BxxxIIQII") # command, frame_id, cell index, mstimestamp, width, height
+reply = struct.Struct("<BxxxII") # command, frame_id, payload length
+
 class StdProcess:
     """A class for running machine vision.  
     
@@ -25,6 +34,14 @@ class StdProcess:
 
         ./example_process1.py 1280 720 /tmp/valkka-tmpfile
 
+    Instead of the tmpfile, the frames can be read from a POSIX shared memory ring buffer.  In that case, start the file like this:
+
+    ::
+
+        ./example_process1.py 1280 720 --shmem shmem_name
+
+    and the communication through STDIN and STDOUT uses binary messages instead of text lines (see cycleShmem)
+
     - Once the process has been started, it waits for the STDIN
     - When STDIN receives the string "R\n", the process knows that there is data in the tmpfile
     - Process then reads that tmpfile as a numpy array, does some analysis to that array, and returns the (textual) analysis results by printing them into STDOUT
@@ -35,11 +52,12 @@ class StdProcess:
     Create your own class based on this class (see an example below)
     """
     
-    def __init__(self, width, height, filename, verbose = False):
+    def __init__(self, width, height, filename, verbose = False, shmem_name = None):
         self.pre = self.__class__.__name__+" : "
         self.width = width
         self.height = height
         self.filename = filename
+        self.shmem_name = shmem_name
         self.verbose = verbose
         self.load()
     
@@ -115,6 +133,78 @@ class StdProcess:
                         self.sendReceipt()
                         
             # ok = False # debugging
+
+
+    def openShmem(self):
+        """Map the shared memory ring buffer.  Returns a list of numpy arrays, one per cell
+        """
+        f = open("/dev/shm/" + self.shmem_name, "r+b") # same as shm_open("/" + shmem_name, ..) in C
+        self.shmem = mmap.mmap(f.fileno(), 0)
+        f.close()
+        magic, version, n_cells, cell_size, width, height = ring_header.unpack_from(self.shmem, 0)
+        self.report("ring buffer", magic, version, n_cells, cell_size, width, height)
+        return [
+            numpy.frombuffer(self.shmem, dtype = numpy.uint8, count = cell_size, offset = ring_header.size + i * cell_size)
+            for i in range(n_cells)
+            ]
+
+
+    def sendReply(self, command, frame_id, text = ""):
+        payload = text.encode("utf-8")
+        sys.stdout.buffer.write(reply.pack(ord(command), frame_id, len(payload)) + payload)
+        sys.stdout.buffer.flush()
+
+
+    def readRequests(self, q):
+        """Reads binary requests from STDIN into queue q.  Runs in a separate thread, so that reading STDIN overlaps with the image analysis
+        """
+        stdin = sys.stdin.buffer
+        while True:
+            buf = stdin.read(request.size)
+            if (len(buf) < request.size):
+                self.report("fatal error")
+                q.put(None)
+                break
+            req = request.unpack(buf)
+            q.put(req)
+            if chr(req[0]) == "X":
+                break
+
+
+    def cycleShmem(self):
+        """Like cycle, but reads binary requests from STDIN and the frames from the shared memory ring buffer
+
+        Each request is answered with a binary reply: "C" (no results) or "D" (results as utf-8 text), having the same frame_id as the request.  Valkka may send several frames before getting the results (each one in a different cell), so the requests are read by a separate thread & queued, while this thread analyzes the frames
+        """
+        cells = self.openShmem()
+        q = queue.Queue()
+        reader = threading.Thread(target = self.readRequests, args = (q,), daemon = True)
+        reader.start()
+        while True:
+            req = q.get()
+            if req is None:
+                self.close()
+                break
+            command, frame_id, index, mstimestamp, width, height = req
+            command = chr(command)
+            self.report("got", command, frame_id, index, "queued", q.qsize())
+            if (command == "T"): #      RESET STATE
+                self.reset()
+                self.sendReply("C", frame_id)
+            elif (command == "X"): #    EXIT
+                self.close()
+                break
+            elif (command == "R"): #    READ NEW FRAME
+                # a view into the ring buffer: no copying.  Valid until we send the reply
+                img = cells[index][0:width*height*3].reshape((height, width, 3))
+                result = self.run(img)
+                try:
+                    if (result):
+                        self.sendReply("D", frame_id, result)
+                    else:
+                        self.sendReply("C", frame_id)
+                except IOError:
+                    self.report("could not send data")
         
         
 
@@ -140,17 +230,24 @@ class TestStdProcess(StdProcess):
 
 
 if (__name__ == "__main__"):
-    # arguments needed: width, height, tmpfilename
+    # arguments needed: width, height, tmpfilename or width, height, --shmem, shmem_name
     try:
         width       = int(sys.argv[1])
         height      = int(sys.argv[2])
         filename    = sys.argv[3]
+        shmem_name  = None
+        if filename == "--shmem":
+            filename = None
+            shmem_name = sys.argv[4]
     except Exception as e:
         sys.stderr.write("example_process1.py parameters failed with '"+str(e)+"'\n")
         raise SystemExit()
 
-    p = TestStdProcess(width, height, filename, verbose = False)
-    p.cycle()
+    p = TestStdProcess(width, height, filename, verbose = False, shmem_name = shmem_name)
+    if shmem_name is None:
+        p.cycle()
+    else:
+        p.cycleShmem()
 
     print("example_process1.py : bye!")
 
@@ -0,0 +1,151 @@
+"""
+frame.py : Zero-copy access to the frames in the shared memory ring buffer
+
+Copyright 2018 Sampsa Riikonen
+
+Authors: Sampsa Riikonen
+
+This file is part of the machine vision plugin for the Valkka Live program
+
+This plugin is free software: you can redistribute it and/or modify it under the terms of the MIT License.  This code is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the MIT License for more details.
+
+@file    frame.py
+@author  Sampsa Riikonen
+@date    2018
+@version 1.2.2
+@brief   Zero-copy access to the frames in the shared memory ring buffer
+"""
+import sys
+import numpy
+
+
+class FrameView:
+    """A read-only view into a cell of the shared memory ring buffer
+
+    ::
+
+        index       : index of the ring buffer cell
+        slot        : slot number of the stream
+        mstimestamp : timestamp of the frame in milliseconds
+        width       : frame width
+        height      : frame height
+        img         : numpy array of shape (height, width, 3).  Read-only
+        detached    : True if img is a private copy
+
+    No data is copied when the view is created, so the view is valid only until the ring buffer cell is overwritten by the server, i.e. use it within cycle_.  If you need to keep the frame or modify it, call detach()
+    """
+
+    def __init__(self, index = None, slot = None, mstimestamp = None, img = None, detached = False):
+        self.index = index
+        self.slot = slot
+        self.mstimestamp = mstimestamp
+        self.img = img
+        self.height = img.shape[0]
+        self.width = img.shape[1]
+        self.detached = detached
+
+    @classmethod
+    def fromShmem(cls, shmem_client, index, meta):
+        """Create a view from the index & metadata returned by ShmemRGBClient.pullFrame
+        """
+        img = shmem_client.shmem_list[index][0:meta.size].reshape(
+            (meta.height, meta.width, 3))
+        img.flags.writeable = False # only this view: the shmem array itself is untouched
+        return cls(
+            index       = index,
+            slot        = meta.slot,
+            mstimestamp = meta.mstimestamp,
+            img         = img
+            )
+
+    def __str__(self):
+        return "<FrameView: index %s slot %s mstimestamp %s %ix%i>" % (self.index, self.slot, self.mstimestamp, self.width, self.height)
+
+    def detach(self):
+        """Returns a FrameView that owns a (writable) copy of the frame
+        """
+        return FrameView(
+            index       = self.index,
+            slot        = self.slot,
+            mstimestamp = self.mstimestamp,
+            img         = self.img.copy(),
+            detached    = True
+            )
+
+
+class ScratchBuffer:
+    """A preallocated, reusable image buffer for drawing overlays on top of frames
+
+    ::
+
+        scratch = ScratchBuffer()
+        ...
+        img = scratch(frame) # a writable copy of the frame, in the same buffer each time
+        cv2.line(img, ...)
+
+    The buffer is reallocated only if the frame dimensions change
+    """
+
+    def __init__(self):
+        self.buf = None
+
+    def __call__(self, frame: FrameView):
+        if (self.buf is None) or (self.buf.shape != frame.img.shape):
+            self.buf = numpy.empty(frame.img.shape, dtype = frame.img.dtype)
+        numpy.copyto(self.buf, frame.img)
+        return self.buf
+
+
+def test1():
+    """FrameView over a fake ring buffer
+    """
+    class Meta:
+        pass
+
+    class Client:
+        shmem_list = [numpy.zeros(100*50*3, dtype = numpy.uint8) for i in range(3)]
+
+    meta = Meta()
+    meta.size = 80*40*3
+    meta.width = 80
+    meta.height = 40
+    meta.slot = 1
+    meta.mstimestamp = 123
+
+    client = Client()
+    frame = FrameView.fromShmem(client, 2, meta)
+    print(frame)
+    assert(frame.img.shape == (40, 80, 3))
+    try:
+        frame.img[0, 0, 0] = 1
+    except ValueError:
+        print("read-only ok")
+    else:
+        raise AssertionError("view should be read-only")
+    client.shmem_list[2][0] = 10 # server writes to the cell ..
+    assert(frame.img[0, 0, 0] == 10) # .. which is seen through the view: no copies
+    detached = frame.detach()
+    detached.img[0, 0, 0] = 20
+    assert(client.shmem_list[2][0] == 10)
+
+    scratch = ScratchBuffer()
+    img = scratch(frame)
+    buf = scratch.buf
+    img = scratch(frame)
+    assert(scratch.buf is buf) # no reallocation
+    img[0, 0, 0] = 30
+    assert(frame.img[0, 0, 0] == 10)
+
+
+def main():
+    pre = "main :"
+    print(pre, "main: arguments: ", sys.argv)
+    if (len(sys.argv) < 2):
+        print(pre, "main: needs test number")
+    else:
+        st = "test" + str(sys.argv[1]) + "()"
+        exec(st)
+
+
+if (__name__ == "__main__"):
+    main()
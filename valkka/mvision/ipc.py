@@ -1,49 +1,151 @@
-from valkka import core
-from multiprocessing import Pipe, Event
+import threading
+import time
+import weakref
+from multiprocessing import Pipe
+from valkka.live.tools import getLogger
 
-class IPCElement:
+logger = getLogger(__name__)
 
-    def __init__(self):
-        self.event_fd = core.EventFd()
+
+class IPCError(Exception):
+    pass
+
+
+class IPCSlot:
+    """Communication channel between a client process & a master process
+
+    ::
+
+        pipe1 : client process end
+        pipe2 : master process end
+
+    The pipe is created on demand at the frontend & the ends are sent to the running multiprocesses (see QShmemClientProcess.setMasterProcess), so nothing needs to be inherited when forking.  The pipe is duplex: the client notifies the master about new frames & the master replies with the results
+    """
+
+    def __init__(self, index, owner = None):
+        self.index = index
         self.pipe1, self.pipe2 = Pipe()
-        self.event = Event()
-        self.event.clear()
+        if owner is None:
+            self.owner = None
+        else:
+            self.owner = weakref.ref(owner)
+        self.t_reserve = time.time()
+
+    def leaked(self):
+        # the owner was garbage collected without releasing the slot
+        return (self.owner is not None) and (self.owner() is None)
+
+    def close(self):
+        self.pipe1.close()
+        self.pipe2.close()
 
 
 class IPC:
+    """A growable, thread-safe pool of IPCSlots
+
+    ::
 
-    num = 10
+        i = ipc.reserve(owner = client_process) # creates a new slot, reusing a free index
+        pipe1 = ipc.get1(i)
+        pipe2 = ipc.get2(i)
+        ipc.release(i)
+
+    Slots whose owner has been garbage collected without a call to release are reclaimed (and a warning is logged) at the next reserve
+    """
+
+    max_slots = 1024
 
     def __init__(self):
-        self.lis = []
-        self.indices = []
-        for i in range(self.num):
-            self.lis.append(IPCElement())
-            self.indices.append(i)
+        self.lock = threading.Lock()
+        self.slots = {} # reserved slots by index
+        self.free = [] # free indices
+        self.n = 0 # number of indices created
 
     def get1(self, i):
-        el = self.lis[i]
-        return el.event_fd, el.pipe1
+        return self.slots[i].pipe1
 
     def get2(self, i):
-        el = self.lis[i]
-        return el.event_fd, el.pipe2
-    
-    def reserve(self):
-        return self.indices.pop(0)
+        return self.slots[i].pipe2
+
+    def reserve(self, owner = None):
+        with self.lock:
+            self.reclaim_()
+            if len(self.free) > 0:
+                i = self.free.pop()
+            elif self.n < self.max_slots:
+                i = self.n
+                self.n += 1
+            else:
+                raise IPCError("all %i ipc slots in use" % (self.max_slots))
+            self.slots[i] = IPCSlot(i, owner = owner)
+        return i
 
     def release(self, i):
-        self.indices.append(i)
-    
-    def wait(self, i):
-        el = self.lis[i]
-        el.event.wait()
+        with self.lock:
+            self.release_(i)
+
+    def release_(self, i):
+        try:
+            slot = self.slots.pop(i)
+        except KeyError:
+            logger.warning("release: ipc slot %s not reserved", i)
+            return
+        slot.close() # the multiprocesses have their own copies of the pipe ends
+        self.free.append(i)
+
+    def leaks(self):
+        """Indices of the slots that were never released by their owner
+        """
+        with self.lock:
+            return [i for i, slot in self.slots.items() if slot.leaked()]
+
+    def reclaim_(self):
+        for i in [i for i, slot in self.slots.items() if slot.leaked()]:
+            logger.warning("ipc slot %s leaked (reserved %.0f secs ago): reclaiming", i, time.time() - self.slots[i].t_reserve)
+            self.release_(i)
+
+    def inUse(self):
+        with self.lock:
+            return len(self.slots)
+
+
+def test1():
+    class Owner:
+        pass
+    ipc = IPC()
+    o1 = Owner()
+    o2 = Owner()
+    i1 = ipc.reserve(owner = o1)
+    i2 = ipc.reserve(owner = o2)
+    print(i1, i2, ipc.inUse())
+    ipc.get1(i1).send("hello")
+    print(ipc.get2(i1).recv())
+    ipc.release(i1)
+    assert(ipc.reserve(owner = o1) == i1) # index reused
+    del o2
+    print("leaks", ipc.leaks())
+    assert(ipc.leaks() == [i2])
+    i3 = ipc.reserve()
+    assert(i3 == i2) # leaked slot was reclaimed & reused
+    print("in use", ipc.inUse())
+
 
-    def set(self, i):
-        el = self.lis[i]
-        el.event.set()
+def test2():
+    # client processes migrating between (respawned) master processes: release + reserve, many more times than there are slots
+    class Owner:
+        pass
+    ipc = IPC()
+    owners = [Owner() for i in range(10)]
+    indices = [ipc.reserve(owner = o) for o in owners]
+    for n in range(2 * ipc.max_slots):
+        k = n % len(owners)
+        ipc.release(indices[k]) # QShmemClientProcess.unsetMasterProcess
+        indices[k] = ipc.reserve(owner = owners[k]) # QShmemClientProcess.setMasterProcess
+    print("in use", ipc.inUse(), "created", ipc.n)
+    assert(ipc.inUse() == len(owners))
+    assert(ipc.n == len(owners)) # indices were recycled
 
-    def clear(self, i):
-        el = self.lis[i]
-        el.event.clear()
 
+if (__name__ == "__main__"):
+    test1()
+    test2()
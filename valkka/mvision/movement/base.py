@@ -22,7 +22,6 @@ import sys
 import time
 import os
 import numpy
-import imutils
 import importlib
 import cv2
 import logging
@@ -30,12 +29,16 @@ import logging
 from valkka.api2 import parameterInitCheck, typeCheck
 from valkka.mvision.base import Analyzer
 from valkka.live.multiprocess import MessageObject
+from valkka.live.codec import registerCommand
 from valkka.mvision.multiprocess import test_process, test_with_file, MVisionBaseProcess
 from valkka.live import style
 from valkka.live.tools import getLogger, setLogger
 from valkka.live.qt.widget import SimpleVideoWidget, LineCrossingVideoWidget
 
 
+registerCommand("line_crossing")
+
+
 class MovementVideoWidget(SimpleVideoWidget):
     """Receives QPixMaps to a slot & draws them
 
@@ -76,7 +79,20 @@ class MovementVideoWidget(SimpleVideoWidget):
 
 
 class MovementDetector(Analyzer):
-    """A demo movement detector, written using OpenCV
+    """A demo movement detector, written using OpenCV & numpy
+
+    Each frame is downscaled once & reduced into a single channel (max over the color channels).  All further work is done on that small, single channel image, using buffers that are allocated only when the frame dimensions change:
+
+    ::
+
+        img (h, w, 3) --resize--> small (h', width, 3) --max--> luma (h', width) --blur--> cur (h', width)
+        absdiff(prev, cur) --treshold--> delta (0/1 values)
+        
+    The prev & cur buffers are swapped after each frame, so there are no copies
+
+    If the grid parameter is set, a motion map is calculated as well.  It is a (rows, columns) array with the fraction of moving pixels in each cell, see getMotionMap
+
+    The analysis can be restricted to a region of interest and/or to a band around a line with setRegion.  The masks are rebuilt only when the region or the frame dimensions change: the frame difference is then calculated only inside the bounding box of the region and the moving pixels are counted only at the precomputed pixel indices of the region.  If a line with a unit normal has been set, the analyzer tracks on which side of the line the movement is, see getCrossing
     """
 
     # return values:
@@ -92,7 +108,19 @@ class MovementDetector(Analyzer):
         # :param deadtime: Movement inside this time interval belong to the same event
         "deadtime": (int, 3),
         # :param treshold: How much movement is an event (area of the image place)
-        "treshold": (float, 0.001)
+        "treshold": (float, 0.001),
+        # :param pixel_treshold: Minimum change of a pixel value (0-255) that is considered as movement
+        "pixel_treshold": (int, 100),
+        # :param width: Width of the downscaled image used for the analysis.  Height is calculated from the aspect ratio
+        "width": (int, 500),
+        # :param blur: "gaussian", "box" (integral image box filter) or "none"
+        "blur": (str, "gaussian"),
+        # :param blur_size: Size of the blur kernel in pixels
+        "blur_size": (int, 21),
+        # :param grid: Motion map dimensions (columns, rows).  (0, 0) = no motion map
+        "grid": (tuple, (0, 0)),
+        # :param line_margin: Half-width of the analyzed band around a line, relative to the image width
+        "line_margin": (float, 0.05)
     }
 
     def __init__(self, **kwargs):
@@ -103,55 +131,246 @@ class MovementDetector(Analyzer):
         # self.setDebug()
         if self.debug:
             self.logger.warning("Enabling OpenCV high-gui.  That requires opencv installed with apt-get.  Otherwise, get ready for a segfault..")
+        assert(self.blur in ["gaussian", "box", "none"])
+        if self.blur_size % 2 == 0: # gaussian kernel size must be odd
+            self.blur_size += 1
         self.init()
             
 
     def init(self):
+        self.shape = None # shape of the incoming frames
+        self.roi = None
+        self.line = None
+        self.unitnormal = None
+        self.mask_changed = True
         self.reset()
         
     def reset(self):
         """Reset analyzer state
         """
         self.prevframe = None
+        self.motion_map = None
+        self.line_side = None # side of the line where the movement was seen the last time: -1 or 1
+        self.crossing = 0
         self.wasmoving = False
         self.t0 = 0
         self.ismoving = False
         
     def isMoving(self):
         return self.ismoving
+
+    def getMotionMap(self):
+        """Returns the latest motion map: numpy float array of shape (rows, columns), or None
+
+        If a region has been set, the map covers the bounding box of the region
+        """
+        return self.motion_map
+
+    def getCrossing(self):
+        """Did the movement cross the line in the latest frame.  1 = in the direction of the unit normal, -1 = in the opposite direction, 0 = no crossing
+        """
+        return self.crossing
+
+    def setRegion(self, roi = None, line = None, unitnormal = None):
+        """Restrict the analysis into a region
+
+        :param roi:         Polygon as a list of [x, y] points.  None = the whole image
+        :param line:        A line [[x0, y0], [x1, y1]].  Only a band of width 2*line_margin around the line is analyzed
+        :param unitnormal:  Unit normal [nx, ny] of the line.  Enables line crossing detection
+
+        All coordinates are relative, i.e. between 0 and 1, with y pointing downwards
+        
+        The masks are rebuilt at the next frame
+        """
+        self.roi = roi
+        self.line = line
+        self.unitnormal = unitnormal
+        self.mask_changed = True
+        self.line_side = None
+
+
+    def allocate_(self, shape):
+        """Allocate the work buffers for frames of this shape
+        """
+        self.shape = shape
+        h, w = shape[0], shape[1]
+        if w > self.width:
+            sw, sh = self.width, max(1, round(h * self.width / w))
+            self.dsize = (sw, sh) # cv2 style: (width, height)
+            self.small = numpy.empty((sh, sw, 3), dtype = numpy.uint8)
+        else: # no need to downscale
+            sw, sh = w, h
+            self.dsize = None
+            self.small = None
+        self.luma = numpy.empty((sh, sw), dtype = numpy.uint8)
+        if self.blur == "box":
+            # box filter of size k, evaluated from the integral image, gives only the "valid" part of the image
+            self.k = min(self.blur_size, sw, sh)
+            self.integral = numpy.zeros((sh + 1, sw + 1), dtype = numpy.int32)
+            sw, sh = sw - self.k + 1, sh - self.k + 1
+            self.boxsum = numpy.empty((sh, sw), dtype = numpy.int32)
+        self.cur = numpy.empty((sh, sw), dtype = numpy.uint8)
+        self.prev = numpy.empty((sh, sw), dtype = numpy.uint8)
+        self.mask_changed = True # buildMask_ allocates self.delta
+        self.logger.debug("allocate_ : frame %s analyzed at %ix%i", shape, sw, sh)
+
+
+    def gridSetup_(self):
+        sh, sw = self.delta.shape
+        if self.grid[0] > 0 and self.grid[1] > 0:
+            # cells must be at least one pixel
+            self.grid_ = (min(self.grid[0], sw), min(self.grid[1], sh))
+            self.cell = (sw // self.grid_[0], sh // self.grid_[1])
+        else:
+            self.grid_ = None
+
+
+    def buildMask_(self):
+        """Precompute the bounding box, pixel indices & distances from the line for the region set with setRegion
+        """
+        sh, sw = self.cur.shape
+        self.mask_changed = False
+        self.bbox = None # slices into the prev & cur buffers
+        self.index = None # indices of the region pixels in the flattened delta buffer.  None = all pixels
+        self.side = None # signed distance of the region pixels from the line, along the unit normal
+        self.delta = numpy.empty((sh, sw), dtype = numpy.uint8)
+
+        if (self.roi is not None) or (self.line is not None):
+            mask = numpy.ones((sh, sw), dtype = numpy.uint8)
+            if self.roi is not None:
+                m = numpy.zeros((sh, sw), dtype = numpy.uint8)
+                pts = numpy.array([[x*sw, y*sh] for x, y in self.roi], dtype = numpy.int32)
+                cv2.fillPoly(m, [pts], 1)
+                numpy.bitwise_and(mask, m, out = mask)
+            if self.line is not None:
+                m = numpy.zeros((sh, sw), dtype = numpy.uint8)
+                p0 = (int(self.line[0][0]*sw), int(self.line[0][1]*sh))
+                p1 = (int(self.line[1][0]*sw), int(self.line[1][1]*sh))
+                cv2.line(m, p0, p1, 1, max(1, int(2*self.line_margin*sw)))
+                numpy.bitwise_and(mask, m, out = mask)
+            ys, xs = numpy.nonzero(mask)
+            if len(ys) < 1:
+                self.logger.warning("buildMask_ : empty region: analyzing the whole image")
+            else:
+                y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+                self.bbox = (slice(y0, y1), slice(x0, x1))
+                crop = mask[self.bbox]
+                self.delta = numpy.empty(crop.shape, dtype = numpy.uint8)
+                if not crop.all():
+                    self.index = numpy.flatnonzero(crop)
+                if (self.line is not None) and (self.unitnormal is not None):
+                    yy, xx = numpy.mgrid[y0:y1, x0:x1]
+                    side = (xx / sw - self.line[0][0]) * self.unitnormal[0] + (yy / sh - self.line[0][1]) * self.unitnormal[1]
+                    side = side.ravel()
+                    if self.index is not None:
+                        side = side[self.index]
+                    self.side = side.astype(numpy.float32)
+                self.logger.debug("buildMask_ : region bounding box %s, %i pixels", self.delta.shape, crop.sum())
+        self.gridSetup_()
+
+
+    def boxBlur_(self, src, dst):
+        """Box blur using an integral image.  dst has the dimensions of the "valid" region (see allocate_)
+        """
+        k = self.k
+        h, w = dst.shape
+        i = self.integral
+        numpy.cumsum(src, axis = 0, dtype = numpy.int32, out = i[1:, 1:])
+        numpy.cumsum(i[1:, 1:], axis = 1, out = i[1:, 1:])
+        b = self.boxsum
+        numpy.subtract(i[k:k+h, k:k+w], i[0:h, k:k+w], out = b)
+        numpy.subtract(b, i[k:k+h, 0:w], out = b)
+        numpy.add(b, i[0:h, 0:w], out = b)
+        numpy.floor_divide(b, k * k, out = b)
+        numpy.copyto(dst, b, casting = "unsafe")
+
+
+    def preprocess_(self, img):
+        """Downscale, reduce to one channel & blur the frame into self.cur
+        """
+        if img.dtype != numpy.uint8: # the buffers are uint8.  Frames from shmem are always uint8, so this is for testing only
+            img = numpy.clip(img, 0, 255).astype(numpy.uint8)
+        if (self.shape != img.shape):
+            self.allocate_(img.shape)
+            self.prevframe = None # can't compare with frames of different dimensions
+        if self.dsize is not None:
+            cv2.resize(img, self.dsize, dst = self.small, interpolation = cv2.INTER_NEAREST)
+            numpy.max(self.small, axis = 2, out = self.luma)
+        else:
+            numpy.max(img, axis = 2, out = self.luma)
+
+        if (self.debug):
+            cv2.imshow("SimpleMovementDetector_channels-luma", self.luma)
+
+        if self.blur == "gaussian":
+            cv2.GaussianBlur(self.luma, (self.blur_size, self.blur_size), 0, dst = self.cur)
+        elif self.blur == "box":
+            self.boxBlur_(self.luma, self.cur)
+        else:
+            numpy.copyto(self.cur, self.luma)
+
+
+    def motionMap_(self):
+        cw, ch = self.cell
+        gx, gy = self.grid_
+        cells = self.delta[0:gy*ch, 0:gx*cw].reshape((gy, ch, gx, cw))
+        self.motion_map = cells.sum(axis = (1, 3), dtype = numpy.int32) / (ch * cw)
+
+        
+    def crossingCheck_(self, d, n):
+        """Which side of the line the moving pixels are on
+        """
+        centroid = numpy.dot(d, self.side) / n # mean distance of the moving pixels from the line
+        side = 1 if centroid > 0 else -1
+        if (self.line_side is not None) and (side != self.line_side):
+            self.crossing = side
+            self.logger.info("==> LINE CROSSED %i", side)
+        self.line_side = side
+
         
     def __call__(self, img):
         self.logger.info("got frame : %s",img.shape)
 
         # NOTE: this is where all the image analysis takes place.  Implement your own
-    
-        modframe = imutils.resize(img, width=500)
+        self.preprocess_(img)
+        if self.mask_changed:
+            self.buildMask_()
         self.ismoving = False
+        self.crossing = 0
 
-        if (self.debug):
-            cv2.imshow("SimpleMovementDetector_channels-modframe", modframe)
-
-        modframe = cv2.GaussianBlur(modframe, (21, 21), 0)
-
-        if (self.prevframe.__class__ is None.__class__):  # first frame
-            self.prevframe = modframe.copy()
+        if (self.prevframe is None):  # first frame
+            self.prev, self.cur = self.cur, self.prev
+            self.prevframe = self.prev
             self.logger.info("First image found!")
             result = self.state_same
 
         else:  # second or n:th frame
-            delta = cv2.absdiff(self.prevframe.max(2), modframe.max(2))
+            if self.bbox is None:
+                cv2.absdiff(self.prev, self.cur, dst = self.delta)
+            else: # only the bounding box of the region
+                cv2.absdiff(self.prev[self.bbox], self.cur[self.bbox], dst = self.delta)
             if (self.debug):
-                cv2.imshow("SimpleMovementDetector_channels-delta0", delta)
-            delta = cv2.threshold(delta, 100, 1, cv2.THRESH_BINARY)[
-                1]  # TODO: how much treshold here..?
-            val = delta.sum() / (delta.shape[0] * delta.shape[1])
+                cv2.imshow("SimpleMovementDetector_channels-delta0", self.delta)
+            # pixels that changed more than pixel_treshold are 1, others 0
+            cv2.threshold(self.delta, self.pixel_treshold, 1, cv2.THRESH_BINARY, dst = self.delta)
+            if self.index is None:
+                d = self.delta.ravel() # a view: delta is contiguous
+            else:
+                d = self.delta.ravel()[self.index] # region pixels only
+            n = numpy.count_nonzero(d)
+            val = n / d.size
+            if self.grid_ is not None:
+                self.motionMap_()
             # print(self.pre,"MovementDetector: val=",val)
-            self.prevframe = modframe.copy()
+            self.prev, self.cur = self.cur, self.prev # the current frame becomes the previous one: no copying
+            self.prevframe = self.prev
 
             if (val >= self.treshold):  # one promille ok .. there is movement
                 self.t0 = time.time()
                 self.logger.info("==>MOVEMENT!")
                 self.ismoving = True
+                if self.side is not None:
+                    self.crossingCheck_(d, n)
                 if (self.wasmoving):
                     result = self.state_same
                 else:
@@ -172,7 +391,7 @@ class MovementDetector(Analyzer):
                     result = self.state_same
 
             if (self.debug):
-                cv2.imshow("SimpleMovementDetector_channels-delta", delta * 255)
+                cv2.imshow("SimpleMovementDetector_channels-delta", self.delta * 255)
 
         if (self.debug):
             # cv2.waitKey(40*25) # 25 fps
@@ -203,6 +422,8 @@ class MVisionProcess(MVisionBaseProcess):
     tag  = "movement" # NOTE: name identifying the detector group
     auto_menu = True # append automatically to valkka live machine vision menu or not
     max_instances = 5 # NOTE: how many detectors belonging to the same group can be instantiated
+    shmem_image_dimensions = (160, 90) # NOTE: requested image size.  Movement detection needs only small images
+    shmem_image_interval = 100 # NOTE: requested interval between frames in milliseconds (10 fps)
     # analyzer_video_widget_class = MovementVideoWidget # use this widget class to define parameters for your machine vision (line crossing, zone intrusion, etc.)
     analyzer_video_widget_class = LineCrossingVideoWidget # testing this one ..
 
@@ -215,6 +436,7 @@ class MVisionProcess(MVisionBaseProcess):
         shmem_server = Signal(object) # launched when the mvision process has established a shared mem server
         start_move = Signal()
         stop_move = Signal()
+        line_crossing = Signal(object) # carries the direction: 1 = in the direction of the unit normal, -1 = against it
     #"""
 
     # backend method
@@ -247,27 +469,29 @@ class MVisionProcess(MVisionBaseProcess):
     def cycle_(self):
         # NOTE: enable this to see if your multiprocess is alive
         self.logger.debug("cycle_ starts")
-        index, meta = self.client.pullFrame()
-        if (index is None):
-            self.logger.debug("cycle_ : client timed out..")
-            return
-        
-        self.logger.debug("cycle_ : client index = %s", index)
-        if meta.size < 1:
+        frame = self.pullFrame_()
+        if frame is None:
             return
 
-        data = self.client.shmem_list[index][0:meta.size]
-        img = data.reshape(
-            (meta.height, meta.width, 3))
+        img = frame.img
         """ # WARNING: the x-server doesn't like this, i.e., we're creating a window from a separate python multiprocess, so the program will crash
         print(self.pre,"Visualizing with OpenCV")
         cv2.imshow("openCV_window",img)
         cv2.waitKey(1)
         """
-        self.logger.debug("cycle_ : got frame %s", img.shape)
+        self.logger.debug("cycle_ : got frame %s", frame)
+        if self.parameters_changed:
+            # the analyzer rebuilds its masks at the next frame
+            parameters = self.parameters or {}
+            self.analyzer.setRegion(
+                roi         = parameters.get("roi"),
+                line        = parameters.get("line"),
+                unitnormal  = parameters.get("unitnormal")
+                )
+            self.parameters_changed = False
         result = self.analyzer(img)
 
-        img_ = img.copy()
+        img_ = self.scratch(frame) # overlays are drawn into the per-process scratch buffer
 
         if self.parameters:
             # what we have in parameters, depends on the 
@@ -292,8 +516,8 @@ class MVisionProcess(MVisionBaseProcess):
             # print(">>", img_[0:10])
             self.qt_server.pushFrame(
                 img_,
-                meta.slot,
-                meta.mstimestamp
+                frame.slot,
+                frame.mstimestamp
             )
 
         # NOTE: you could use and combine several analyzers here, say first see if there is movement and then do the rest
@@ -304,6 +528,8 @@ class MVisionProcess(MVisionBaseProcess):
             self.send_out__(MessageObject("start_move"))
         elif (result == MovementDetector.state_stop):
             self.send_out__(MessageObject("stop_move"))
+        if self.analyzer.getCrossing() != 0:
+            self.send_out__(MessageObject("line_crossing", direction = self.analyzer.getCrossing()))
 
 
     # *** create a widget for this machine vision module ***
@@ -318,6 +544,7 @@ class MVisionProcess(MVisionBaseProcess):
         widget.setStyleSheet(style.detector_test)
         self.signals.start_move.connect(lambda : widget.setText("MOVEMENT START"))
         self.signals.stop_move. connect(lambda : widget.setText("MOVEMENT STOP"))
+        self.signals.line_crossing.connect(lambda dic: widget.setText("LINE CROSSED (%+i)" % (dic["direction"])))
         return widget
 
     
@@ -339,6 +566,38 @@ def test1():
     print("\nresult =", result, "\n")
 
 
+def test5():
+    """Box blur & motion map with a moving square
+    """
+    analyzer = MovementDetector(treshold = 0.001, blur = "box", blur_size = 5, grid = (4, 4), width = 240, pixel_treshold = 50)
+    for i in range(10):
+        img = numpy.zeros((1080 // 4, 1920 // 4, 3), dtype = numpy.uint8)
+        img[10:60, 10 + 20*i:60 + 20*i, :] = 255
+        t = time.time()
+        result = analyzer(img)
+        print("result =", result, "moving =", analyzer.isMoving(), "%.2f ms" % ((time.time() - t)*1000))
+    print(analyzer.getMotionMap())
+    assert(analyzer.getMotionMap()[0].sum() > 0) # movement at the top row of the grid
+    assert(analyzer.getMotionMap()[1:].sum() == 0)
+
+
+def test6():
+    """Line crossing: a square moving from left to right over a vertical line
+    """
+    analyzer = MovementDetector(treshold = 0.001, blur = "none", width = 240, pixel_treshold = 50, line_margin = 0.2)
+    # normal points to the right
+    analyzer.setRegion(line = [[0.5, 0.0], [0.5, 1.0]], unitnormal = [1.0, 0.0])
+    crossings = []
+    for i in range(12):
+        img = numpy.zeros((1080 // 4, 1920 // 4, 3), dtype = numpy.uint8)
+        img[100:150, 120 + 20*i:170 + 20*i, :] = 255
+        result = analyzer(img)
+        crossings.append(analyzer.getCrossing())
+    print("crossings", crossings)
+    assert(crossings.count(1) == 1)
+    assert(crossings.count(-1) == 0)
+
+
 def test2():
     """Demo here the OpenCV highgui with valkka
     """
@@ -0,0 +1,143 @@
+"""
+base.py : A movement analyzer multiprocess that serves several streams
+
+Copyright 2018 Sampsa Riikonen
+
+Authors: Sampsa Riikonen
+
+This file is part of the machine vision plugin for the Valkka Live program
+
+This plugin is free software: you can redistribute it and/or modify it under the terms of the MIT License.  This code is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the MIT License for more details.
+
+@file    base.py
+@author  Sampsa Riikonen
+@date    2018
+@version 1.2.2 
+@brief   A movement analyzer multiprocess that serves several streams
+"""
+
+# from valkka.live.qimport import QtWidgets, QtCore, QtGui, Signal, Slot # Qt5
+from valkka.live.qimport import QtWidgets, QtCore, QtGui, Signal, Slot
+import sys
+import time
+
+from valkka.api2 import parameterInitCheck
+from valkka.live.multiprocess import MessageObject
+from valkka.mvision.multiprocess import test_process, test_with_file, QShmemMultiStreamProcess
+from valkka.mvision.movement.base import MovementDetector
+from valkka.live import style
+
+
+class MVisionProcess(QShmemMultiStreamProcess):
+    """Like valkka.mvision.movement.base.MVisionProcess, but a single multiprocess analyzes up to max_streams streams
+
+    Each stream has a MovementDetector of its own.  The outgoing signals carry the slot and the shmem_name of the stream
+    """
+    
+    name = "Multi-Stream Movement Detector" # NOTE: this class member is required, so that Valkka Live can find the class
+    tag  = "movementmulti" # NOTE: name identifying the detector group
+    auto_menu = True # append automatically to valkka live machine vision menu or not
+    max_instances = 2 # NOTE: how many multiprocesses belonging to the same group can be instantiated
+    max_streams = 16 # NOTE: how many streams one multiprocess analyzes
+    shmem_image_dimensions = (160, 90) # NOTE: requested image size.  Movement detection needs only small images
+    shmem_image_interval = 100 # NOTE: requested interval between frames in milliseconds (10 fps)
+
+    class Signals(QtCore.QObject):
+        pong = Signal(object)
+        start_move = Signal(object) # carries slot & shmem_name
+        stop_move = Signal(object)
+
+    parameter_defs = {
+        "verbose" : (bool, False),
+        "deadtime": (int, 1)
+    }
+
+    def __init__(self, name = "MVisionProcess", **kwargs):
+        parameterInitCheck(self.parameter_defs, kwargs, self)
+        super().__init__(name = name)
+        # the widgets of the streams, by shmem_name.  The signals are connected only once & dispatched from here
+        self.widgets = {}
+        self.signals.start_move.connect(self.start_move_slot)
+        self.signals.stop_move.connect(self.stop_move_slot)
+        
+
+    def postActivateStream_(self, stream):
+        # per-stream analyzer state
+        stream.analyzer = MovementDetector(
+            treshold    =0.0001,
+            verbose     =self.verbose,
+            deadtime    =self.deadtime
+        )
+
+    def preDeactivateStream_(self, stream):
+        stream.analyzer.close()
+
+
+    def handleFrame_(self, stream, frame):
+        self.logger.debug("handleFrame_ : %s : got frame %s", stream.shmem_name, frame)
+        result = stream.analyzer(frame.img)
+        if (result == MovementDetector.state_same):
+            pass
+        elif (result == MovementDetector.state_start):
+            self.send_out__(MessageObject("start_move", slot = frame.slot, shmem_name = stream.shmem_name))
+        elif (result == MovementDetector.state_stop):
+            self.send_out__(MessageObject("stop_move", slot = frame.slot, shmem_name = stream.shmem_name))
+
+
+    # *** create a widget for this machine vision module ***
+    def getWidget(self, shmem_name = None):
+        widget = QtWidgets.QLabel("NO MOVEMENT YET")
+        widget.setStyleSheet(style.detector_test)
+        self.widgets[shmem_name] = widget
+        return widget
+
+    def releaseWidget(self, shmem_name = None):
+        self.widgets.pop(shmem_name, None)
+
+    def setText_(self, message_object, text):
+        try:
+            widget = self.widgets[message_object["shmem_name"]]
+        except KeyError: # the stream has been removed meanwhile
+            return
+        widget.setText(text)
+
+    def start_move_slot(self, message_object):
+        self.setText_(message_object, "MOVEMENT START")
+
+    def stop_move_slot(self, message_object):
+        self.setText_(message_object, "MOVEMENT STOP")
+
+    
+def test1():
+    """Test the multiprocess
+    """
+    test_process(MVisionProcess)
+
+    
+def test2():
+
+    if (len(sys.argv) > 2):
+        init_filename = sys.argv[2]
+    else:
+        init_filename = None
+
+    test_with_file(
+        MVisionProcess, 
+        ["valkka.mvision"],
+        shmem_image_interval = 10,
+        init_filename = init_filename)
+
+
+
+def main():
+    pre = "main :"
+    print(pre, "main: arguments: ", sys.argv)
+    if (len(sys.argv) < 2):
+        print(pre, "main: needs test number")
+    else:
+        st = "test" + str(sys.argv[1]) + "()"
+        exec(st)
+
+
+if (__name__ == "__main__"):
+    main()
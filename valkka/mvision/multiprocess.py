@@ -19,8 +19,11 @@ This plugin is free software: you can redistribute it and/or modify it under the
 # from valkka.live.qimport import QtWidgets, QtCore, QtGui, Signal, Slot # Qt5
 from valkka.live.qimport import QtWidgets, QtCore, QtGui, Signal, Slot
 import sys
+import os
 import time
 import logging
+from collections import deque
+from multiprocessing import reduction
 from setproctitle import setproctitle
 
 # from valkka.api2 import ValkkaProcess, Namespace, ShmemRGBClient, ShmemRGBServer
@@ -30,6 +33,7 @@ from valkka.api2.tools import *
 from valkka.live.multiprocess import MessageObject, safe_select, QMultiProcess
 from valkka.live import singleton as live_singleton
 from valkka.mvision import singleton as mvision_singleton
+from valkka.mvision.frame import FrameView, ScratchBuffer
 
 
 logger = getLogger(__name__)
@@ -50,6 +54,7 @@ logger = getLogger(__name__)
         QShmemMasterProcess
         QShmemClientProcess
             MVisionClientBaseProcess
+        QShmemMultiStreamProcess
         MVisionBaseProcess
 
 
@@ -106,6 +111,26 @@ class QShmemProcess(QMultiProcess):
     """
     timeout = 1.0
 
+    # frame-drop policy, in the case the analyzer is slower than the incoming frames:
+    # "fifo"   : analyze all frames in the ring buffer, one by one.  Latency grows if the analyzer can't keep up
+    # "latest" : skip to the newest frame in the ring buffer
+    # "nth"    : analyze only every frame_nth:th frame
+    frame_policy = "fifo"
+    frame_nth = 1
+    frame_stats_interval = 10.0 # how often (seconds) frame statistics are logged
+    pending_frames_warned = False # see pendingFrames_
+
+    max_streams = 1 # how many streams one multiprocess analyzes.  See QShmemMultiStreamProcess
+
+    # requested shmem image geometry.  None = use the default of the filterchain.  See MultiForkFilterchain.getShmem
+    shmem_image_dimensions = None # (width, height)
+    shmem_image_interval = None # milliseconds between frames
+    shmem_n_buffer = None # ring-buffer size
+
+    # restored after a crash by valkka.live.multiprocess.Supervisor
+    replay_commands = ["activate"]
+    replay_cancel = {"deactivate": ["activate"]}
+
     class Signals(QtCore.QObject):
         pong = Signal(object) # demo outgoing signal
 
@@ -144,6 +169,7 @@ class QShmemProcess(QMultiProcess):
         self.n_buffer = n_buffer
         self.image_dimensions = image_dimensions
         
+        self.resetFrameStats_()
         self.postActivate_()
         
 
@@ -169,6 +195,7 @@ class QShmemProcess(QMultiProcess):
     def __init__(self, name = "QShmemProcess", **kwargs):
         super().__init__(name)
         parameterInitCheck(QShmemProcess.parameter_defs, kwargs, self)
+        self.scratch = ScratchBuffer() # for drawing overlays on top of the frames
         """
         if self.shmem_name is None:
             self.shmem_name = "valkkashmemclient"+str(id(self))
@@ -182,6 +209,7 @@ class QShmemProcess(QMultiProcess):
         self.logger.debug("preRun_")
         if hasattr(self, "tag"):
             setproctitle("valkka-"+self.tag)
+        self.resetFrameStats_()
         self.c__deactivate() # init variables
         
 
@@ -207,27 +235,88 @@ class QShmemProcess(QMultiProcess):
 
         self.postRun_()
         # indicate front end qt thread to exit
-        self.back_pipe.send(None)
+        self.send_out__(None)
         self.logger.debug("bye!")
 
 
-    def cycle_(self):
-        """Receives frames from the shmem client and does something with them
+    def pullFrame_(self, client = None, n_pending = None):
+        """Pull the next frame from a shmem client (default: self.client), obeying frame_policy
 
-        Typically launch qt signals
+        :param n_pending:   Number of frames known to be waiting in the ring buffer after the next one (say, counted from an EventFd).  Default: ask the shmem client (see pendingFrames_)
+
+        Returns a read-only FrameView into the ring buffer or None if the client timed out, the frame was empty or the frame was dropped
         """
-        index, meta = self.client.pullFrame()
+        if client is None:
+            client = self.client
+        index, meta = client.pullFrame()
         if (index is None):
             self.logger.debug("Client timed out..")
-            return
-        
+            return None
         self.logger.debug("Client index = %s", index)
+        self.n_frames += 1
+
+        if self.frame_policy == "latest":
+            # the frames that have piled up in the ring buffer are older than this one: skip them
+            if n_pending is None:
+                n_pending = self.pendingFrames_(client)
+            for i in range(n_pending):
+                index_, meta_ = client.pullFrame()
+                if index_ is None:
+                    break
+                index, meta = index_, meta_
+                self.n_frames += 1
+                self.n_dropped += 1
+        elif self.frame_policy == "nth":
+            if (self.n_frames % self.frame_nth) != 0:
+                self.n_dropped += 1
+                self.logFrameStats_()
+                return None
+
+        self.logFrameStats_()
         if meta.size < 1:
+            return None
+        return FrameView.fromShmem(client, index, meta)
+
+
+    def pendingFrames_(self, client):
+        """Number of frames waiting in the ring buffer of a shmem client
+        """
+        try:
+            return max(0, client.core.getValue())
+        except AttributeError: # libValkka without the semaphore value API
+            if not self.pending_frames_warned:
+                self.logger.warning("pendingFrames_: libValkka has no semaphore value API: frame policy %s behaves like fifo", self.frame_policy)
+                self.pending_frames_warned = True
+            return 0
+
+
+    def resetFrameStats_(self):
+        self.n_frames = 0 # frames pulled from the ring buffer
+        self.n_dropped = 0 # frames skipped because of the frame-drop policy
+        self.t_frame_stats = time.time()
+
+
+    def logFrameStats_(self):
+        t = time.time()
+        if (t - self.t_frame_stats) < self.frame_stats_interval:
             return
+        if self.n_dropped > 0:
+            self.logger.info("frame policy %s: dropped %i of %i frames in %.1f secs", 
+                self.frame_policy, self.n_dropped, self.n_frames, t - self.t_frame_stats)
+        self.n_frames = 0
+        self.n_dropped = 0
+        self.t_frame_stats = t
+
+
+    def cycle_(self):
+        """Receives frames from the shmem client and does something with them
 
-        data = self.client.shmem_list[index][0:meta.size]
-        img = data.reshape(
-            (meta.height, meta.width, 3))
+        Typically launch qt signals
+        """
+        frame = self.pullFrame_()
+        if frame is None:
+            return
+        img = frame.img
         """ # WARNING: the x-server doesn't like this, i.e., we're creating a window from a separate python multiprocess, so the program will crash
         print(self.pre,"Visualizing with OpenCV")
         cv2.imshow("openCV_window",img)
@@ -276,67 +365,139 @@ class QShmemProcess(QMultiProcess):
 class QShmemMasterProcess(QShmemProcess):
 
     max_clients = 999 # how many clients can register to this master process
+
+    # batching: frames from clients that become ready within batch_window seconds are analyzed
+    # with a single handleBatch_ call.  max_batch = 1 means no batching
+    max_batch = 1
+    batch_window = 0.01
+    register_timeout = 5.0 # how long to wait for a client process to create its shmem server.  See c__registerClient
+    # one frame is pulled per notification from a client process: the client processes apply their frame_policy
+    frame_policy = "fifo"
+
+    # load balancing between several master processes: the backend reports its load every load_interval seconds
+    # a master process is saturated if the mean latency (ms) exceeds saturation_latency
+    load_interval = 2.0
+    saturation_latency = 500.0
+
+    class Signals(QtCore.QObject):
+        pong = Signal(object) # demo outgoing signal
+        load = Signal(object) # latency & queue depth of the master process
     
     class Client:
-        def __init__(self, fd = None, pipe = None, shmem_client = None):
+        def __init__(self, fd = None, pipe = None, shmem_client = None, ipc_index = None, shmem_pars = None, deadline = None):
             self.fd = fd
             self.pipe = pipe
             self.shmem_client = shmem_client
+            self.ipc_index = ipc_index
+            # for a pending client: ShmemRGBClient parameters & the time by which the client process should be ready
+            self.shmem_pars = shmem_pars
+            self.deadline = deadline
+            # metrics
+            self.n_frames = 0
+            self.latency = 0.0 # sum of latencies: from the frame becoming available until sending the reply
+            self.t_stats = time.time()
 
 
     def c__registerClient(self,
         n_buffer:int = None, 
         image_dimensions:tuple = None, 
         shmem_name:str = None,
-        ipc_index:int = None):
-        """Shared mem info is given.  Now we can create the shmem client
+        ipc_index:int = None,
+        pipe = None):
+        """Shared mem info is given.  The shmem client is created once the client process has created the shmem server
 
         There can be several shmem clients
-        """
-        self.logger.debug("c__registerClient")
-
-        event_fd, pipe = mvision_singleton.ipc.get2(ipc_index)
-        mvision_singleton.ipc.wait(ipc_index) # wait till the shmem server has been created
-        # this flag is controlled by QShmemClientProcess.c__setMasterProcess
-        mvision_singleton.ipc.clear(ipc_index)
-        shmem_client = ShmemRGBClient(
-                name            =shmem_name,
-                n_ringbuffer    =n_buffer,   # size of ring buffer
-                width           =image_dimensions[0],
-                height          =image_dimensions[1],
-                # client timeouts if nothing has been received in 1000 milliseconds
-                mstimeout   =1000,
-                verbose     =False
-                )
-        shmem_client.useEventFd(event_fd)
 
-        fd = event_fd.getFd()
+        pipe is the master end of an IPCSlot (see valkka.mvision.ipc)
 
-        client = self.Client(
+        The client is pending until its process sends "ready" through the pipe (see QShmemClientProcess.c__setMasterProcess).  That is handled in the main select loop (see registerPending__), so that the other clients are not stalled meanwhile
+        """
+        self.logger.debug("c__registerClient")
+        fd = pipe.fileno()
+        self.pending[fd] = self.Client(
             fd = fd,
             pipe = pipe,
-            shmem_client = shmem_client
+            ipc_index = ipc_index,
+            shmem_pars = {
+                "name"          : shmem_name,
+                "n_ringbuffer"  : n_buffer,
+                "width"         : image_dimensions[0],
+                "height"        : image_dimensions[1]
+                },
+            deadline = time.time() + self.register_timeout
             )
-
-        self.clients[ipc_index] = client
-        self.clients_by_fd[fd] = client
-        self.logger.debug("c__registerClient: fd=%s", fd)
         self.rlis.append(fd)
 
+
+    def registerPending__(self, client):
+        """The pipe of a pending client is readable: the shmem server is ready
+        """
+        self.pending.pop(client.fd)
+        try:
+            client.pipe.recv() # "ready"
+        except EOFError:
+            self.logger.warning("registerPending__: client %s closed the pipe before registering", client.ipc_index)
+            self.rlis.remove(client.fd)
+            client.pipe.close()
+            return
+        client.shmem_client = ShmemRGBClient(
+                verbose     =False,
+                # client timeouts if nothing has been received in 1000 milliseconds
+                mstimeout   =1000,
+                **client.shmem_pars
+                )
+        client.shmem_pars = None
+        client.deadline = None
+        self.clients[client.ipc_index] = client
+        self.clients_by_fd[client.fd] = client
+        self.logger.debug("registerPending__: fd=%s", client.fd)
+
         if len(self.clients) == 1:
-            self.logger.debug("c__registerClient: first client registered")
+            self.logger.debug("registerPending__: first client registered")
             self.firstClientRegistered_()
 
-        self.logger.debug("c__registerClient: number of clients is %s", len(self.clients))
+        self.logger.debug("registerPending__: number of clients is %s", len(self.clients))
+
+
+    def expirePending__(self, t):
+        for client in [client for client in self.pending.values() if t > client.deadline]:
+            self.logger.critical("expirePending__: client %s did not create the shmem server", client.ipc_index)
+            self.pending.pop(client.fd)
+            self.rlis.remove(client.fd)
+            client.pipe.close()
 
 
     def c__unregisterClient(self, ipc_index = None):
-        client = self.clients.pop(ipc_index)
-        self.clients_by_fd.pop(client.fd)
-        self.rlis.remove(client.fd)
-        client.pipe.send(None)
+        for client in list(self.pending.values()):
+            if client.ipc_index == ipc_index: # never got ready
+                self.pending.pop(client.fd)
+                self.rlis.remove(client.fd)
+                client.pipe.close()
+                return
+        client = self.clients.get(ipc_index)
+        if client is None:
+            # i.e. this master process has been respawned & lost its clients, or the client process died & was removed
+            # in handleClientBatch__.  The IPC pool lives in the main process: the IPCSlot is released by the client process frontend
+            # in any case (see QShmemClientProcess.unsetMasterProcess), so there's nothing to release here
+            self.logger.warning("c__unregisterClient: no client with ipc_index %s", ipc_index)
+            return
+        try:
+            client.pipe.send(None)
+        except OSError: # client process has closed the pipe already
+            pass
+        self.removeClient__(client)
+
+
+    def removeClient__(self, client):
+        """Forget a client: stop listening to its pipe & close the master end of the pipe
+        """
+        self.clients.pop(client.ipc_index, None)
+        self.clients_by_fd.pop(client.fd, None)
+        if client.fd in self.rlis:
+            self.rlis.remove(client.fd)
+        client.pipe.close()
         if len(self.clients) == 0:
-            self.logger.debug("c__unregisterClient: last client unregistered")
+            self.logger.debug("removeClient__: last client unregistered")
             self.lastClientUnregistered_()
 
 
@@ -348,20 +509,57 @@ class QShmemMasterProcess(QShmemProcess):
         super().__init__(name)
         parameterInitCheck(QShmemMasterProcess.parameter_defs, kwargs, self)
         self.n_clients = 0 # a front-end variable
+        # load as reported by the backend.  Front-end variables
+        self.latency = 0.0
+        self.queue = 0.0
+        self.signals.load.connect(self.load_slot)
 
 
     def preRun_(self):
         self.logger.debug("preRun_")
         if hasattr(self, "tag"):
             setproctitle("valkka-"+self.tag)
+        self.resetFrameStats_()
         self.clients = {}
         self.clients_by_fd = {}
+        self.pending = {} # clients whose shmem server is not ready yet, by fd
         self.rlis = [self.back_pipe]
+        self.resetLoad__()
+
+
+    def resetLoad__(self):
+        self.load_n = 0 # number of frames handled
+        self.load_latency = 0.0 # sum of latencies
+        self.load_queue = 0 # sum of the number of clients waiting at each round
+        self.load_rounds = 0
+        self.t_load = time.time()
+
+
+    def reportLoad__(self):
+        t = time.time()
+        dt = t - self.t_load
+        if dt < self.load_interval:
+            return
+        latency = 0.0
+        queue = 0.0
+        if self.load_n > 0:
+            latency = 1000 * self.load_latency / self.load_n
+        if self.load_rounds > 0:
+            queue = self.load_queue / self.load_rounds
+        self.send_out__(MessageObject("load",
+            latency = latency,
+            queue   = queue,
+            fps     = self.load_n / dt
+            ))
+        self.resetLoad__()
 
 
     def postRun_(self):
         """Clear shmem variables
         """
+        for client in self.pending.values():
+            client.pipe.close()
+        self.pending = {}
         self.clients = {}
         self.lastClientUnregistered_()
 
@@ -383,33 +581,116 @@ class QShmemMasterProcess(QShmemProcess):
 
             if self.back_pipe in rlis:
                 rlis.remove(self.back_pipe)
-                obj = self.back_pipe.recv()
+                obj = self.recv_in__()
                 self.routeMainPipe__(obj)
 
+            t = time.time()
+            self.expirePending__(t)
+            ready = []
             for fd in rlis:
                 self.logger.debug("run: handling %s", fd)
+                if fd in self.pending:
+                    self.registerPending__(self.pending[fd])
+                    continue
                 # an fd removed from clients_by_fd might still be in rlis... routeMainPipe__ => c__unregisterClient => clients_by_fd modified
                 try:
-                    client = self.clients_by_fd[fd]
+                    ready.append((self.clients_by_fd[fd], t))
                 except KeyError:
                     pass
-                else:
-                    reply = self.handleFrame_(client.shmem_client)
-                    client.pipe.send(reply)
+
+            if len(ready) > 0:
+                self.load_queue += len(ready)
+                self.load_rounds += 1
+            self.reportLoad__()
+
+            if len(ready) < 1:
+                pass
+            elif self.max_batch > 1:
+                self.handleClientBatch__(self.collectBatch__(ready))
+            else:
+                for client_t in ready:
+                    self.handleClientBatch__([client_t])
 
         self.postRun_()
         # indicate front end qt thread to exit
-        self.back_pipe.send(None)
+        self.send_out__(None)
         self.logger.debug("run: bye!")
 
 
-    def handleFrame_(self, shmem_client):
-        """Receives frames from the shmem client.  Reply with results
+    def collectBatch__(self, ready):
+        """Wait at most batch_window for more clients to become ready.  Returns at most max_batch (client, time) tuples
+        """
+        t_end = ready[0][1] + self.batch_window
+        n_max = min(self.max_batch, len(self.clients))
+        while len(ready) < n_max:
+            timeout = t_end - time.time()
+            if timeout <= 0:
+                break
+            got = [client for client, t in ready]
+            waiting = [client.fd for client in self.clients.values() if client not in got]
+            r, w, e = safe_select(waiting, [], [], timeout = timeout)
+            t = time.time()
+            for fd in r:
+                ready.append((self.clients_by_fd[fd], t))
+        # the rest of the ready clients (if any) stay readable & are handled in the next round
+        return ready[:self.max_batch]
+
+
+    def handleClientBatch__(self, ready):
+        frames = []
+        for client, t_ready in ready:
+            try:
+                client.pipe.recv() # new frame notification
+            except EOFError: # client process is gone: an EOF'd pipe would be readable forever
+                self.logger.warning("handleClientBatch__: client %s has closed the pipe: removing it", client.ipc_index)
+                self.removeClient__(client)
+                frames.append(None)
+                continue
+            frames.append(self.pullFrame_(client.shmem_client))
+        self.logger.debug("handleClientBatch__: batch of %i", len(frames))
+        replies = self.handleBatch_(frames)
+        for (client, t_ready), frame, reply in zip(ready, frames, replies):
+            if frame is None: # nothing to reply to
+                continue
+            # scatter the results back to the clients.  Client matches the reply to the frame it sent by slot & timestamp
+            try:
+                client.pipe.send((frame.slot, frame.mstimestamp, reply))
+            except OSError:
+                self.logger.warning("handleClientBatch__: could not reply to client %s", client.ipc_index)
+                continue
+            self.clientStats__(client, t_ready)
+
+
+    def clientStats__(self, client, t_ready):
+        t = time.time()
+        client.n_frames += 1
+        client.latency += t - t_ready
+        self.load_n += 1
+        self.load_latency += t - t_ready
+        dt = t - client.t_stats
+        if dt < self.frame_stats_interval:
+            return
+        self.logger.info("client %s: %.1f frames/sec, mean latency %.1f ms", 
+            client.ipc_index, client.n_frames / dt, 1000 * client.latency / client.n_frames)
+        client.n_frames = 0
+        client.latency = 0.0
+        client.t_stats = t
+
+
+    def handleFrame_(self, frame):
+        """Receives a frame (FrameView) from a shmem client.  Reply with results
         """
-        index, meta = shmem_client.pullFrame()
-        if meta.size < 1:
-            return None
         return "kokkelis"
+
+
+    def handleBatch_(self, frames):
+        """Receives a batch of frames from the shmem clients (see max_batch).  Reply with results
+
+        :param frames: A list of FrameView instances (or None for an empty frame)
+
+        Returns a list of replies, one per frame.  By default, calls handleFrame_ for each frame.  Override this if your analyzer can do batched inference
+        """
+        return [None if frame is None else self.handleFrame_(frame) for frame in frames]
         
 
     def postActivate_(self):
@@ -455,11 +736,44 @@ class QShmemMasterProcess(QShmemProcess):
         return self.n_clients < self.max_clients
 
 
+    def inUse(self):
+        return self.n_clients > 0
+
+
+    def loadScore(self):
+        """Used to choose the least loaded master process (see valkka.live.multiprocess.ProcessPool.getShared)
+        """
+        return (self.latency, self.queue, self.n_clients)
+
+
+    def saturated(self):
+        return self.latency > self.saturation_latency
+
+
+    def load_slot(self, message_object):
+        self.latency = message_object["latency"]
+        self.queue = message_object["queue"]
+        self.logger.debug("load_slot: latency %.1f ms, queue %.1f, %.1f fps", self.latency, self.queue, message_object["fps"])
+
+
+    def respawn(self):
+        # the new multiprocess has no clients: they register again in QShmemClientProcess.peerRespawned
+        self.n_clients = 0
+        self.latency = 0.0
+        self.queue = 0.0
+        super().respawn()
+
+
 
 class QShmemClientProcess(QShmemProcess):
     """Like QShmemProcess, but uses a common master process
+
+    Frames are sent to the master process without waiting for the results: at most max_in_flight requests can be waiting for a reply.  Replies are matched to the requests by slot & timestamp and handled in handleReply_
     """
 
+    max_in_flight = 2 # max number of frames sent to the master process that are waiting for a reply
+    in_flight_timeout = 2.0 # forget a request if there's no reply in this many seconds
+
     """
     def c__setMasterProcess(self, 
             ipc_index = None,
@@ -467,10 +781,13 @@ class QShmemClientProcess(QShmemProcess):
             image_dimensions = None,
             shmem_name = None):
     """
-    def c__setMasterProcess(self, ipc_index = None):
-        # get shmem parameters from master process frontend
+    def c__setMasterProcess(self, ipc_index = None, pipe = None):
+        """pipe is the client end of an IPCSlot (see valkka.mvision.ipc)
+        """
         self.ipc_index = ipc_index
-        self.eventfd, self.master_pipe = mvision_singleton.ipc.get1(self.ipc_index)
+        self.seq = 0
+        self.in_flight = deque() # requests sent to the master process: tuples (seq, slot, mstimestamp, time)
+        self.master_pipe = pipe
         # self.n_buffer etc. have been set by a call to c__activate
         self.server = ShmemRGBServer(
             name            =self.shmem_name_server,
@@ -479,15 +796,16 @@ class QShmemClientProcess(QShmemProcess):
             height          =self.image_dimensions[1],
             verbose         =self.shmem_verbose
             )        
-        self.server.useEventFd(self.eventfd) # activate eventfd API
-        mvision_singleton.ipc.set(ipc_index)
+        self.master_pipe.send("ready") # master process can now create the shmem client
 
 
     def c__unsetMasterProcess(self):
         # mvision_singleton.ipc.release(self.ipc_index) # not here
+        self.in_flight = deque()
         self.server = None
+        if self.master_pipe is not None:
+            self.master_pipe.close()
         self.master_pipe = None
-        self.eventfd = None
 
     # ****
 
@@ -503,6 +821,7 @@ class QShmemClientProcess(QShmemProcess):
         self.logger.debug("preRun_")
         if hasattr(self, "tag"):
             setproctitle("valkka-"+self.tag)
+        self.resetFrameStats_()
         self.c__deactivate() # init variables
         self.c__unsetMasterProcess()
 
@@ -526,7 +845,7 @@ class QShmemClientProcess(QShmemProcess):
 
         self.postRun_()
         # indicate front end qt thread to exit
-        self.back_pipe.send(None)
+        self.send_out__(None)
         self.logger.debug("bye!")
 
 
@@ -535,28 +854,80 @@ class QShmemClientProcess(QShmemProcess):
         processing to a master process
         """
         # get rgb frame from the filterchain
-        index, meta = self.client.pullFrame()
-        if (index is None):
-            self.logger.debug("Client timed out..")
+        frame = self.pullFrame_()
+        if frame is not None:
+            # forward rgb frame to master process (yolo etc.)
+            self.logger.debug("cycle_: got frame %s", frame)
+            self.pushToMaster_(frame)
+        # receive results from master process, if any
+        self.readReplies_()
+
+
+    def pushToMaster_(self, frame):
+        """Send a frame to the master process without waiting for the reply
+
+        Returns the sequence number of the request or None if the frame was not sent (no master process or too many requests in flight)
+        """
+        if self.server is None:
+            return None
+        if len(self.in_flight) >= self.max_in_flight:
+            self.logger.debug("pushToMaster_: %i requests in flight: skipping frame", len(self.in_flight))
+            return None
+        self.logger.debug("pushToMaster_ : pushing to server")
+        self.server.pushFrame(
+            frame.img,
+            frame.slot,
+            frame.mstimestamp
+        )
+        try:
+            self.master_pipe.send((frame.slot, frame.mstimestamp)) # notify the master process
+        except OSError:
+            self.logger.warning("pushToMaster_: master process has closed the pipe")
+            self.c__unsetMasterProcess()
+            return None
+        self.seq += 1
+        self.in_flight.append((self.seq, frame.slot, frame.mstimestamp, time.time()))
+        return self.seq
+
+
+    def readReplies_(self):
+        """Read all available replies from the master process & call handleReply_ for each one of them
+        """
+        if self.master_pipe is None:
             return
-        
-        self.logger.debug("Client index, size = %s", index)
-        data = self.client.shmem_list[index][0:meta.size]
-        img = data.reshape(
-            (meta.height, meta.width, 3))
-        # forward rgb frame to master process (yolo etc.)
-        self.logger.debug("cycle_: got frame %s", img.shape)
-
-        if self.server is not None:
-            self.logger.debug("cycle_ : pushing to server")
-            self.server.pushFrame(
-                img,
-                meta.slot,
-                meta.mstimestamp
-            )
-            # receive results from master process
-            message = self.master_pipe.recv()
-            print("reply from master process:", message)
+        t = time.time()
+        # forget requests the master process never answers (say, it dropped the frame)
+        while len(self.in_flight) > 0 and (t - self.in_flight[0][3]) > self.in_flight_timeout:
+            seq, slot, mstimestamp, t_ = self.in_flight.popleft()
+            self.logger.debug("readReplies_: request %s timed out", seq)
+
+        while self.master_pipe.poll(0):
+            try:
+                message = self.master_pipe.recv()
+            except EOFError:
+                self.logger.warning("readReplies_: master process has closed the pipe")
+                self.c__unsetMasterProcess()
+                return
+            if message is None: # sent when the master process unregisters this client
+                continue
+            slot, mstimestamp, reply = message
+            for i, request in enumerate(self.in_flight):
+                if request[1] == slot and request[2] == mstimestamp:
+                    break
+            else:
+                self.logger.debug("readReplies_: stale reply for %s, %s", slot, mstimestamp)
+                continue
+            # replies come in order: requests older than this one will not be answered
+            for j in range(i):
+                self.in_flight.popleft()
+            seq, slot, mstimestamp, t_ = self.in_flight.popleft()
+            self.handleReply_(seq, slot, mstimestamp, reply)
+
+
+    def handleReply_(self, seq, slot, mstimestamp, reply):
+        """A reply from the master process for the frame sent with sequence number seq.  Overwrite in child classes
+        """
+        self.logger.debug("reply from master process: %s", reply)
 
 
     # *** frontend ***
@@ -564,17 +935,19 @@ class QShmemClientProcess(QShmemProcess):
     def setMasterProcess(self, master_process = None):
         # ipc_index, n_buffer, image_dimensions, shmem_name # TODO
         self.master_process = master_process
-        self.ipc_index = mvision_singleton.ipc.reserve()
+        self.ipc_index = mvision_singleton.ipc.reserve(owner = self)
 
-        # first, create the server
+        # first, create the server.  The pipe ends are sent to the multiprocesses
         self.sendMessageToBack(MessageObject(
             "setMasterProcess", 
-            ipc_index = self.ipc_index))
+            ipc_index = self.ipc_index,
+            pipe = mvision_singleton.ipc.get1(self.ipc_index)))
 
         # this will create the client:
         # self.n_buffer etc. have been set by call to self.activate
         master_process.registerClient(
             ipc_index = self.ipc_index,
+            pipe = mvision_singleton.ipc.get2(self.ipc_index),
             n_buffer = self.n_buffer,
             image_dimensions = self.image_dimensions,
             shmem_name = self.shmem_name_server)
@@ -591,11 +964,37 @@ class QShmemClientProcess(QShmemProcess):
         self.master_process.unregisterClient(
             ipc_index = self.ipc_index
         )
+        # always released here, also when the master process has been respawned & has forgotten this client
+        # (peerRespawned => migrateMasterProcess), so the slots don't run out.  See valkka.mvision.ipc.test2
         mvision_singleton.ipc.release(self.ipc_index)
         self.ipc_index = None
         self.master_process = None
 
 
+    def respawn(self):
+        super().respawn()
+        self.resetMasterProcess_()
+
+
+    def peerRespawned(self, process):
+        if process is self.master_process:
+            self.resetMasterProcess_()
+
+
+    def resetMasterProcess_(self):
+        # the shmem server / client pair between this process & the master process must be created again
+        if self.master_process is None:
+            return
+        self.migrateMasterProcess(self.master_process)
+
+
+    def migrateMasterProcess(self, master_process):
+        """Move this client process to another master process (or re-register to the same one)
+        """
+        self.unsetMasterProcess()
+        self.setMasterProcess(master_process)
+
+
     def requestStop(self):
         self.unsetMasterProcess()
         super().requestStop()
@@ -622,10 +1021,239 @@ class QShmemClientProcess(QShmemProcess):
     """
 
 
+class QShmemMultiStreamProcess(QShmemProcess):
+    """Analyzes several streams in a single multiprocess
+
+    Each call to activate adds a stream (i.e. a shmem client), and deactivate with the same shmem_name removes it.  The multiprocess is shared between the containers, up to max_streams streams (see ProcessPool.getShared), so the analysis cost scales with the number of frames instead of the number of multiprocesses.
+
+    The shmem server of each stream signals new frames also with an EventFd (see MultiForkFilterchain.getShmem), so the multiprocess selects over the EventFds of all streams & the intercom pipe.  The file descriptor of the EventFd is passed along with the activate message, so this works also for multiprocesses launched by a forkserver.  Frames are pulled round-robin, one per stream at a time
+
+    Per-stream state lives in the Stream objects.  Subclasses implement:
+
+    ::
+
+        postActivateStream_(stream)     : a stream was added, e.g. create stream.analyzer
+        preDeactivateStream_(stream)    : a stream is about to be removed
+        handleFrame_(stream, frame)     : analyze a frame (FrameView) of a stream
+
+    Outgoing messages should carry the slot and/or the shmem_name of the stream, so that the frontend can tell the streams apart
+    """
+
+    max_streams = 16
+    # frames are pulled only after the EventFd has signalled them, so this is hit only if the EventFd and the semaphore disagree
+    pull_timeout = 0.01 # seconds
+
+    # the streams are replayed in respawn
+    replay_commands = []
+    replay_cancel = {}
+
+    class Stream:
+        def __init__(self, shmem_name = None, client = None, fd = None, n_buffer = None):
+            self.shmem_name = shmem_name
+            self.client = client
+            self.fd = fd # EventFd file descriptor
+            self.n_buffer = n_buffer
+            self.n_pending = 0 # frames signalled by the EventFd but not pulled yet
+            self.slot = None # known after the first frame
+
+
+    def c__activate(self, 
+        n_buffer:int = None, 
+        image_dimensions:tuple = None, 
+        shmem_name:str = None,
+        event_fd = None):
+        """event_fd is a multiprocessing.reduction.DupFd of the EventFd of the shmem server
+        """
+        self.logger.debug("c__activate: %s", shmem_name)
+        fd = event_fd.detach() # this process' own copy of the file descriptor
+        if shmem_name in self.streams:
+            self.logger.warning("c__activate: stream %s already active", shmem_name)
+            os.close(fd)
+            return
+        client = ShmemRGBClient(
+            name            =shmem_name,
+            n_ringbuffer    =n_buffer,
+            width           =image_dimensions[0],
+            height          =image_dimensions[1],
+            mstimeout       =max(1, int(self.pull_timeout*1000)),
+            verbose         =self.shmem_verbose
+            )
+        stream = self.Stream(shmem_name = shmem_name, client = client, fd = fd, n_buffer = n_buffer)
+        self.streams[shmem_name] = stream
+        self.streams_by_fd[fd] = stream
+        self.listening = True
+        self.postActivateStream_(stream)
+
+
+    def c__deactivate(self, shmem_name = None):
+        """Remove a stream.  If shmem_name is None, remove all streams
+        """
+        self.logger.debug("c__deactivate: %s", shmem_name)
+        if shmem_name is None:
+            names = list(self.streams.keys())
+        else:
+            names = [shmem_name]
+        for name in names:
+            try:
+                stream = self.streams.pop(name)
+            except KeyError:
+                self.logger.warning("c__deactivate: no stream %s", name)
+                continue
+            self.streams_by_fd.pop(stream.fd)
+            os.close(stream.fd)
+            self.preDeactivateStream_(stream)
+        self.listening = len(self.streams) > 0
+
+
+    def __init__(self, name = "QShmemMultiStreamProcess", **kwargs):
+        super().__init__(name = name, **kwargs)
+        self.stream_kwargs = {} # frontend: activate kwargs by shmem_name
+
+
+    def preRun_(self):
+        self.streams = {}
+        self.streams_by_fd = {}
+        super().preRun_()
+
+
+    def run(self):
+        self.preRun_()
+
+        while self.loop:
+            if any(stream.n_pending > 0 for stream in self.streams.values()):
+                timeout = 0 # frames waiting: just poll
+            else:
+                timeout = self.timeout
+            rlis, wlis, elis = safe_select([self.back_pipe] + list(self.streams_by_fd.keys()), [], [], timeout = timeout)
+
+            if self.back_pipe in rlis:
+                rlis.remove(self.back_pipe)
+                obj = self.recv_in__()
+                self.routeMainPipe__(obj)
+
+            for fd in rlis:
+                # the stream might have been removed by the message from the intercom pipe
+                stream = self.streams_by_fd.get(fd)
+                if stream is None:
+                    continue
+                stream.n_pending = min(stream.n_buffer, stream.n_pending + self.readEventFd__(fd))
+
+            self.cycle_()
+
+        self.postRun_()
+        # indicate front end qt thread to exit
+        self.send_out__(None)
+        self.logger.debug("bye!")
+
+
+    def readEventFd__(self, fd):
+        """Number of new frames signalled by an EventFd.  Reading resets the EventFd
+        """
+        try:
+            return int.from_bytes(os.read(fd, 8), sys.byteorder)
+        except BlockingIOError:
+            return 0
+
+
+    def cycle_(self):
+        """Pull one frame from each stream that has frames waiting
+        """
+        for stream in list(self.streams.values()):
+            if stream.n_pending < 1:
+                continue
+            stream.n_pending -= 1
+            # the frames signalled by the EventFd can be pulled without waiting, so the semaphore value is not needed
+            frame = self.pullFrame_(stream.client, n_pending = stream.n_pending)
+            if self.frame_policy == "latest": # pullFrame_ skipped to the newest frame
+                stream.n_pending = 0
+            if frame is None:
+                continue
+            stream.slot = frame.slot
+            self.handleFrame_(stream, frame)
+
+
+    def postActivateStream_(self, stream):
+        pass
+
+    def preDeactivateStream_(self, stream):
+        pass
+
+    def handleFrame_(self, stream, frame):
+        self.logger.debug("handleFrame_: %s: got frame %s", stream.shmem_name, frame)
+
+
+    # *** frontend ***
+
+    def available(self):
+        """Has available space for streams or not
+        """
+        return len(self.stream_kwargs) < self.max_streams
+
+    def inUse(self):
+        return len(self.stream_kwargs) > 0
+
+    def activate(self, **kwargs):
+        """kwargs: n_buffer, image_dimensions, shmem_name & event_fd (an EventFd, see MultiForkFilterchain.getShmemEventFd)
+        """
+        self.stream_kwargs[kwargs["shmem_name"]] = kwargs
+        self.sendActivate_(kwargs)
+
+    def sendActivate_(self, kwargs):
+        kwargs = kwargs.copy()
+        # the file descriptor is duplicated to the running multiprocess when the message is unpickled
+        kwargs["event_fd"] = reduction.DupFd(kwargs["event_fd"].getFd())
+        self.sendMessageToBack(MessageObject(
+            "activate", **kwargs))
+
+    def deactivate(self, shmem_name = None):
+        if shmem_name is None:
+            self.stream_kwargs = {}
+        else:
+            self.stream_kwargs.pop(shmem_name, None)
+        self.sendMessageToBack(MessageObject(
+            "deactivate", shmem_name = shmem_name))
+
+    def respawn(self):
+        super().respawn()
+        for kwargs in self.stream_kwargs.values():
+            self.sendActivate_(kwargs)
+
+    # the MVisionContainer interface.  There's no per-stream analyzer widget
+
+    def connectAnalyzerWidget(self, analyzer_widget):
+        pass
+
+    def disconnectAnalyzerWidget(self, analyzer_widget):
+        pass
+
+    def getAnalyzerParameters(self):
+        return {}
+
+    def updateAnalyzerParameters(self, kwargs):
+        pass
+
+    def getWidget(self, shmem_name = None):
+        """A widget for the stream shmem_name
+        """
+        return QtWidgets.QWidget()
+
+    def releaseWidget(self, shmem_name = None):
+        """The widget of the stream shmem_name is going away: disconnect anything connected to it in getWidget
+        """
+        pass
+
+
+
 class MVisionBaseProcess(QShmemProcess):
     """Mvision process without a common master process
     """
 
+    replay_commands = ["activate", "updateAnalyzerParameters", "requestQtShmemServer"]
+    replay_cancel = {
+        "deactivate"            : ["activate", "requestQtShmemServer"],
+        "releaseQtShmemServer"  : ["requestQtShmemServer"]
+        }
+
     class Signals(QtCore.QObject):
         pong = Signal(object) # demo outgoing signal
         shmem_server = Signal(object) # launched when the mvision process has established a shared mem server
@@ -768,6 +1396,12 @@ class MVisionClientBaseProcess(QShmemClientProcess):
     """Client Analyzer processes that use a common master processs
     """
 
+    replay_commands = ["activate", "updateAnalyzerParameters", "requestQtShmemServer"]
+    replay_cancel = {
+        "deactivate"            : ["activate", "requestQtShmemServer"],
+        "releaseQtShmemServer"  : ["requestQtShmemServer"]
+        }
+
     class Signals(QtCore.QObject):
         pong = Signal(object) # demo outgoing signal
         shmem_server = Signal(object) # launched when the mvision process has established a shared mem server
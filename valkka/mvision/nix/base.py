@@ -27,6 +27,8 @@ import imutils
 import importlib
 import cv2
 import logging
+import threading
+from collections import deque
 
 from valkka.api2 import parameterInitCheck, typeCheck
 from valkka.mvision.base import Analyzer
@@ -36,10 +38,22 @@ from valkka.live import style
 from valkka.live.tools import getLogger, setLogger
 from valkka.mvision.tools import getModulePath
 from valkka.mvision import constant
+from valkka.mvision.nix import ring
 
 
 class ExternalDetector(Analyzer):
     """A demo analyzer, using an external program
+
+    Two ways of passing the frames to the external program (parameter transport):
+
+    ::
+
+        "file"  : frames are dumped into tmpfile & the external program is notified with text lines through its stdin
+        "shmem" : frames are written into a POSIX shared memory ring buffer & the external program is notified with binary messages through its stdin.  See valkka.mvision.nix.ring
+
+    With the "file" transport, the protocol is lock-step: __call__ waits for the results of the previous frame before sending the next one.
+
+    With the "shmem" transport, the protocol is pipelined: up to max_in_flight frames are sent to the external program without waiting for the results.  Each frame occupies a ring buffer cell until the reply with the same frame id arrives.  The replies are read by a separate thread, so __call__ never blocks.  If all max_in_flight frames are still being analyzed, the new frame is dropped.  A frame that has not been answered in in_flight_timeout seconds is forgotten & its cell reused.  If the external program exits, no more frames are sent to it
     """
 
     parameter_defs = {
@@ -47,7 +61,10 @@ class ExternalDetector(Analyzer):
         "debug":            (bool, False),
         "executable":       str,
         "image_dimensions": (tuple, (1920 // 4, 1080 // 4)),
-        "tmpfile":          str
+        "tmpfile":          (str, ""),
+        "transport":        (str, "file"),
+        "max_in_flight":    (int, 2), # shmem transport: max number of frames sent to the external program without results
+        "in_flight_timeout": (float, 5.0) # shmem transport: seconds to wait for the results of a frame
     }
 
     def __init__(self, **kwargs):
@@ -67,7 +84,22 @@ class ExternalDetector(Analyzer):
         width = str(self.image_dimensions[0])
         height = str(self.image_dimensions[1])
         
-        comlist = self.executable.split() + [width, height, self.tmpfile] # e.g. "python3", "example_process1.py", etc.
+        assert(self.transport in ["file", "shmem"])
+        self.ring = None
+        self.frame_id = 0
+        if self.transport == "shmem":
+            assert(self.max_in_flight >= 1)
+            # one cell per frame in flight
+            self.ring = ring.ShmemRing(self.max_in_flight, self.image_dimensions[0], self.image_dimensions[1])
+            self.free_cells = list(range(self.max_in_flight))
+            self.in_flight = {} # frame_id: (cell index, time when sent)
+            self.replies = deque() # filled by the reader thread
+            self.n_dropped = 0
+            self.n_expired = 0
+            self.alive = True # see checkAlive_
+            comlist = self.executable.split() + [width, height, "--shmem", self.ring.name]
+        else:
+            comlist = self.executable.split() + [width, height, self.tmpfile] # e.g. "python3", "example_process1.py", etc.
         
         try:
             self.p = subprocess.Popen(comlist, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
@@ -75,6 +107,9 @@ class ExternalDetector(Analyzer):
             print(self.pre, "Could not open external process.  Failed with '"+str(e)+"'")
             return
         
+        if self.ring is not None:
+            self.reader = threading.Thread(target = self.readReplies__, daemon = True)
+            self.reader.start()
         self.reset()
 
 
@@ -83,8 +118,11 @@ class ExternalDetector(Analyzer):
         """
         self.logger.info("sending reset")
         try:
-            self.p.stdin.write(bytes("T\n","utf-8"))
-            self.p.stdin.flush()
+            if self.ring is not None:
+                ring.sendRequest(self.p.stdin, ring.COMMAND_RESET)
+            else:
+                self.p.stdin.write(bytes("T\n","utf-8"))
+                self.p.stdin.flush()
         except IOError:
             self.logger.info("could not send reset command")
 
@@ -93,19 +131,29 @@ class ExternalDetector(Analyzer):
         """Tell the process to exit
         """
         try:
-            self.p.stdin.write(bytes("X\n","utf-8"))
-            self.p.stdin.flush()
+            if self.ring is not None:
+                ring.sendRequest(self.p.stdin, ring.COMMAND_EXIT)
+            else:
+                self.p.stdin.write(bytes("X\n","utf-8"))
+                self.p.stdin.flush()
         except IOError:
             self.logger.info("could not send exit command")
         self.p.wait() # wait until the process is closed
+        if self.ring is not None:
+            self.reader.join() # exits at the EOF of the stdout of the external program
+            self.ring.close()
+            self.ring = None
+            return
         try:
             os.remove(self.tmpfile) # clean up the temporary file
         except FileNotFoundError:
             pass
 
     
-    def __call__(self, img):
+    def __call__(self, img, mstimestamp = 0):
         self.logger.info("got frame : %s",img.shape)
+        if self.ring is not None:
+            return self.callShmem_(img, mstimestamp)
         
         # before sending the new frame, collect results the analyzer produced from the previous frame
         self.logger.info("waiting for external process")
@@ -131,6 +179,99 @@ class ExternalDetector(Analyzer):
         return result
 
 
+    def readReplies__(self):
+        """Runs in the reader thread
+        """
+        while True:
+            rep = ring.recvReply(self.p.stdout)
+            if rep is None:
+                self.logger.info("external process closed its stdout")
+                break
+            self.replies.append(rep)
+
+
+    def collectReplies_(self):
+        """Release the cells of the answered frames.  Returns the latest results or ""
+        """
+        result = ""
+        while len(self.replies) > 0:
+            command, frame_id, text = self.replies.popleft()
+            try:
+                index, t = self.in_flight.pop(frame_id)
+            except KeyError: # e.g. the receipt of a reset
+                continue
+            self.free_cells.append(index)
+            self.logger.info("got %s for frame %i in %.1f ms: >%s<", chr(command), frame_id, (time.time() - t)*1000, text)
+            if command == ring.REPLY_DATA:
+                result = text
+        self.expireInFlight_()
+        return result
+
+
+    def expireInFlight_(self):
+        """Forget the frames the external program has not answered in in_flight_timeout seconds.  A late reply is ignored (see collectReplies_)
+        """
+        t = time.time()
+        for frame_id, (index, t_) in list(self.in_flight.items()):
+            if (t - t_) > self.in_flight_timeout:
+                self.in_flight.pop(frame_id)
+                self.free_cells.append(index)
+                self.n_expired += 1
+                self.logger.warning("no reply for frame %i in %.1f s: forgetting it (%i expired)", frame_id, t - t_, self.n_expired)
+
+
+    def checkAlive_(self):
+        """Is the external program still running.  A dead one is reported only once
+        """
+        if not self.alive:
+            return False
+        returncode = self.p.poll()
+        if returncode is None and self.reader.is_alive():
+            return True
+        self.alive = False
+        self.logger.critical("external program %s has exited with code %s: not sending frames anymore", self.executable, returncode)
+        return False
+
+
+    def callShmem_(self, img, mstimestamp):
+        result = self.collectReplies_()
+
+        if not self.checkAlive_():
+            return result
+
+        if len(self.free_cells) < 1:
+            # the external program is busy with max_in_flight frames
+            self.n_dropped += 1
+            self.logger.info("dropping frame: %i frames in flight (%i dropped)", len(self.in_flight), self.n_dropped)
+            return result
+
+        index = self.free_cells.pop()
+        if not self.ring.write(index, img):
+            self.logger.warning("frame %s does not fit into the ring buffer", img.shape)
+            self.free_cells.append(index)
+            return result
+        
+        self.frame_id = (self.frame_id + 1) % 0xFFFFFFFF # uint32 in the protocol.  0 is never used by frames
+        if self.frame_id == 0:
+            self.frame_id = 1
+        self.in_flight[self.frame_id] = (index, time.time())
+        try:
+            ring.sendRequest(self.p.stdin, ring.COMMAND_READ, 
+                frame_id    = self.frame_id,
+                index       = index,
+                mstimestamp = mstimestamp,
+                width       = img.shape[1],
+                height      = img.shape[0]
+                )
+        except IOError:
+            self.logger.info("could not send data")
+            self.in_flight.pop(self.frame_id)
+            self.free_cells.append(index)
+
+        # the results of the previous frames: format here the string into a data structure if you need to
+        return result
+
+
     def readStdout(self):
         """Not used
         """
@@ -160,6 +301,10 @@ class MVisionProcess(MVisionBaseProcess):
     
     # The (example) process that gets executed.  You can find it in the module directory
     executable = "python3 "+os.path.join(getModulePath(),"example_process1.py")
+    # How frames are passed to the executable: "file" or "shmem".  See ExternalDetector
+    transport = "file"
+    max_in_flight = 2 # for the shmem transport
+    in_flight_timeout = 5.0 # for the shmem transport
     
     # For each outgoing signal, create a Qt signal with the same name.  The
     # frontend Qt thread will read processes communication pipe and emit these
@@ -197,6 +342,9 @@ class MVisionProcess(MVisionBaseProcess):
             executable = self.executable,
             image_dimensions = self.image_dimensions,
             tmpfile = self.tmpfile,
+            transport = self.transport,
+            max_in_flight = self.max_in_flight,
+            in_flight_timeout = self.in_flight_timeout,
             verbose = self.verbose
             )
         
@@ -222,27 +370,20 @@ class MVisionProcess(MVisionBaseProcess):
                 (self.image_dimensions[1], self.image_dimensions[0], 3))
             result = self.analyzer(img)
         """
-        index, meta = self.client.pullFrame()
-        if (index is None):
-            self.logger.debug("Client timed out..")
-            return
-        
-        self.logger.debug("Client index = %s", index)
-        if meta.size < 1:
+        frame = self.pullFrame_()
+        if frame is None:
             return
 
-        data = self.client.shmem_list[index][0:meta.size]
-        img = data.reshape(
-            (meta.height, meta.width, 3))
-        self.logger.debug("got frame %s", img.shape)
-        result = self.analyzer(img) # does something .. returns something ..
+        img = frame.img
+        self.logger.debug("got frame %s", frame)
+        result = self.analyzer(img, frame.mstimestamp) # does something .. returns something ..
 
         if self.qt_server is not None:
             self.logger.info("pushing frame to server")
             self.qt_server.pushFrame(
                 img,
-                meta.slot,
-                meta.mstimestamp
+                frame.slot,
+                frame.mstimestamp
             )
 
         if (result != ""):
@@ -285,6 +426,32 @@ def test1():
     analyzer.close()
 
 
+def test5():
+    """Like test1, but using the shared memory ring buffer
+    """
+    width = 1920
+    height = 1080
+    
+    analyzer = ExternalDetector(
+        verbose=True, 
+        debug=True,
+        executable = "python3 " + os.path.join(getModulePath(),"example_process1.py"),
+        image_dimensions = (width, height),
+        transport = "shmem",
+        max_in_flight = 3
+        )
+
+    img = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+    
+    for i in range(20):
+        img[:,:,:]=i
+        result = analyzer(img, mstimestamp = i)
+        print("result =", result)
+        time.sleep(0.1) # frames come in faster than the example analyzer can handle them
+    
+    analyzer.close()
+
+
 
 def test2():
     """Demo here the OpenCV highgui with valkka
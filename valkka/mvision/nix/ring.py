@@ -0,0 +1,186 @@
+"""
+ring.py : A POSIX shared memory ring buffer and a binary protocol for the external analyzers
+
+Copyright 2018 Sampsa Riikonen
+
+Authors: Sampsa Riikonen
+
+This file is part of the machine vision plugin for the Valkka Live program
+
+This plugin is free software: you can redistribute it and/or modify it under the terms of the MIT License.  This code is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the MIT License for more details.
+
+@file    ring.py
+@author  Sampsa Riikonen
+@date    2018
+@version 1.2.2
+@brief   A POSIX shared memory ring buffer and a binary protocol for the external analyzers
+"""
+import sys
+import struct
+from multiprocessing import shared_memory
+import numpy
+
+
+"""The external analyzer is started with
+
+::
+
+    executable width height --shmem name
+
+where name is the name of a POSIX shared memory segment (i.e. shm_open("/"+name) in C, or the file /dev/shm/name in Linux).  The segment looks like this:
+
+::
+
+    [ring header] [cell 0] [cell 1] ... [cell n_cells-1]
+
+    ring header : magic (4 bytes, b"VKRB"), version (uint32), n_cells (uint32), cell_size (uint32), width (uint32), height (uint32)
+    cell        : cell_size bytes.  An RGB24 image (height, width, 3) in the beginning of the cell
+
+All integers are little-endian.  Valkka writes requests into the stdin of the external analyzer:
+
+::
+
+    command (uint8), 3 bytes padding, frame_id (uint32), cell index (uint32), mstimestamp (uint64), width (uint32), height (uint32)
+
+    command:
+        "R" : a new frame with frame_id, width & height is in the cell
+        "T" : reset the analyzer state
+        "X" : exit
+
+The external analyzer answers each "R" and "T" request by writing a reply into its stdout:
+
+::
+
+    command (uint8), 3 bytes padding, frame_id (uint32), payload length (uint32), [payload: utf-8 text]
+
+    command:
+        "C" : receipt.  No results.  Payload length is 0
+        "D" : the payload has the (textual) results for frame frame_id
+
+The protocol is pipelined: valkka may send several "R" requests (each one using a different cell) before receiving the replies.  The external analyzer must answer the requests in the order they arrive.  A cell must not be written by valkka before the reply to the request that used it has been received, i.e. the external analyzer may read the cell until it sends the reply
+"""
+
+MAGIC = b"VKRB"
+VERSION = 1
+
+ring_header = struct.Struct("<4sIIIII")
+request = struct.Struct("<BxxxIIQII")
+reply = struct.Struct("<BxxxII")
+
+COMMAND_READ = ord("R")
+COMMAND_RESET = ord("T")
+COMMAND_EXIT = ord("X")
+REPLY_RECEIPT = ord("C")
+REPLY_DATA = ord("D")
+
+
+class ShmemRing:
+    """The valkka end of the shared memory ring buffer
+
+    :param n_cells: Number of cells in the ring buffer
+    :param width:   Maximum image width
+    :param height:  Maximum image height
+    :param name:    Name of the shared memory segment.  Default: None (a unique name is generated)
+    """
+
+    def __init__(self, n_cells, width, height, name = None):
+        self.n_cells = n_cells
+        self.cell_size = width * height * 3
+        self.shm = shared_memory.SharedMemory(
+            name    = name,
+            create  = True,
+            size    = ring_header.size + n_cells * self.cell_size)
+        self.name = self.shm.name
+        ring_header.pack_into(self.shm.buf, 0, MAGIC, VERSION, n_cells, self.cell_size, width, height)
+        self.cells = [
+            numpy.ndarray((self.cell_size,), dtype = numpy.uint8, buffer = self.shm.buf,
+                offset = ring_header.size + i * self.cell_size)
+            for i in range(n_cells)
+            ]
+
+    def write(self, index, img):
+        """Copy an image into a cell.  Returns False if the image doesn't fit
+        """
+        if img.size > self.cell_size:
+            return False
+        numpy.copyto(self.cells[index][0:img.size].reshape(img.shape), img)
+        return True
+
+    def close(self):
+        self.cells = [] # numpy arrays must release the buffer before the segment can be closed
+        self.shm.close()
+        self.shm.unlink()
+
+
+def sendRequest(f, command, frame_id = 0, index = 0, mstimestamp = 0, width = 0, height = 0):
+    f.write(request.pack(command, frame_id, index, mstimestamp, width, height))
+    f.flush()
+
+
+def readExactly(f, n):
+    """Read n bytes from a binary stream.  Returns None at EOF
+    """
+    buf = bytes()
+    while len(buf) < n:
+        b = f.read(n - len(buf))
+        if not b:
+            return None
+        buf += b
+    return buf
+
+
+def recvReply(f):
+    """Returns a tuple (command, frame_id, text) or None at EOF
+    """
+    buf = readExactly(f, reply.size)
+    if buf is None:
+        return None
+    command, frame_id, n = reply.unpack(buf)
+    if n > 0:
+        payload = readExactly(f, n)
+        if payload is None:
+            return None
+        return command, frame_id, payload.decode("utf-8")
+    return command, frame_id, ""
+
+
+def test1():
+    """Ring buffer & protocol round trip through an in-memory stream
+    """
+    import io
+    ring = ShmemRing(2, 16, 8)
+    img = numpy.arange(16*8*3, dtype = numpy.uint8).reshape((8, 16, 3))
+    assert(ring.write(1, img))
+    assert(not ring.write(1, numpy.zeros((9, 16, 3), dtype = numpy.uint8)))
+
+    # the external analyzer end
+    f = open("/dev/shm/" + ring.name, "rb")
+    buf = f.read()
+    f.close()
+    magic, version, n_cells, cell_size, width, height = ring_header.unpack_from(buf, 0)
+    print(magic, version, n_cells, cell_size, width, height)
+    offset = ring_header.size + 1 * cell_size
+    img_ = numpy.frombuffer(buf, dtype = numpy.uint8, count = img.size, offset = offset).reshape(img.shape)
+    assert((img_ == img).all())
+
+    s = io.BytesIO()
+    sendRequest(s, COMMAND_READ, frame_id = 5, index = 1, mstimestamp = 123, width = 16, height = 8)
+    s.write(reply.pack(REPLY_DATA, 5, 5) + b"hello")
+    s.seek(0)
+    print(request.unpack(readExactly(s, request.size)))
+    print(recvReply(s))
+    ring.close()
+
+
+def main():
+    pre = "main :"
+    print(pre, "main: arguments: ", sys.argv)
+    if (len(sys.argv) < 2):
+        print(pre, "main: needs test number")
+    else:
+        st = "test" + str(sys.argv[1]) + "()"
+        exec(st)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -36,29 +36,14 @@ pre = "valkka.mvision.yolo2.base : "
 from valkka.mvision.yolo3 import YoloV3Analyzer
 from valkka.mvision.yolo3 import MVisionProcess as BaseProcess
 from valkka.mvision.multiprocess import test_process, test_with_file
-
-
-# if the following works, then darknet is available and the weights file has been downloaded ok
-from darknet.api2.constant import get_yolov2_weights_file, get_yolov3_weights_file, get_yolov3_tiny_weights_file
-fname = get_yolov2_weights_file()
-
-from valkka.live.version import MIN_DARKNET_VERSION_MAJOR, MIN_DARKNET_VERSION_MINOR, MIN_DARKNET_VERSION_PATCH
-from darknet.core import VERSION_MAJOR, VERSION_MINOR, VERSION_PATCH
-assert(VERSION_MAJOR >= MIN_DARKNET_VERSION_MAJOR)
-assert(VERSION_MINOR >= MIN_DARKNET_VERSION_MINOR)
-assert(VERSION_PATCH >= MIN_DARKNET_VERSION_PATCH)
+from valkka.mvision import detector
 
 
 class YoloV2Analyzer(YoloV3Analyzer):
     
-    def init(self):
-        # from darknet.api2.error import WeightMissingError
-        from darknet.api2.predictor import get_YOLOv3_Predictor, get_YOLOv3_Tiny_Predictor, get_YOLOv2_Predictor
-        # self.predictor = get_YOLOv3_Predictor()
-        # self.predictor = get_YOLOv3_Tiny_Predictor()
-        self.predictor = get_YOLOv2_Predictor()
-        self.reset()
-        
+    model = "yolov2" # for the darknet backend
+
+
 
 class MVisionProcess(BaseProcess):
     """YOLO v2 object detector
@@ -67,20 +52,15 @@ class MVisionProcess(BaseProcess):
     name = "YOLO v2 object detector"
     tag = "yolov2"
     max_instances = 1       # just one instance allowed .. this is kinda heavy detector
-    auto_menu = True # append automatically to valkka live machine vision menu or not
 
     required_mb = 1230      # required GPU memory in MB
     
-    def postActivate_(self):
-        """Whatever you need to do after creating the shmem client
-        """
-        # super().postActivate_() # nopes, since we inherit from yolov3
-        if (self.requiredGPU_MB(self.required_mb)):
-            self.analyzer = YoloV2Analyzer(verbose = self.verbose)
-        else:
-            self.warning_message = "WARNING: not enough GPU memory!"
-            self.analyzer = None
-    
+    detector_backends = [
+        ("darknet", {"model": "yolov2"}),
+        ("opencv",  detector.opencv_yolov2)
+        ]
+    analyzer_class = YoloV2Analyzer
+    auto_menu = detector.hasBackend(detector_backends) # in the menu only if a backend is available
         
         
 def test1():
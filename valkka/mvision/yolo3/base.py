@@ -32,64 +32,17 @@ from valkka.mvision.base import Analyzer
 from valkka.live.multiprocess import MessageObject
 from valkka.mvision.multiprocess import test_process, test_with_file, MVisionBaseProcess
 from valkka.live import style
-from valkka.live.tools import getLogger, setLogger, getFreeGPU_MB
+from valkka.live.tools import getLogger, setLogger
+from valkka.mvision import detector
 
-# if the following works, then darknet is available and the weights file has been downloaded ok
-from darknet.api2.constant import get_yolov2_weights_file, get_yolov3_weights_file, get_yolov3_tiny_weights_file
-fname = get_yolov3_weights_file()
 
-from valkka.live.version import MIN_DARKNET_VERSION_MAJOR, MIN_DARKNET_VERSION_MINOR, MIN_DARKNET_VERSION_PATCH
-from darknet.core import VERSION_MAJOR, VERSION_MINOR, VERSION_PATCH
-assert(VERSION_MAJOR >= MIN_DARKNET_VERSION_MAJOR)
-assert(VERSION_MINOR >= MIN_DARKNET_VERSION_MINOR)
-assert(VERSION_PATCH >= MIN_DARKNET_VERSION_PATCH)
-
-
-class YoloV3Analyzer(Analyzer):
+class YoloV3Analyzer(detector.DetectorAnalyzer):
     """The celebrated Yolo v3 object detector
+
+    The detection is done by a valkka.mvision.detector.DetectorBackend.  If no backend is given, the darknet backend is used
     """
 
-    parameter_defs = {
-        "verbose": (bool, False),   # :param verbose:  Verbose output or not?  Default: False.
-        "debug": (bool, False)     
-    }
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        # checks that kwargs is consistent with parameter_defs.  Attaches
-        # parameters as attributes to self
-        parameterInitCheck(self.parameter_defs, kwargs, self)
-        self.init()
-            
-            
-    def init(self):
-        # from darknet.api2.error import WeightMissingError
-        from darknet.api2.predictor import get_YOLOv3_Predictor, get_YOLOv3_Tiny_Predictor, get_YOLOv2_Predictor
-        self.predictor = get_YOLOv3_Predictor()
-        # self.predictor = get_YOLOv3_Tiny_Predictor()
-        # self.predictor = get_YOLOv2_Predictor()
-        self.reset()
-        
-    def reset(self):
-        pass
-        
-    def __call__(self, img):
-        self.logger.debug("analyzing frame : %s",img.shape)    
-        lis = self.predictor(img)
-        """
-        lis = [ # debugging ..
-            ('dog', 99, 134, 313, 214, 542), 
-            ('truck', 91, 476, 684, 81, 168),
-            ('bicycle', 99, 99, 589, 124, 447)
-            ]
-        """
-        """
-        lis = [ # debugging ..
-            ('dog', 99, img.shape[0]*0.25, img.shape[0]*0.75, img.shape[1]*0.25, img.shape[1]*0.75)
-            ]
-        """
-        self.logger.debug("finished analyzing frame")
-        return lis
+    model = "yolov3" # for the darknet backend
 
 
 
@@ -106,9 +59,33 @@ class MVisionProcess(MVisionBaseProcess):
     name = "YOLO v3 object detector"
     tag = "yolov3"
     max_instances = 1       # just one instance allowed .. this is kinda heavy detector
-    auto_menu = True # append automatically to valkka live machine vision menu or not
 
     required_mb = 2400      # required GPU memory in MB
+
+    # yolo's native input size at 2 fps.  Subclasses (yolo2, yolo3tiny) inherit these
+    shmem_image_dimensions = (416, 416)
+    shmem_image_interval = 500
+
+    # detector backends & their parameters in the order of preference.  See valkka.mvision.detector
+    detector_backends = [
+        ("darknet", {"model": "yolov3"}),
+        ("opencv",  detector.opencv_yolov3)
+        ]
+    analyzer_class = YoloV3Analyzer
+
+    # the GPU reservation is not replayed but made again in respawn.  See preReplay_
+    replay_commands = ["activate", "updateAnalyzerParameters", "requestQtShmemServer"]
+    replay_cancel = {
+        "deactivate"            : ["activate", "requestQtShmemServer"],
+        "releaseQtShmemServer"  : ["requestQtShmemServer"]
+        }
+    auto_menu = detector.hasBackend(detector_backends) # append automatically to valkka live machine vision menu if a backend is available
+
+    # only the latest object list & bounding boxes are relevant for the GUI: coalesce them
+    coalesce_signals = True
+    state_signals = ["objects", "bboxes"]
+    # yolo is slow (on cpu, especially): analyze always the newest frame to keep the latency bounded
+    frame_policy = "latest"
     
     # For each outgoing signal, create a Qt signal with the same name.  The
     # frontend Qt thread will read processes communication pipe and emit these
@@ -127,35 +104,32 @@ class MVisionProcess(MVisionBaseProcess):
         parameterInitCheck(self.parameter_defs, kwargs, self)
         super().__init__(name = self.__class__.name)
         self.analyzer = None
+        self.gpu_claimed = False # a front-end variable.  See reserveGPU
 
     def preRun_(self):
         super().preRun_()
         self.analyzer = None
+        self.gpu_reserved = True # see reserveGPU
         
     def postRun_(self):
         if (self.analyzer): self.analyzer.close() # release any resources acquired by the analyzer
         super().postRun_()
         
         
-    def requiredGPU_MB(self, n):
-        """Required GPU memory in MBytes
-        """
-        from darknet.core import darknet_with_cuda
-        if (darknet_with_cuda()): # its using cuda
-            free = getFreeGPU_MB()
-            print("Yolo: requiredGPU_MB: required, free", n, free)
-            if (free == -1): # could not detect ..
-                return True
-            return (free>=n)
-        else:
-            return True
-        
+    def c__reserveGPU(self, ok = True):
+        # did the front-end manage to reserve GPU memory for this process
+        self.gpu_reserved = ok
+
     def postActivate_(self):
         """Whatever you need to do after creating the shmem client
         """
         super().postActivate_()
-        if (self.requiredGPU_MB(self.required_mb)):
-            self.analyzer = YoloV3Analyzer(verbose = self.verbose)
+        backend = detector.preferredBackend(self.detector_backends, verbose = self.verbose)
+        if backend is None:
+            self.warning_message = "WARNING: no detector backend available!"
+            self.analyzer = None
+        elif self.gpu_reserved or not backend.usesGPU():
+            self.analyzer = self.analyzer_class(verbose = self.verbose, backend = backend)
         else:
             self.warning_message = "WARNING: not enough GPU memory!"
             self.analyzer = None
@@ -183,26 +157,19 @@ class MVisionProcess(MVisionBaseProcess):
             img = data.reshape(
                 (self.image_dimensions[1], self.image_dimensions[0], 3))
         """
-        index, meta = self.client.pullFrame()
-        if (index is None):
-            self.logger.debug("Client timed out..")
-            return
-        
-        self.logger.debug("Client index = %s", index)
-        if (meta.size < 1) or (self.analyzer is None):
+        frame = self.pullFrame_()
+        if (frame is None) or (self.analyzer is None):
             return
 
-        data = self.client.shmem_list[index][0:meta.size]
-        img = data.reshape(
-            (meta.height, meta.width, 3))
+        img = frame.img
         lis = self.analyzer(img)
 
         if self.qt_server is not None:
             self.logger.info("pushing frame to server")
             self.qt_server.pushFrame(
                 img,
-                meta.slot,
-                meta.mstimestamp
+                frame.slot,
+                frame.mstimestamp
             )
 
         """
@@ -218,18 +185,8 @@ class MVisionProcess(MVisionBaseProcess):
         ]
         """
         
-        object_list=[]
-        bbox_list=[]
-        for l in lis:
-            object_list.append(l[0])
-            # """
-            bbox_list.append((
-                l[2]/img.shape[1],  # from pixels to fractional coordinates
-                l[3]/img.shape[1],
-                l[4]/img.shape[0],
-                l[5]/img.shape[0]
-            ))
-            # """
+        object_list = [l[0] for l in lis]
+        bbox_list = detector.fractional(lis, img.shape) # from pixels to fractional coordinates
             
         if (hasattr(self, "warning_message")):
             object_list.append(self.warning_message)
@@ -242,6 +199,42 @@ class MVisionProcess(MVisionBaseProcess):
         self.send_out__(MessageObject("bboxes", bbox_list = bbox_list))
         
 
+    # *** frontend ***
+
+    def reserveGPU(self):
+        """GPU memory is reserved here, in the main process, so that analyzers activated at the same time don't all count on the same free memory
+
+        A process holds at most one claim: it's released in deactivate & requestStop
+        """
+        if not self.gpu_claimed:
+            self.gpu_claimed = detector.reserveGPU_MB(self.detector_backends, self.required_mb)
+        self.sendMessageToBack(MessageObject(
+            "reserveGPU", ok = self.gpu_claimed))
+
+    def releaseGPU(self):
+        if self.gpu_claimed:
+            detector.releaseGPU_MB(self.detector_backends, self.required_mb)
+            self.gpu_claimed = False
+
+    def activate(self, **kwargs):
+        self.reserveGPU()
+        super().activate(**kwargs)
+
+    def deactivate(self):
+        super().deactivate()
+        self.releaseGPU()
+
+    def requestStop(self):
+        self.releaseGPU()
+        super().requestStop()
+
+    def preReplay_(self):
+        # the GPU memory of the dead multiprocess is free again: reserve it anew for the new one, before activate is replayed
+        self.releaseGPU()
+        if "activate" in self.replay:
+            self.reserveGPU()
+
+
     # *** create a widget for this machine vision module ***
     def getWidget(self):
         """Some ideas for your widget:
@@ -40,7 +40,17 @@ class MVisionClientProcess(MVisionClientBaseProcess):
     tag = "yolo3client"
     max_instances = 5
     master = "yolo3master" # name tag of the required master process
+
+    # yolo's native input size at 2 fps
+    shmem_image_dimensions = (416, 416)
+    shmem_image_interval = 500
     auto_menu = True # append automatically to valkka live machine vision menu or not
+
+    # only the latest object list & bounding boxes are relevant for the GUI: coalesce them
+    coalesce_signals = True
+    state_signals = ["objects", "bboxes"]
+    # yolo is slow (on cpu, especially): analyze always the newest frame to keep the latency bounded
+    frame_policy = "latest"
     
     # For each outgoing signal, create a Qt signal with the same name.  The
     # frontend Qt thread will read processes communication pipe and emit these
@@ -63,6 +73,7 @@ class MVisionClientProcess(MVisionClientBaseProcess):
     def preRun_(self):
         super().preRun_()
         retval, self.baseline = cv2.getTextSize("A", cv2.FONT_HERSHEY_SIMPLEX, 1, 2)
+        self.boxes = [] # latest bounding boxes from the master process
         print("retval, baseline", retval, self.baseline)
 
 
@@ -71,75 +82,50 @@ class MVisionClientProcess(MVisionClientBaseProcess):
 
 
     def cycle_(self):
-        lis=[]
         self.logger.debug("cycle_ starts")
-        index, meta = self.client.pullFrame()
-        if (index is None):
-            self.logger.debug("Client timed out..")
-            return
-        
-        self.logger.debug("Client index = %s", index)
-        if meta.size < 1:
+        frame = self.pullFrame_()
+        if frame is not None:
+            self.logger.debug("cycle_: got frame %s", frame)
+            # sent to the master process: the results arrive later on in handleReply_
+            self.pushToMaster_(frame)
+        self.readReplies_()
+
+        if (frame is None) or (self.qt_server is None):
             return
 
-        data = self.client.shmem_list[index][0:meta.size]
-        img = data.reshape(
-            (meta.height, meta.width, 3))
-
-        scale = numpy.array([meta.height, meta.width])
-        self.logger.debug("cycle_: got frame %s", img.shape)
-
-        img_ = img.copy()
-
-        if self.server is not None:
-            self.logger.debug("cycle_ : pushing to server")
-            self.server.pushFrame(
-                img,
-                meta.slot,
-                meta.mstimestamp
-            )
-            # receive results from master process
-            replies = self.master_pipe.recv()
-            self.logger.debug("reply from master process: %s", replies)
-            if replies is not None:
-                object_list = []
-                bbox_list = []
-                for reply in replies:
-                    if isinstance(reply, str):
-                        object_list.append(reply)
-                    else:
-                        tag = reply[0]
-                        x0 = reply[1] 
-                        x1 = reply[2]
-                        y0 = reply[3]
-                        y1 = reply[4]
-
-                        object_list.append(tag)
-                        bbox_list.append((x0, x1, y0, y1))
-                        # yolo: origo at left lower corner
-                        y0 = 1 - y0 # numpy / opencv: origo at left upper corner
-                        y1 = 1 - y1
-
-                        # start: lower left corner of the box
-                        start = (int(x0 * meta.width), int(y0 * meta.height))
-                        # end: upper right corner of the box
-                        end = (int( x1 * meta.width), int( y1 * meta.height))
-                        
-                        linew = 3 # object box linewidth
-                        label = (int(x0 * meta.width), int(y1 * meta.height) + self.baseline + linew + 2) # object label coordinates
-                        """
-                        print(">", x0, x1, y0, y1)
-                        print("width, height", meta.width, meta.height)
-                        print("start", start)
-                        print("end", end)
-                        """
-                        color = (255, 0, 0)
-                        img_ = cv2.rectangle(img_, start, end, color, linew)
-                        cv2.putText(img_, tag, label, cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2, cv2.LINE_AA)
-
-                self.send_out__(MessageObject("objects", object_list = object_list))
-                self.send_out__(MessageObject("bboxes", bbox_list = bbox_list))
-
+        img_ = self.scratch(frame) # overlays are drawn into the per-process scratch buffer
+        # draw the latest results available
+        for tag, x0, x1, y0, y1 in self.boxes:
+            # yolo: origo at left lower corner
+            y0 = 1 - y0 # numpy / opencv: origo at left upper corner
+            y1 = 1 - y1
+
+            # start: lower left corner of the box
+            start = (int(x0 * frame.width), int(y0 * frame.height))
+            # end: upper right corner of the box
+            end = (int( x1 * frame.width), int( y1 * frame.height))
+            
+            linew = 3 # object box linewidth
+            label = (int(x0 * frame.width), int(y1 * frame.height) + self.baseline + linew + 2) # object label coordinates
+            """
+            print(">", x0, x1, y0, y1)
+            print("width, height", frame.width, frame.height)
+            print("start", start)
+            print("end", end)
+            """
+            color = (255, 0, 0)
+            img_ = cv2.rectangle(img_, start, end, color, linew)
+            cv2.putText(img_, tag, label, cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2, cv2.LINE_AA)
+
+        self.logger.info("pushing frame to server")
+        self.qt_server.pushFrame(
+            img_,
+            frame.slot,
+            frame.mstimestamp
+        )
+
+
+    def handleReply_(self, seq, slot, mstimestamp, replies):
         """
         reply can be:
         
@@ -149,13 +135,27 @@ class MVisionClientProcess(MVisionClientBaseProcess):
                 (nametag, x, y, w, h)
             - string
         """
-        if self.qt_server is not None:
-            self.logger.info("pushing frame to server")
-            self.qt_server.pushFrame(
-                img_,
-                meta.slot,
-                meta.mstimestamp
-            )
+        self.logger.debug("reply from master process: %s", replies)
+        if replies is None:
+            return
+        object_list = []
+        bbox_list = []
+        boxes = []
+        for reply in replies:
+            if isinstance(reply, str):
+                object_list.append(reply)
+            else:
+                tag = reply[0]
+                x0 = reply[1] 
+                x1 = reply[2]
+                y0 = reply[3]
+                y1 = reply[4]
+                object_list.append(tag)
+                bbox_list.append((x0, x1, y0, y1))
+                boxes.append((tag, x0, x1, y0, y1))
+        self.boxes = boxes
+        self.send_out__(MessageObject("objects", object_list = object_list))
+        self.send_out__(MessageObject("bboxes", bbox_list = bbox_list))
 
 
     # *** create a widget for this machine vision module ***
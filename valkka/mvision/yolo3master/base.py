@@ -32,64 +32,16 @@ from valkka.mvision.base import Analyzer
 from valkka.live.multiprocess import MessageObject
 from valkka.mvision.multiprocess import QShmemMasterProcess
 from valkka.live import style
-from valkka.live.tools import getLogger, setLogger, getFreeGPU_MB
+from valkka.live.tools import getLogger, setLogger
 
-# if the following works, then darknet is available and the weights file has been downloaded ok
-from darknet.api2.constant import get_yolov2_weights_file, get_yolov3_weights_file, get_yolov3_tiny_weights_file
-fname = get_yolov3_weights_file()
+from valkka.mvision import detector
 
-from valkka.live.version import MIN_DARKNET_VERSION_MAJOR, MIN_DARKNET_VERSION_MINOR, MIN_DARKNET_VERSION_PATCH
-from darknet.core import VERSION_MAJOR, VERSION_MINOR, VERSION_PATCH
-assert(VERSION_MAJOR >= MIN_DARKNET_VERSION_MAJOR)
-assert(VERSION_MINOR >= MIN_DARKNET_VERSION_MINOR)
-assert(VERSION_PATCH >= MIN_DARKNET_VERSION_PATCH)
 
-
-class YoloV3Analyzer(Analyzer):
-    """The celebrated Yolo v3 object detector
+class YoloV3Analyzer(detector.DetectorAnalyzer):
+    """Yolo v3 tiny object detector.  See valkka.mvision.detector.DetectorAnalyzer
     """
 
-    parameter_defs = {
-        "verbose": (bool, False),   # :param verbose:  Verbose output or not?  Default: False.
-        "debug": (bool, False)     
-    }
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        # checks that kwargs is consistent with parameter_defs.  Attaches
-        # parameters as attributes to self
-        parameterInitCheck(self.parameter_defs, kwargs, self)
-        self.init()
-            
-            
-    def init(self):
-        # from darknet.api2.error import WeightMissingError
-        from darknet.api2.predictor import get_YOLOv3_Predictor, get_YOLOv3_Tiny_Predictor, get_YOLOv2_Predictor
-        # self.predictor = get_YOLOv3_Predictor()
-        self.predictor = get_YOLOv3_Tiny_Predictor()
-        # self.predictor = get_YOLOv2_Predictor()
-        self.reset()
-        
-    def reset(self):
-        pass
-        
-    def __call__(self, img):
-        self.logger.debug("analyzing frame : %s",img.shape)    
-        lis = self.predictor(img)
-        """
-        lis = [ # debugging ..
-            ('dog', 99, 134, 313, 214, 542), 
-            ('truck', 91, 476, 684, 81, 168),
-            ('bicycle', 99, 99, 589, 124, 447)
-            ]
-        """
-        """
-        lis = [ # debugging ..
-            ('dog', 99, img.shape[0]*0.25, img.shape[0]*0.75, img.shape[1]*0.25, img.shape[1]*0.75)
-            ]
-        """
-        self.logger.debug("finished analyzing frame")
-        return lis
+    model = "yolov3tiny" # for the darknet backend
 
 
 
@@ -105,10 +57,18 @@ class MVisionMasterProcess(QShmemMasterProcess):
     
     name = "YOLO v3 object detector master"
     tag = "yolo3master"
-    max_instances = 1       # just one instance allowed .. this is kinda heavy detector
+    max_instances = 2       # this is kinda heavy detector: a second instance is spawned only if the first one is saturated
     max_clients = 4
+    max_batch = 4           # analyze frames from all clients in one go
     
     required_mb = 230      # required GPU memory in MB .. this is tiny yolo
+
+    # detector backends & their parameters in the order of preference.  See valkka.mvision.detector
+    detector_backends = [
+        ("darknet", {"model": "yolov3tiny"}),
+        ("opencv",  detector.opencv_yolov3_tiny)
+        ]
+    auto_menu = detector.hasBackend(detector_backends)
     
     
     parameter_defs = {
@@ -119,34 +79,30 @@ class MVisionMasterProcess(QShmemMasterProcess):
         parameterInitCheck(self.parameter_defs, kwargs, self)
         super().__init__(self.__class__.name)
         self.analyzer = None
+        self.gpu_claimed = False # a front-end variable.  See registerClient
         # self.setDebug()
 
     def preRun_(self):
         super().preRun_()
         self.analyzer = None
+        self.gpu_reserved = True # see registerClient
         
     def postRun_(self):
         if (self.analyzer is not None): self.analyzer.close() # release any resources acquired by the analyzer
         super().postRun_()
         
         
-    def requiredGPU_MB(self, n):
-        """Required GPU memory in MBytes
-        """
-        from darknet.core import darknet_with_cuda
-        if (darknet_with_cuda()): # its using cuda
-            free = getFreeGPU_MB()
-            print("Yolo: requiredGPU_MB: required, free", n, free)
-            if (free == -1): # could not detect ..
-                return True
-            return (free>=n)
-        else:
-            return True
-        
+    def c__reserveGPU(self, ok = True):
+        # did the front-end manage to reserve GPU memory for this process
+        self.gpu_reserved = ok
 
     def firstClientRegistered_(self):
-        if (self.requiredGPU_MB(self.required_mb)):
-            self.analyzer = YoloV3Analyzer(verbose = self.verbose)
+        backend = detector.preferredBackend(self.detector_backends, verbose = self.verbose)
+        if backend is None:
+            self.warning_message = "WARNING: no detector backend available!"
+            self.analyzer = None
+        elif self.gpu_reserved or not backend.usesGPU():
+            self.analyzer = YoloV3Analyzer(verbose = self.verbose, backend = backend)
             # self.analyzer = None # debug
         else:
             self.warning_message = "WARNING: not enough GPU memory!"
@@ -156,10 +112,43 @@ class MVisionMasterProcess(QShmemMasterProcess):
     def lastClientUnregistered_(self):
         if (self.analyzer): self.analyzer.close()
         self.analyzer = None
+
+
+    # *** frontend ***
+
+    def registerClient(self, **kwargs):
+        if self.n_clients < 1:
+            # the analyzer is created when the first client registers.  GPU memory is reserved here, in the main process, so that
+            # master processes (& other analyzers) started at the same time don't all count on the same free memory
+            if not self.gpu_claimed:
+                self.gpu_claimed = detector.reserveGPU_MB(self.detector_backends, self.required_mb)
+            self.sendMessageToBack(MessageObject(
+                "reserveGPU", ok = self.gpu_claimed))
+        super().registerClient(**kwargs)
+
+    def unregisterClient(self, **kwargs):
+        super().unregisterClient(**kwargs)
+        if self.n_clients < 1: # the analyzer is closed
+            self.releaseGPU()
+
+    def releaseGPU(self):
+        if self.gpu_claimed:
+            detector.releaseGPU_MB(self.detector_backends, self.required_mb)
+            self.gpu_claimed = False
+
+    def requestStop(self):
+        self.releaseGPU()
+        super().requestStop()
+
+    def respawn(self):
+        # the GPU memory of the dead multiprocess is free again.  The clients register again (see QShmemClientProcess.peerRespawned)
+        # & the first one makes a new reservation
+        self.releaseGPU()
+        super().respawn()
             
 
-    def handleFrame_(self, shmem_client):
-        """Receives frames from the shmem client and does something with them
+    def handleFrame_(self, frame):
+        """Receives a frame from a shmem client and does something with it
 
         This routine returns:
         - None
@@ -168,18 +157,28 @@ class MVisionMasterProcess(QShmemMasterProcess):
                 (nametag, x, y, w, h)
             - string
         """
-        index, meta = shmem_client.pullFrame()
-        self.logger.debug("index %s, meta.size %s, meta.height %s, meta.width %s, prod %s", index, meta.size, meta.height, meta.width, meta.height*meta.width*3)
+        self.logger.debug("frame %s", frame)
         # return [] # debugging
 
-        if (meta.size < 1) or (self.analyzer is None):
+        if self.analyzer is None:
             return None
 
-        data = shmem_client.shmem_list[index][0:meta.size]
-        img = data.reshape(
-            (meta.height, meta.width, 3))
-        lis = self.analyzer(img)
+        return self.reply_(self.analyzer(frame.img), frame.img)
 
+
+    def handleBatch_(self, frames):
+        """Like handleFrame_, but for a batch of frames (see max_batch)
+        """
+        if self.analyzer is None:
+            return [None] * len(frames)
+        valid = [frame for frame in frames if frame is not None]
+        results = iter(self.analyzer.batch([frame.img for frame in valid]))
+        return [None if frame is None else self.reply_(next(results), frame.img) for frame in frames]
+
+
+    def reply_(self, lis, img):
+        """Analyzer results to a reply for the client process
+        """
         """
         print("img.shape=",img.shape)
         for l in lis:
@@ -192,17 +191,9 @@ class MVisionMasterProcess(QShmemMasterProcess):
         ('bicycle', 99, 99, 589, 124, 447)
         ]
         """        
-        bbox_list=[]
-        for l in lis:
-            # """
-            bbox_list.append((
-                l[0], # name tag
-                l[2]/img.shape[1],  # from pixels to fractional coordinates
-                l[3]/img.shape[1],
-                l[4]/img.shape[0],
-                l[5]/img.shape[0]
-            ))
-            # """
+        bbox_list = [ # (name tag, left, right, top, bottom)
+            (l[0],) + bbox for l, bbox in zip(lis, detector.fractional(lis, img.shape)) # from pixels to fractional coordinates
+            ]
             
         if (hasattr(self, "warning_message")):
             bbox_list.append(self.warning_message)